@@ -2,96 +2,909 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import AsIs, register_adapter
 from urllib.parse import parse_qs, urlparse
 import voyageai
 import anthropic
 import re
 import imagehash
-from PIL import Image
-from io import BytesIO
+from PIL import Image, ImageOps
+import numpy as np
+from io import BytesIO, RawIOBase
 import base64
+import threading
+import time
+import bisect
+import heapq
+import copy
+import gzip
+import hashlib
+import hmac
+import sqlite3
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Clients
 vo = voyageai.Client(api_key=os.environ.get("VOYAGE_API_KEY"))
 claude = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
 def get_db():
+    """Connessione dedicata, fuori dal pool (script, migrazioni)."""
     return psycopg2.connect(os.environ.get("NEON_DATABASE_URL"))
 
-# ============ IMAGE HASH FUNCTIONS (NEW) ============
+# ============ DATABASE POOL ============
 
-def compute_image_hash(image_base64: str) -> str:
-    """Calcola l'hash percettivo di un'immagine in base64."""
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_HEALTHCHECK_IDLE = float(os.environ.get("DB_HEALTHCHECK_IDLE", "30"))
+
+class DatabasePool:
+    """Pool di connessioni Postgres condiviso da tutto il processo.
+    
+    Le connessioni restituite restano aperte fino a `maxconn` (non solo
+    `minconn` come in psycopg2.pool), così una raffica di ricerche non riapre
+    connessioni verso Neon. Quelle rimaste inattive più di `healthcheck_idle`
+    secondi vengono verificate al prelievo: dopo lo scale-to-zero di Neon i
+    socket sono chiusi lato server, quindi quelle morte vengono scartate e sostituite.
+    """
+    
+    def __init__(self, dsn: str, minconn: int, maxconn: int,
+                 timeout: float = 10, healthcheck_idle: float = 30):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        # (connessione, ultimo uso): l'ultima restituita è la prima riusata
+        self._idle = []
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'connessioni_create': 0,
+            'riconnessioni': 0,
+            'healthcheck': 0,
+            'timeout': 0,
+            'attesa_ms_totale': 0.0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+    
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        # Niente round trip per BEGIN/ROLLBACK
+        conn.autocommit = True
+        with self._lock:
+            self._stats['connessioni_create'] += 1
+        return conn
+    
+    def getconn(self):
+        """Preleva una connessione sana, attendendo al massimo `timeout` secondi."""
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeout'] += 1
+            raise pg_pool.PoolError("Pool di connessioni esaurito")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            self._stats['attesa_ms_totale'] += (time.monotonic() - started) * 1000
+        return conn
+    
+    def _checkout(self):
+        while True:
+            with self._lock:
+                conn, last_used = self._idle.pop() if self._idle else (None, None)
+            if conn is None:
+                return self._connect()
+            
+            if not conn.closed and time.monotonic() - last_used < self.healthcheck_idle:
+                return conn
+            
+            if self._is_alive(conn):
+                return conn
+            
+            with self._lock:
+                self._stats['riconnessioni'] += 1
+            self._close(conn)
+    
+    def _is_alive(self, conn) -> bool:
+        if conn.closed:
+            return False
+        with self._lock:
+            self._stats['healthcheck'] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+    
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def putconn(self, conn, discard: bool = False):
+        """Restituisce la connessione; `discard` la chiude invece di riusarla."""
+        try:
+            # Una transazione rimasta aperta (BEGIN esplicito interrotto) non si riusa
+            reusable = (not discard and not conn.closed
+                        and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+            with self._lock:
+                self._in_use -= 1
+                if reusable and not self._closed:
+                    self._idle.append((conn, time.monotonic()))
+                    return
+            self._close(conn)
+        finally:
+            self._slots.release()
+    
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+    
+    def available(self) -> int:
+        """Connessioni prelevabili in questo momento senza attendere."""
+        with self._lock:
+            return self.maxconn - self._in_use
+    
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_uso'] = self._in_use
+            stats['inattive'] = len(self._idle)
+        stats['attesa_ms_totale'] = round(stats['attesa_ms_totale'], 2)
+        stats['min'] = self.minconn
+        stats['max'] = self.maxconn
+        return stats
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_pool() -> DatabasePool:
+    """Restituisce il pool del processo, creandolo al primo utilizzo."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DatabasePool(
+                    os.environ.get("NEON_DATABASE_URL"),
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    healthcheck_idle=DB_HEALTHCHECK_IDLE
+                )
+    return _db_pool
+
+def reset_pool(close: bool = True):
+    """Scarta il pool corrente; il prossimo prelievo ne crea uno nuovo.
+    
+    Dopo un fork va chiamata con close=False: le connessioni ereditate
+    appartengono al processo padre e chiuderle qui le romperebbe anche là.
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None and close:
+            try:
+                _db_pool.closeall()
+            except Exception as e:
+                print(f"Errore chiusura pool: {e}")
+        _db_pool = None
+
+@contextmanager
+def db_connection():
+    """Presta una connessione dal pool e la restituisce all'uscita dal blocco."""
+    db_pool = get_pool()
+    conn = db_pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        db_pool.putconn(conn, discard=broken)
+
+def init_worker():
+    """Prepara il processo corrente a servire richieste.
+    
+    Ricrea i client HTTP (non sono sicuri dopo un fork), apre subito il pool,
+    così la prima richiesta non paga l'handshake con Neon, e avvia il
+    caricamento degli indici in memoria del catalogo.
+    """
+    global vo, claude
+    vo = voyageai.Client(api_key=os.environ.get("VOYAGE_API_KEY"))
+    claude = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    reset_pool(close=False)
+    try:
+        get_pool()
+    except Exception as e:
+        print(f"Pool DB non inizializzato: {e}")
+    start_catalog_refresh()
+
+def get_pool_stats() -> dict:
+    if _db_pool is None:
+        return {'attivo': False}
+    return {'attivo': True, **_db_pool.stats()}
+
+# ============ CACHE IN MEMORIA ============
+
+class LRUCache:
+    """Cache LRU thread-safe, limitata per numero di voci e/o byte, con TTL opzionale."""
+    
+    def __init__(self, max_entries: int = None, max_bytes: int = None,
+                 ttl: float = None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl or None
+        self._sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hit': 0, 'miss': 0, 'evict': 0}
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.stats['miss'] += 1
+                return default
+            value, size, expires = item
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.stats['miss'] += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats['hit'] += 1
+            return value
+    
+    def set(self, key, value):
+        size = self._sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, expires)
+            self._bytes += size
+            while self._data and (
+                (self.max_entries is not None and len(self._data) > self.max_entries) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.stats['evict'] += 1
+    
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+    
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {**self.stats, 'voci': len(self._data), 'byte': self._bytes}
+
+def normalize_query_text(text: str) -> str:
+    """Forma canonica di una query per le chiavi di cache (spazi, maiuscole, Unicode)."""
+    return " ".join(unicodedata.normalize('NFC', text or '').lower().split())
+
+# ============ CATALOG INDEXES (IN MEMORIA) ============
+# Strutture costruite dal catalogo all'avvio e ricaricate in background, così
+# i percorsi caldi non interrogano Postgres. Ogni loader riceve un cursore e
+# l'indice precedente (per aggiornamenti incrementali) e restituisce quello nuovo.
+
+CATALOG_REFRESH_INTERVAL = float(os.environ.get("CATALOG_REFRESH_INTERVAL", "600"))
+
+CATALOG_INDEX_LOADERS = {}
+_catalog_indexes = {}
+_catalog_status = {'caricato_il': None, 'durata_ms': None, 'errori': 0}
+_catalog_refresh_lock = threading.Lock()
+_catalog_start_lock = threading.Lock()
+_catalog_refresh_pid = None
+
+def catalog_index(name: str):
+    """Indice in memoria già caricato, oppure None se non è ancora pronto."""
+    return _catalog_indexes.get(name)
+
+def refresh_catalog_indexes():
+    """Ricarica tutti gli indici registrati e li sostituisce in blocco."""
+    started = time.monotonic()
+    with _catalog_refresh_lock:
+        fresh = {}
+        with db_connection() as conn, conn.cursor() as cur:
+            for name, loader in CATALOG_INDEX_LOADERS.items():
+                fresh[name] = loader(cur, _catalog_indexes.get(name))
+        _catalog_indexes.update(fresh)
+        _catalog_status['caricato_il'] = time.time()
+        _catalog_status['durata_ms'] = round((time.monotonic() - started) * 1000, 1)
+
+def _catalog_refresh_loop():
+    while True:
+        try:
+            refresh_catalog_indexes()
+        except Exception as e:
+            _catalog_status['errori'] += 1
+            print(f"Errore aggiornamento indici catalogo: {e}")
+        time.sleep(CATALOG_REFRESH_INTERVAL)
+
+def start_catalog_refresh():
+    """Avvia (una volta per processo) il thread che carica e aggiorna gli indici."""
+    global _catalog_refresh_pid
+    if _catalog_refresh_pid == os.getpid():
+        return
+    with _catalog_start_lock:
+        if _catalog_refresh_pid == os.getpid():
+            return
+        _catalog_refresh_pid = os.getpid()
+    threading.Thread(target=_catalog_refresh_loop, name="catalog-refresh", daemon=True).start()
+
+def read_catalog_version(cur) -> int:
+    """Versione del catalogo (migrations/003) letta con il cursore del loader, 0 se manca."""
+    try:
+        cur.execute("SELECT version FROM public.catalog_version WHERE id = 1")
+        row = cur.fetchone()
+    except psycopg2.Error:
+        return 0
+    return row[0] if row else 0
+
+def get_catalog_stats() -> dict:
+    stats = dict(_catalog_status)
+    for name, index in _catalog_indexes.items():
+        stats[name] = len(index)
+    return stats
+
+# ============ BOOK FIELDS ============
+# Le liste di risultati portano solo i campi della proiezione compatta: la
+# descrizione e gli altri dettagli si chiedono a /api/book quando servono.
+# Ogni richiesta può scegliere i suoi campi con "fields".
+
+BOOK_COLUMNS = {
+    'id': 'b.id',
+    'titolo': 'b.titolo',
+    'editore': 'b.editore',
+    'anno': 'b.anno',
+    'descrizione': 'b.descrizione',
+    'prezzo': 'b.prezzo_def_euro_web',
+    'pagine': 'b.pagine',
+    'lingua': 'b.lingua',
+    'immagine': 'b.permalinkimmagine',
+    'isbn': 'b.isbn_expo',
+}
+LIST_FIELDS = ('id', 'titolo', 'editore', 'anno', 'lingua', 'immagine', 'prezzo')
+# Campi citati nelle risposte del bibliotecario, sempre letti dalla ricerca AI
+REPLY_FIELDS = ('id', 'titolo', 'editore', 'anno', 'lingua')
+DETAIL_FIELDS = tuple(BOOK_COLUMNS)
+BOOK_DETAIL_MAX_IDS = int(os.environ.get("BOOK_DETAIL_MAX_IDS", "100"))
+
+def book_fields(requested=None, default: tuple = LIST_FIELDS) -> tuple:
+    """Campi richiesti (lista o "a,b,c") tra quelli di BOOK_COLUMNS, sempre con l'id."""
+    if not requested:
+        return default
+    if isinstance(requested, str):
+        requested = requested.split(",")
+    wanted = {str(field).strip() for field in requested} | {'id'}
+    return tuple(field for field in BOOK_COLUMNS if field in wanted)
+
+def book_select(fields: tuple = None) -> str:
+    """Colonne SELECT (alias b) dei campi, nello stesso ordine."""
+    return ", ".join(BOOK_COLUMNS[field] for field in (fields or LIST_FIELDS))
+
+# ============ BOOK ROW CACHE ============
+# Le ricerche per nome, autore e copertina lavorano in due fasi: la prima
+# seleziona e ordina solo gli id, la seconda legge i campi di quei libri con
+# una sola query (WHERE id = ANY), passando da questa cache per id. La chiave
+# include la versione del catalogo (migrations/003): dopo un import le righe
+# vecchie non vengono più lette ed escono per LRU.
+
+BOOK_CACHE_SIZE = int(os.environ.get("BOOK_CACHE_SIZE", "20000"))
+BOOK_CACHE_MAX_BYTES = int(os.environ.get("BOOK_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+BOOK_CACHE_TTL = float(os.environ.get("BOOK_CACHE_TTL", "3600"))
+
+def book_row_size(row: dict) -> int:
+    return sum(len(str(value)) for value in row.values()) + 64 * len(row)
+
+book_cache = LRUCache(
+    max_entries=BOOK_CACHE_SIZE, max_bytes=BOOK_CACHE_MAX_BYTES,
+    ttl=BOOK_CACHE_TTL, sizeof=book_row_size
+) if BOOK_CACHE_SIZE > 0 else None
+
+def hydrate_books(ids: list, fields: tuple = None) -> dict:
+    """Seconda fase: {id: libro con i campi richiesti} per gli id esistenti.
+    
+    Una riga in cache serve solo se ha già tutti i campi chiesti; le altre si
+    leggono insieme, sempre con almeno LIST_FIELDS, e vengono unite a quanto
+    già in cache.
+    """
+    fields = fields or LIST_FIELDS
+    books = {}
+    partial = {}
+    missing = []
+    version = get_catalog_version() if book_cache is not None else None
+    
+    for book_id in dict.fromkeys(ids):
+        cached = book_cache.get((version, book_id)) if book_cache is not None else None
+        if cached is not None and all(field in cached for field in fields):
+            books[book_id] = {field: cached[field] for field in fields}
+        else:
+            missing.append(book_id)
+            if cached is not None:
+                partial[book_id] = cached
+    
+    if missing:
+        load = book_fields(set(fields) | set(LIST_FIELDS))
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT {book_select(load)} FROM public.books b WHERE b.id = ANY(%s)", (missing,))
+            rows = cur.fetchall()
+        
+        for row in rows:
+            row = dict(zip(load, row))
+            if book_cache is not None:
+                row = {**partial.get(row['id'], {}), **row}
+                book_cache.set((version, row['id']), row)
+            books[row['id']] = {field: row[field] for field in fields}
+    
+    return books
+
+def fetch_books(ids: list, fields: tuple = None) -> list:
+    """Libri per id nell'ordine richiesto; gli id inesistenti sono omessi."""
+    books = hydrate_books(ids, fields or DETAIL_FIELDS)
+    return [books[book_id] for book_id in ids if book_id in books]
+
+# ============ LEXICAL QUERY BUILDERS ============
+# I filtri LOWER(col) LIKE '%x%' sono serviti dagli indici GIN pg_trgm su
+# lower(col) (migrations/002): i predicati devono restare nella stessa forma
+# dell'espressione indicizzata, altrimenti il planner torna al seq scan.
+
+def like_escape(term: str) -> str:
+    """Neutralizza i caratteri speciali di LIKE presenti nel testo utente."""
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def contains_pattern(term: str) -> str:
+    return f"%{like_escape(term.lower().strip())}%"
+
+def prefix_pattern(term: str) -> str:
+    return f"{like_escape(term.lower().strip())}%"
+
+def build_title_search_query(title: str, limit: int, with_tipo: bool = False, fields: tuple = None) -> tuple:
+    """Query per titolo: match esatto, poi prefisso, poi contenuto."""
+    tipo_columns = ",\n               1 as ranking, 'titolo' as tipo" if with_tipo else ""
+    sql = f"""
+        SELECT {book_select(fields)}{tipo_columns}
+        FROM public.books b
+        WHERE LOWER(b.titolo) LIKE %s
+        ORDER BY 
+            CASE WHEN LOWER(b.titolo) = %s THEN 0
+                 WHEN LOWER(b.titolo) LIKE %s THEN 1
+                 ELSE 2 END,
+            b.anno DESC
+        LIMIT %s
+    """
+    return sql, (contains_pattern(title), title.lower().strip(), prefix_pattern(title), limit)
+
+def build_suggest_query(suggestion_type: str, query: str, limit: int) -> tuple:
+    """Query di autocompletamento: prima i nomi che iniziano con il testo, poi i più frequenti.
+    
+    Il filtro è solo sul pattern contenuto: il prefisso è un suo sottoinsieme e
+    serve soltanto per l'ordinamento.
+    """
+    table, column = ('book_artists', 'artist') if suggestion_type == 'artist' else ('book_authors', 'author')
+    sql = f"""
+        SELECT {column}, COUNT(*) as cnt
+        FROM public.{table}
+        WHERE LOWER({column}) LIKE %s
+        GROUP BY {column}
+        ORDER BY 
+            CASE WHEN LOWER({column}) LIKE %s THEN 0 ELSE 1 END,
+            cnt DESC
+        LIMIT %s
+    """
+    return sql, (contains_pattern(query), prefix_pattern(query), limit)
+
+# ============ COVER FINGERPRINTS ============
+# Quattro hash percettivi calcolati dalla stessa immagine ridotta. Nel database
+# l'average hash resta in image_hash (testo esadecimale), gli altri sono colonne
+# bigint (migrations/004); in memoria sono interi senza segno a 64 bit e il
+# confronto con i candidati è uno XOR + popcount vettoriale numpy.
+
+FINGERPRINT_EDGE = 128
+FINGERPRINT_HASHES = ('average', 'difference', 'perceptual', 'color')
+FINGERPRINT_COLUMNS = {'difference': 'hash_difference', 'perceptual': 'hash_perceptual', 'color': 'hash_color'}
+# colorhash con binbits=3: 14 bin da 3 bit
+FINGERPRINT_BITS = {'average': 64, 'difference': 64, 'perceptual': 64, 'color': 42}
+FINGERPRINT_WEIGHTS = {'average': 1.0, 'difference': 1.0, 'perceptual': 1.5, 'color': 0.5}
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def image_bytes(image) -> bytes:
+    """Byte dell'immagine da una stringa base64 (anche data URL) o da un upload binario.
+    
+    Gli upload restano come arrivano (bytes o memoryview sul body multipart).
+    """
+    if isinstance(image, str):
+        if ',' in image:
+            image = image.split(',')[1]
+        return base64.b64decode(image)
+    return image
+
+class BufferReader(RawIOBase):
+    """File in sola lettura sopra un buffer: Pillow legge dalla memoryview senza copiarla tutta."""
+    
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, target):
+        chunk = self._view[self._position:self._position + len(target)]
+        target[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+    
+    def seek(self, offset, whence=0):
+        base = {0: 0, 1: self._position, 2: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+    
+    def tell(self):
+        return self._position
+
+def open_image(raw):
+    """Immagine PIL dai byte: BytesIO condivide i bytes, le memoryview si leggono in place."""
+    return Image.open(BytesIO(raw) if isinstance(raw, bytes) else BufferReader(raw))
+
+def decode_image(image):
+    """Immagine PIL da una stringa base64 (anche in forma data URL) o dai byte caricati."""
+    return open_image(image_bytes(image))
+
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1568"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+# Foto già piccole e in un formato accettato da Claude passano senza ricodifica
+IMAGE_PASSTHROUGH_BYTES = 400 * 1024
+IMAGE_MEDIA_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+
+def sniff_image_format(head: bytes):
+    """Formato dai primi byte del file, solo tra quelli accettati; altrimenti None."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+def prepare_cover_image(image) -> dict:
+    """Decodifica una sola volta la foto caricata e la prepara per Claude.
+    
+    `image` è la stringa base64 del body JSON oppure i byte di un upload binario
+    (bytes o memoryview sul body multipart, letta senza copiarla).
+    Riconosce il formato reale, decodifica i JPEG già ridotti (draft mode),
+    raddrizza secondo l'EXIF, riduce il lato lungo a IMAGE_MAX_EDGE e ricodifica
+    in JPEG. L'immagine ridotta resta in 'immagine' per il calcolo degli hash.
+    """
+    raw = None
     try:
-        if ',' in image_base64:
-            image_base64 = image_base64.split(',')[1]
+        raw = image_bytes(image)
+        img = open_image(raw)
+        image_format = img.format
+        original_size = img.size
+        if image_format == 'JPEG' and max(original_size) > IMAGE_MAX_EDGE:
+            # Il decoder riduce di 1/2, 1/4 o 1/8 finché entrambi i lati restano sopra il box
+            ratio = IMAGE_MAX_EDGE / max(original_size)
+            img.draft('RGB', (int(original_size[0] * ratio), int(original_size[1] * ratio)))
+        img = ImageOps.exif_transpose(img)
+        
+        media_type = IMAGE_MEDIA_TYPES.get(image_format)
+        untouched = (media_type is not None and len(raw) <= IMAGE_PASSTHROUGH_BYTES
+                     and max(original_size) <= IMAGE_MAX_EDGE and img.size == original_size)
         
-        image_data = base64.b64decode(image_base64)
-        img = Image.open(BytesIO(image_data))
-        hash_value = str(imagehash.average_hash(img))
-        img.close()
-        return hash_value
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+        
+        if untouched:
+            data = image.split(',')[-1] if isinstance(image, str) else base64.b64encode(raw).decode()
+        else:
+            encoded = BytesIO()
+            img.save(encoded, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+            data = base64.b64encode(encoded.getvalue()).decode()
+            media_type = 'image/jpeg'
+        
+        return {
+            'immagine': img,
+            'media_type': media_type,
+            'data': data,
+            'formato': image_format,
+            'byte_originali': len(raw),
+            'byte_inviati': len(data) * 3 // 4
+        }
     except Exception as e:
-        print(f"Errore calcolo hash: {e}")
+        # Immagine non leggibile: la si inoltra così com'è e si rinuncia agli hash
+        print(f"Errore preparazione immagine: {e}")
+        data = image.split(',')[-1] if isinstance(image, str) else base64.b64encode(raw or b'').decode()
+        return {
+            'immagine': None,
+            'media_type': 'image/jpeg',
+            'data': data,
+            'formato': None,
+            'byte_originali': len(data) * 3 // 4,
+            'byte_inviati': len(data) * 3 // 4
+        }
+
+def compute_fingerprint(img) -> dict:
+    """Hash average, difference, perceptual (DCT) e colore come interi senza segno."""
+    small = img.convert('RGB')
+    small.thumbnail((FINGERPRINT_EDGE, FINGERPRINT_EDGE))
+    gray = small.convert('L')
+    hashes = {
+        'average': imagehash.average_hash(gray),
+        'difference': imagehash.dhash(gray),
+        'perceptual': imagehash.phash(gray),
+        'color': imagehash.colorhash(small, binbits=3),
+    }
+    return {name: int(str(value), 16) for name, value in hashes.items()}
+
+def fingerprint_hex(fingerprint: dict) -> str:
+    """Average hash nel formato esadecimale di books.image_hash."""
+    return f"{fingerprint['average']:016x}" if fingerprint else None
+
+def to_signed64(value):
+    """Intero senza segno a 64 bit nella forma accettata da una colonna bigint."""
+    if value is None:
+        return None
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def row_fingerprint(image_hash: str, difference=None, perceptual=None, color=None) -> dict:
+    """Impronta di un libro dalle colonne del database (hash mancanti = None)."""
+    return {
+        'average': hash_to_int(image_hash),
+        'difference': difference & 0xFFFFFFFFFFFFFFFF if difference is not None else None,
+        'perceptual': perceptual & 0xFFFFFFFFFFFFFFFF if perceptual is not None else None,
+        'color': color & 0xFFFFFFFFFFFFFFFF if color is not None else None,
+    }
+
+def _popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+def fingerprint_distances(query: dict, candidates: list):
+    """Distanza combinata tra la foto e ogni candidato, su scala 0-64 come l'average hash.
+    
+    Media pesata delle distanze normalizzate dei soli hash presenti su entrambi i
+    lati: un libro con il solo image_hash riceve la sua distanza average, come prima.
+    Restituisce un array numpy (999 dove non c'è nessun hash confrontabile).
+    """
+    count = len(candidates)
+    total = np.zeros(count)
+    weights = np.zeros(count)
+    if not query or not count:
+        return np.full(count, 999.0)
+    
+    for name in FINGERPRINT_HASHES:
+        if query.get(name) is None:
+            continue
+        column = [c.get(name) for c in candidates]
+        known = np.array([value is not None for value in column])
+        if not known.any():
+            continue
+        packed = np.array([value if value is not None else 0 for value in column], dtype=np.uint64)
+        bits = _popcount(packed ^ np.uint64(query[name])).astype(np.float64)
+        weight = FINGERPRINT_WEIGHTS[name] * known
+        total += weight * bits / FINGERPRINT_BITS[name]
+        weights += weight
+    
+    return np.where(weights > 0, total / np.maximum(weights, 1e-9) * 64, 999.0)
+
+IMAGE_MATCH_DISTANCE = 25
+IMAGE_KNN_RESULTS = int(os.environ.get("IMAGE_KNN_RESULTS", "20"))
+# Campi dei libri nei candidati della ricerca per copertina
+IMAGE_RESULT_FIELDS = ('id', 'titolo', 'editore', 'anno', 'immagine')
+
+def hash_to_int(hash_hex: str):
+    """Hash esadecimale a 64 bit (average_hash 8x8) come intero, oppure None."""
+    if not hash_hex or len(hash_hex) != 16:
+        return None
+    try:
+        return int(hash_hex, 16)
+    except ValueError:
         return None
 
-def compare_hashes(hash1: str, hash2: str) -> int:
-    """Confronta due hash e restituisce la distanza di Hamming."""
-    if not hash1 or not hash2:
-        return 999
+class HammingIndex:
+    """Hash a 64 bit delle copertine in un array uint64 contiguo.
+    
+    La ricerca è una scansione vettoriale (XOR + popcount numpy) di tutto
+    l'array: a questa scala del catalogo costa pochi millisecondi, meno di
+    qualunque indice a bande visitato con lookup Python. Gli aggiornamenti
+    singoli usano la mappa id → posizione; la rimozione sposta l'ultimo
+    elemento nel buco lasciato.
+    """
+    
+    def __init__(self):
+        self._values = np.zeros(0, dtype=np.uint64)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._slots = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._slots)
+    
+    def _grow(self):
+        capacity = max(1024, len(self._values) * 2)
+        self._values = np.resize(self._values, capacity)
+        self._ids = np.resize(self._ids, capacity)
+    
+    def _delete(self, book_id):
+        slot = self._slots.pop(book_id, None)
+        if slot is None:
+            return
+        last = len(self._slots)
+        if slot != last:
+            self._values[slot] = self._values[last]
+            self._ids[slot] = self._ids[last]
+            self._slots[int(self._ids[slot])] = slot
+    
+    def upsert(self, book_id, hash_hex: str):
+        """Inserisce o aggiorna l'hash di un libro (hash non valido = rimozione)."""
+        value = hash_to_int(hash_hex)
+        with self._lock:
+            if value is None:
+                self._delete(book_id)
+                return
+            slot = self._slots.get(book_id)
+            if slot is None:
+                slot = len(self._slots)
+                if slot >= len(self._values):
+                    self._grow()
+                self._slots[book_id] = slot
+                self._ids[slot] = book_id
+            self._values[slot] = value
+    
+    def remove(self, book_id):
+        self.upsert(book_id, None)
+    
+    def sync(self, rows):
+        """Allinea l'indice alle righe (id, image_hash) del catalogo, ricostruendo gli array."""
+        entries = {}
+        for book_id, hash_hex in rows:
+            value = hash_to_int(hash_hex)
+            if value is not None:
+                entries[book_id] = value
+        ids = np.fromiter(entries.keys(), dtype=np.int64, count=len(entries))
+        values = np.fromiter(entries.values(), dtype=np.uint64, count=len(entries))
+        slots = {book_id: slot for slot, book_id in enumerate(entries)}
+        with self._lock:
+            self._ids, self._values, self._slots = ids, values, slots
+    
+    def nearest(self, hash_hex: str, k: int = 10, max_distance: int = IMAGE_MATCH_DISTANCE) -> list:
+        """I k libri più vicini entro max_distance, come lista di (distanza, book_id)."""
+        value = hash_to_int(hash_hex)
+        if value is None or k <= 0:
+            return []
+        
+        with self._lock:
+            size = len(self._slots)
+            distances = _popcount(self._values[:size] ^ np.uint64(value))
+            ids = self._ids[:size].copy()
+        
+        within = np.flatnonzero(distances <= max_distance)
+        if len(within) > k:
+            # Soglia del k-esimo, poi ordine per (distanza, id) come heapq sulle tuple
+            kth = np.partition(distances[within], k - 1)[k - 1]
+            within = within[distances[within] <= kth]
+        order = within[np.lexsort((ids[within], distances[within]))][:k]
+        return [(int(distances[i]), int(ids[i])) for i in order]
+
+def _load_image_hash_index(cur, previous):
+    cur.execute("SELECT id, image_hash FROM public.books WHERE image_hash IS NOT NULL")
+    index = previous if previous is not None else HammingIndex()
+    index.sync(cur.fetchall())
+    return index
+
+CATALOG_INDEX_LOADERS['copertine'] = _load_image_hash_index
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def match_cover(image) -> dict:
+    """Parte CPU della ricerca per immagine: hash della foto e copertine più vicine.
+    
+    `image` è l'immagine PIL già decodificata (prepare_cover_image) oppure la stringa base64.
+    """
+    timings = {}
+    started = time.perf_counter()
     try:
-        h1 = imagehash.hex_to_hash(hash1)
-        h2 = imagehash.hex_to_hash(hash2)
-        return h1 - h2
-    except:
-        return 999
+        img = decode_image(image) if isinstance(image, str) else image
+        fingerprint = compute_fingerprint(img) if img is not None else None
+    except Exception as e:
+        print(f"Errore calcolo hash: {e}")
+        fingerprint = None
+    user_hash = fingerprint_hex(fingerprint)
+    timings['hash'] = elapsed_ms(started)
+    
+    started = time.perf_counter()
+    nearest = []
+    start_catalog_refresh()
+    cover_index = catalog_index('copertine')
+    if user_hash and cover_index is not None:
+        nearest = cover_index.nearest(user_hash, IMAGE_KNN_RESULTS)
+    timings['indice'] = elapsed_ms(started)
+    
+    return {'user_hash': user_hash, 'impronta': fingerprint, 'vicini': nearest, 'tempi_ms': timings}
 
-def search_by_image_hybrid(query_info: dict, image_base64: str, limit: int = 50) -> dict:
-    """Ricerca ibrida: combina ricerca testuale + confronto hash immagine."""
+def search_by_image_hybrid(query_info: dict, image_base64: str, limit: int = 50, cover: dict = None) -> dict:
+    """Ricerca ibrida: combina ricerca testuale + confronto hash immagine.
     
-    user_hash = compute_image_hash(image_base64)
+    `cover` è il risultato di match_cover se già calcolato in parallelo.
+    """
     
-    conn = get_db()
-    cur = conn.cursor()
+    cover = cover or match_cover(image_base64)
+    user_hash = cover['user_hash']
+    started = time.perf_counter()
     
     candidates = []
     search_term = query_info.get('titolo') or query_info.get('nome') or ''
     
-    if search_term:
-        search_pattern = f"%{search_term.lower()}%"
-        
-        cur.execute("""
-            SELECT id, titolo, editore, anno, image_hash, permalinkimmagine
-            FROM public.books 
-            WHERE (LOWER(titolo) LIKE %s OR LOWER(descrizione) LIKE %s)
-            AND image_hash IS NOT NULL
-            LIMIT %s
-        """, (search_pattern, search_pattern, limit))
-        candidates.extend(cur.fetchall())
-        
-        if query_info.get('nome'):
-            name_lower = query_info['nome'].lower()
-            parts = name_lower.split()
-            if len(parts) >= 2:
-                reversed_name = " ".join(reversed(parts))
-                pattern_original = f"%{name_lower}%"
-                pattern_reversed = f"%{reversed_name}%"
-            else:
-                pattern_original = f"%{name_lower}%"
-                pattern_reversed = pattern_original
+    # Prima fase: id e impronte dei candidati, senza i campi dei libri
+    with db_connection() as conn, conn.cursor() as cur:
+        if search_term:
+            search_pattern = contains_pattern(search_term)
             
             cur.execute("""
-                SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.image_hash, b.permalinkimmagine
-                FROM public.books b
-                JOIN public.book_artists ba ON b.id = ba.book_id
-                WHERE (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
-                AND b.image_hash IS NOT NULL
+                SELECT id, image_hash, hash_difference, hash_perceptual, hash_color
+                FROM public.books 
+                WHERE (LOWER(titolo) LIKE %s OR LOWER(descrizione) LIKE %s)
+                AND image_hash IS NOT NULL
                 LIMIT %s
-            """, (pattern_original, pattern_reversed, limit))
+            """, (search_pattern, search_pattern, limit))
             candidates.extend(cur.fetchall())
-    
-    cur.close()
-    conn.close()
+            
+            if query_info.get('nome'):
+                pattern_original, pattern_reversed = name_patterns(query_info['nome'])
+                
+                cur.execute("""
+                    SELECT b.id, b.image_hash, b.hash_difference, b.hash_perceptual, b.hash_color
+                    FROM public.books b
+                    WHERE EXISTS (
+                        SELECT 1 FROM public.book_artists ba
+                        WHERE ba.book_id = b.id
+                          AND (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
+                    )
+                    AND b.image_hash IS NOT NULL
+                    LIMIT %s
+                """, (pattern_original, pattern_reversed, limit))
+                candidates.extend(cur.fetchall())
     
     seen_ids = set()
     unique_candidates = []
@@ -99,39 +912,53 @@ def search_by_image_hybrid(query_info: dict, image_base64: str, limit: int = 50)
         if c[0] not in seen_ids:
             seen_ids.add(c[0])
             unique_candidates.append(c)
+    text_ids = set(seen_ids)
     
-    results = []
-    best_match = None
+    # Copertine più simili in tutto il catalogo, anche se il testo letto è sbagliato
+    nearest_ids = [book_id for _, book_id in cover['vicini'] if book_id not in seen_ids]
+    if nearest_ids:
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, image_hash, hash_difference, hash_perceptual, hash_color
+                FROM public.books
+                WHERE id = ANY(%s)
+            """, (nearest_ids,))
+            for row in cur.fetchall():
+                seen_ids.add(row[0])
+                unique_candidates.append(row)
     
-    for candidate in unique_candidates:
-        book_id, titolo, editore, anno, db_hash, immagine = candidate
-        
-        distance = compare_hashes(user_hash, db_hash) if user_hash else 999
-        
-        result = {
-            'id': book_id,
-            'titolo': titolo,
-            'editore': editore,
-            'anno': anno,
-            'immagine': immagine,
+    # Tutti i candidati confrontati in un colpo solo, hash per hash
+    distances = fingerprint_distances(cover.get('impronta'), [row_fingerprint(*c[1:5]) for c in unique_candidates])
+    
+    ranked = sorted(
+        ((candidate[0], round(float(combined), 1)) for candidate, combined in zip(unique_candidates, distances)),
+        key=lambda item: (item[1] > IMAGE_MATCH_DISTANCE, item[1])
+    )[:limit]
+    
+    # Seconda fase: i campi solo per i libri restituiti
+    books = hydrate_books([book_id for book_id, _ in ranked], IMAGE_RESULT_FIELDS)
+    
+    results = []
+    for book_id, distance in ranked:
+        if book_id not in books:
+            continue
+        results.append({
+            **books[book_id],
             'hash_distance': distance,
-            'text_match': True,
-            'image_match': distance <= 25,
-            'confidence': 'alta' if distance <= 15 else ('media' if distance <= 25 else 'bassa')
-        }
-        results.append(result)
-        
-        if distance <= 25 and (best_match is None or distance < best_match['hash_distance']):
-            best_match = result
+            'text_match': book_id in text_ids,
+            'image_match': distance <= IMAGE_MATCH_DISTANCE,
+            'confidence': 'alta' if distance <= 15 else ('media' if distance <= IMAGE_MATCH_DISTANCE else 'bassa')
+        })
     
-    results.sort(key=lambda x: (not x['image_match'], x['hash_distance']))
+    best_match = results[0] if results and results[0]['image_match'] else None
     
     return {
-        'candidati': results[:limit],
+        'candidati': results,
         'best_match': best_match,
         'user_hash': user_hash,
         'search_term': search_term,
-        'total_candidates': len(unique_candidates)
+        'total_candidates': len(unique_candidates),
+        'tempi_ms': {**cover['tempi_ms'], 'candidati': elapsed_ms(started)}
     }
 
 def generate_response_for_image_search(search_result: dict, query_info: dict) -> str:
@@ -176,193 +1003,464 @@ Prova a scattare una foto più nitida o scrivi il titolo/autore."""
 
 # ============ AUTOCOMPLETE / SUGGEST (NEW) ============
 
+class SuggestIndex:
+    """Nomi distinti con il numero di libri, ordinati per forma minuscola.
+    
+    I nomi che iniziano con il testo digitato formano un intervallo contiguo
+    (bisect); quelli che lo contengono altrove servono solo a completare il
+    limite. Stesso ordinamento della query SQL: prima i prefissi, poi per conteggio.
+    """
+    
+    def __init__(self, rows, version: int = 0):
+        # Versione del catalogo letta prima dei nomi: identifica i suggerimenti serviti
+        self.version = version
+        entries = sorted((name.lower(), name, count) for name, count in rows if name)
+        self._keys = [e[0] for e in entries]
+        self._names = [e[1] for e in entries]
+        self._counts = [e[2] for e in entries]
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def _top(self, indexes, limit: int) -> list:
+        best = heapq.nsmallest(limit, indexes, key=lambda i: (-self._counts[i], self._keys[i]))
+        return [self._names[i] for i in best]
+    
+    def suggest(self, query: str, limit: int = 10) -> list:
+        query = query.lower()
+        lo = bisect.bisect_left(self._keys, query)
+        hi = bisect.bisect_left(self._keys, query + '\U0010ffff', lo)
+        results = self._top(range(lo, hi), limit)
+        
+        if len(results) < limit:
+            contains = [i for i, key in enumerate(self._keys)
+                        if query in key and not lo <= i < hi]
+            results += self._top(contains, limit - len(results))
+        
+        return results
+
+def _load_suggest_index(table: str, column: str):
+    def loader(cur, previous):
+        version = read_catalog_version(cur)
+        cur.execute(f"SELECT {column}, COUNT(*) FROM public.{table} GROUP BY {column}")
+        return SuggestIndex(cur.fetchall(), version)
+    return loader
+
+CATALOG_INDEX_LOADERS['artist'] = _load_suggest_index('book_artists', 'artist')
+CATALOG_INDEX_LOADERS['author'] = _load_suggest_index('book_authors', 'author')
+
+_suggest_stats = {'indice': 0, 'sql': 0}
+
 def get_suggestions(suggestion_type: str, query: str, limit: int = 10) -> list:
     """Restituisce suggerimenti per artisti o autori."""
     
     if len(query) < 2:
         return []
     
-    conn = get_db()
-    cur = conn.cursor()
-    
-    query_pattern = f"{query.lower()}%"
-    query_contains = f"%{query.lower()}%"
-    
-    if suggestion_type == 'artist':
-        cur.execute("""
-            SELECT DISTINCT artist, COUNT(*) as cnt
-            FROM public.book_artists
-            WHERE LOWER(artist) LIKE %s OR LOWER(artist) LIKE %s
-            GROUP BY artist
-            ORDER BY 
-                CASE WHEN LOWER(artist) LIKE %s THEN 0 ELSE 1 END,
-                cnt DESC
-            LIMIT %s
-        """, (query_pattern, query_contains, query_pattern, limit))
-    else:
-        cur.execute("""
-            SELECT DISTINCT author, COUNT(*) as cnt
-            FROM public.book_authors
-            WHERE LOWER(author) LIKE %s OR LOWER(author) LIKE %s
-            GROUP BY author
-            ORDER BY 
-                CASE WHEN LOWER(author) LIKE %s THEN 0 ELSE 1 END,
-                cnt DESC
-            LIMIT %s
-        """, (query_pattern, query_contains, query_pattern, limit))
+    start_catalog_refresh()
+    index = catalog_index('artist' if suggestion_type == 'artist' else 'author')
+    if index is not None:
+        _suggest_stats['indice'] += 1
+        return index.suggest(query, limit)
     
-    results = [row[0] for row in cur.fetchall()]
+    # Indice non ancora caricato (primo avvio): una sola query diretta
+    _suggest_stats['sql'] += 1
+    sql, params = build_suggest_query(suggestion_type, query, limit)
     
-    cur.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        results = [row[0] for row in cur.fetchall()]
     
     return results
 
-# ============ DIRECT SEARCH - NO AI (NEW) ============
+# ============ NAME SEARCH QUERY ============
 
-def search_direct_artist(name: str, limit: int = 100) -> dict:
-    """Ricerca diretta per artista - SQL only, no Claude."""
+NAME_CATEGORIES = {
+    1: ('monografie_titolo', 'monografia_titolo'),
+    2: ('monografie', 'monografia'),
+    3: ('collettive', 'collettiva'),
+    4: ('come_autore', 'autore'),
+    5: ('citazioni', 'menzione'),
+}
+
+def name_patterns(name: str) -> tuple:
+    """Pattern LIKE per il nome così com'è e con le parole invertite."""
+    parts = name.lower().split()
     
-    conn = get_db()
-    cur = conn.cursor()
+    if len(parts) >= 2:
+        return contains_pattern(" ".join(parts)), contains_pattern(" ".join(reversed(parts)))
+    pattern = contains_pattern(name)
+    return pattern, pattern
+
+def name_filter_conditions(filters: dict) -> tuple:
+    """Condizioni SQL (parametri con nome) per lingua e intervallo di anni."""
+    conditions = ""
+    params = {}
     
-    name_lower = name.lower().strip()
-    parts = name_lower.split()
+    if filters.get('lingua'):
+        conditions += " AND LOWER(b.lingua) LIKE %(lingua)s"
+        params['lingua'] = contains_pattern(filters['lingua'])
     
-    if len(parts) >= 2:
-        reversed_name = " ".join(reversed(parts))
-        pattern_original = f"%{name_lower}%"
-        pattern_reversed = f"%{reversed_name}%"
-    else:
-        pattern_original = f"%{name_lower}%"
-        pattern_reversed = pattern_original
+    if filters.get('anno_min'):
+        conditions += " AND b.anno >= %(anno_min)s"
+        params['anno_min'] = str(filters['anno_min'])
     
-    # 1. Monografie titolo
-    cur.execute("""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione, 
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               1 as ranking, 'monografia_titolo' as tipo
-        FROM public.books b
-        JOIN public.book_artists ba ON b.id = ba.book_id
-        WHERE (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
-          AND (LOWER(b.titolo) LIKE %s OR LOWER(b.titolo) LIKE %s)
-          AND (SELECT COUNT(*) FROM public.book_artists ba2 WHERE ba2.book_id = b.id) = 1
-        ORDER BY b.anno DESC
-    """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed))
-    monografie_titolo = cur.fetchall()
-    
-    # 2. Monografie
-    cur.execute("""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               2 as ranking, 'monografia' as tipo
-        FROM public.books b
-        JOIN public.book_artists ba ON b.id = ba.book_id
-        WHERE (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
-          AND LOWER(b.titolo) NOT LIKE %s AND LOWER(b.titolo) NOT LIKE %s
-          AND (SELECT COUNT(*) FROM public.book_artists ba2 WHERE ba2.book_id = b.id) = 1
-        ORDER BY b.anno DESC
-    """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed))
-    monografie = cur.fetchall()
-    
-    # 3. Collettive
-    cur.execute("""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               3 as ranking, 'collettiva' as tipo
-        FROM public.books b
-        JOIN public.book_artists ba ON b.id = ba.book_id
-        WHERE (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
-          AND (SELECT COUNT(*) FROM public.book_artists ba2 WHERE ba2.book_id = b.id) > 1
-        ORDER BY b.anno DESC
-    """, (pattern_original, pattern_reversed))
-    collettive = cur.fetchall()
-    
-    # 4. Menzioni
-    found_ids = [r[0] for r in monografie_titolo + monografie + collettive]
-    if found_ids:
-        cur.execute("""
-            SELECT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-                   b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-                   5 as ranking, 'menzione' as tipo
+    if filters.get('anno_max'):
+        conditions += " AND b.anno <= %(anno_max)s"
+        params['anno_max'] = str(filters['anno_max'])
+    
+    return conditions, params
+
+NAME_PAGE_SIZE = int(os.environ.get("NAME_PAGE_SIZE", "25"))
+
+def parse_page_sizes(spec: str) -> dict:
+    """Libri per pagina di ciascuna categoria: NAME_PAGE_SIZE, salvo le
+    eccezioni nel formato "categoria=n,categoria=n"."""
+    sizes = {key: NAME_PAGE_SIZE for key, _ in NAME_CATEGORIES.values()}
+    for item in spec.split(","):
+        key, _, size = item.partition("=")
+        if key.strip() in sizes and size.strip().isdigit():
+            sizes[key.strip()] = int(size)
+    return sizes
+
+NAME_PAGE_SIZES = parse_page_sizes(os.environ.get("NAME_PAGE_SIZES", "citazioni=20"))
+
+# Categorie mostrate per ciascun valore del filtro tipo_pub
+NAME_TIPO_CATEGORIES = {
+    'monografia': ('monografie_titolo', 'monografie'),
+    'collettiva': ('collettive',),
+    'autore': ('come_autore',),
+}
+
+# Chiave della firma dei cursori: la stessa per tutti i worker e le istanze
+# che condividono la configurazione (CURSOR_SECRET, altrimenti l'URL del DB)
+CURSOR_KEY = hashlib.sha256(b"cursori:" + (os.environ.get("CURSOR_SECRET")
+                                           or os.environ.get("NEON_DATABASE_URL") or "").encode()).digest()
+
+class CursorError(ValueError):
+    """Cursore di paginazione malformato o alterato: la richiesta riceve 400."""
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def _b64decode(token: str) -> bytes:
+    return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+
+def _cursor_signature(raw: bytes) -> bytes:
+    return hmac.new(CURSOR_KEY, raw, hashlib.sha256).digest()[:12]
+
+def encode_cursor(values: list) -> str:
+    """Token opaco di continuazione: la chiave di ordinamento dell'ultimo libro della pagina, firmata."""
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return _b64encode(raw) + '.' + _b64encode(_cursor_signature(raw))
+
+def decode_cursor(token: str, ranking: int) -> list:
+    """Chiave (anno, id) del token, preceduta dalla rilevanza per le menzioni."""
+    try:
+        payload, _, signature = str(token).partition('.')
+        raw = _b64decode(payload)
+        signed = hmac.compare_digest(_b64decode(signature), _cursor_signature(raw))
+        values = json.loads(raw) if signed else None
+    except (ValueError, TypeError):
+        values = None
+    size = 3 if ranking == 5 else 2
+    if (not isinstance(values, list) or len(values) != size
+            or not isinstance(values[-2], str) or not isinstance(values[-1], int)
+            or (size == 3 and not isinstance(values[0], (int, float)))):
+        raise CursorError("Cursore di paginazione non valido")
+    return values
+
+def normalize_language(lang: str) -> str:
+    """Codice lingua a due lettere (stesse regole del frontend)."""
+    lang = (lang or '').strip().upper()
+    if lang in ['I', 'IT', 'ITA', 'ITALIANO']:
+        return 'IT'
+    if lang in ['E', 'EN', 'ENG', 'ENGLISH']:
+        return 'EN'
+    if lang in ['D', 'DE', 'DEU', 'DEUTSCH']:
+        return 'DE'
+    if lang in ['F', 'FR', 'FRA', 'FRANCAIS']:
+        return 'FR'
+    return lang
+
+def name_match_ctes(name: str, filters: dict, include_authors: bool) -> tuple:
+    """CTE comuni a pagine e conteggi della ricerca per nome.
+    
+    `matched` classifica i libri dell'artista (1 monografia con il nome nel
+    titolo, 2 monografia, 3 collettiva, 4 come autore), `mentions` trova il nome
+    come frase su search_vector (migrations/006) escludendo i libri già in
+    `matched`. Entrambe portano la chiave di ordinamento anno_key (anno, '' se assente).
+    """
+    pattern_original, pattern_reversed = name_patterns(name)
+    extra_conditions, params = name_filter_conditions(filters or {})
+    words = name.split()
+    params.update({'pattern': pattern_original, 'pattern_rev': pattern_reversed,
+                   'phrase': " ".join(words), 'phrase_rev': " ".join(reversed(words))})
+    
+    author_branch = f"""
+            UNION ALL
+            SELECT DISTINCT b.id, 4 AS ranking, COALESCE(b.anno, '') AS anno_key
             FROM public.books b
-            WHERE (LOWER(b.descrizione) LIKE %s OR LOWER(b.descrizione) LIKE %s
-                   OR LOWER(b.titolo) LIKE %s OR LOWER(b.titolo) LIKE %s)
-              AND b.id NOT IN %s
-            ORDER BY b.anno DESC
-            LIMIT 50
-        """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed, tuple(found_ids)))
-    else:
-        cur.execute("""
-            SELECT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-                   b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-                   5 as ranking, 'menzione' as tipo
+            JOIN public.book_authors bau ON b.id = bau.book_id
+            WHERE (LOWER(bau.author) LIKE %(pattern)s OR LOWER(bau.author) LIKE %(pattern_rev)s)
+              {extra_conditions}""" if include_authors else ""
+    
+    ctes = f"""
+        WITH artist_books AS (
+            SELECT b.id, b.titolo, b.artist_count AS n_artisti, COALESCE(b.anno, '') AS anno_key
             FROM public.books b
-            WHERE (LOWER(b.descrizione) LIKE %s OR LOWER(b.descrizione) LIKE %s
-                   OR LOWER(b.titolo) LIKE %s OR LOWER(b.titolo) LIKE %s)
-            ORDER BY b.anno DESC
-            LIMIT 50
-        """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed))
-    menzioni = cur.fetchall()
+            WHERE EXISTS (
+                SELECT 1 FROM public.book_artists ba
+                WHERE ba.book_id = b.id
+                  AND (LOWER(ba.artist) LIKE %(pattern)s OR LOWER(ba.artist) LIKE %(pattern_rev)s)
+            )
+              {extra_conditions}
+        ),
+        matched AS (
+            SELECT id, ranking, anno_key FROM (
+                SELECT id, anno_key,
+                       CASE
+                           WHEN n_artisti = 1 AND (LOWER(titolo) LIKE %(pattern)s OR LOWER(titolo) LIKE %(pattern_rev)s) THEN 1
+                           WHEN n_artisti = 1 AND LOWER(titolo) NOT LIKE %(pattern)s AND LOWER(titolo) NOT LIKE %(pattern_rev)s THEN 2
+                           WHEN n_artisti > 1 THEN 3
+                       END AS ranking
+                FROM artist_books
+            ) classified
+            WHERE ranking IS NOT NULL{author_branch}
+        ),
+        mention_query AS NOT MATERIALIZED (
+            SELECT phraseto_tsquery('simple', public.search_unaccent(%(phrase)s))
+                   || phraseto_tsquery('simple', public.search_unaccent(%(phrase_rev)s)) AS tsq
+        ),
+        mentions AS (
+            SELECT b.id, 5 AS ranking, ts_rank(b.search_vector, mq.tsq) AS relevance,
+                   COALESCE(b.anno, '') AS anno_key
+            FROM public.books b, mention_query mq
+            WHERE b.search_vector @@ mq.tsq
+              AND NOT EXISTS (SELECT 1 FROM matched m WHERE m.id = b.id)
+              {extra_conditions}
+        )"""
+    return ctes, params
+
+def build_name_search_query(name: str, filters: dict = None, include_authors: bool = True,
+                            pages: dict = None) -> tuple:
+    """Costruisce l'unica query che restituisce una pagina di id per ciascuna categoria.
+    
+    Solo id, categoria e chiavi di ordinamento: i campi dei libri si leggono
+    dopo con hydrate_books. `pages` è {ranking: (chiave dopo cui ripartire o None, libri per pagina)};
+    senza, la prima pagina di tutte le categorie. Paginazione keyset su
+    (anno, id) decrescenti, per le menzioni preceduti da ts_rank: ogni pagina
+    legge al più un libro in più del necessario, per sapere se ce ne sono altri.
+    """
+    ctes, params = name_match_ctes(name, filters, include_authors)
+    if pages is None:
+        pages = {ranking: (None, NAME_PAGE_SIZES[key]) for ranking, (key, _) in NAME_CATEGORIES.items()
+                 if include_authors or ranking != 4}
+    
+    branches = []
+    for ranking, (after, size) in sorted(pages.items()):
+        params[f'limit_{ranking}'] = size + 1
+        if ranking == 5:
+            keyset = ""
+            if after:
+                keyset = " AND (relevance, anno_key, id) < (%(after_rel_5)s::real, %(after_anno_5)s, %(after_id_5)s)"
+                params.update({'after_rel_5': after[0], 'after_anno_5': after[1], 'after_id_5': after[2]})
+            branches.append(f"""
+                (SELECT id, ranking, relevance, anno_key FROM mentions
+                 WHERE TRUE{keyset}
+                 ORDER BY relevance DESC, anno_key DESC, id DESC
+                 LIMIT %(limit_5)s)""")
+        else:
+            keyset = ""
+            if after:
+                keyset = f" AND (anno_key, id) < (%(after_anno_{ranking})s, %(after_id_{ranking})s)"
+                params.update({f'after_anno_{ranking}': after[0], f'after_id_{ranking}': after[1]})
+            branches.append(f"""
+                (SELECT id, ranking, 0::real AS relevance, anno_key FROM matched
+                 WHERE ranking = {ranking}{keyset}
+                 ORDER BY anno_key DESC, id DESC
+                 LIMIT %(limit_{ranking})s)""")
+    
+    sql = f"""{ctes}
+        SELECT p.id, p.ranking,
+               CASE p.ranking
+                   WHEN 1 THEN 'monografia_titolo'
+                   WHEN 2 THEN 'monografia'
+                   WHEN 3 THEN 'collettiva'
+                   WHEN 4 THEN 'autore'
+                   ELSE 'menzione'
+               END AS tipo,
+               p.relevance, p.anno_key
+        FROM ({' UNION ALL'.join(branches)}
+        ) p
+        ORDER BY p.ranking, p.relevance DESC, p.anno_key DESC, p.id DESC
+    """
+    return sql, params
+
+def build_name_counts_query(name: str, filters: dict = None, include_authors: bool = True,
+                            rankings: list = None) -> tuple:
+    """Conteggi per categoria e lingua, con l'intervallo degli anni numerici:
+    i totali e i filtri disponibili senza leggere i libri."""
+    ctes, params = name_match_ctes(name, filters, include_authors)
+    params['rankings'] = list(rankings or NAME_CATEGORIES)
+    
+    sql = f"""{ctes}
+        SELECT r.ranking, UPPER(TRIM(COALESCE(b.lingua, ''))) AS lingua, COUNT(*),
+               MIN(CASE WHEN b.anno ~ '^[0-9]{{1,4}}$' THEN b.anno::int END),
+               MAX(CASE WHEN b.anno ~ '^[0-9]{{1,4}}$' THEN b.anno::int END)
+        FROM (SELECT id, ranking FROM matched WHERE ranking = ANY(%(rankings)s)
+              UNION ALL
+              SELECT id, ranking FROM mentions WHERE ranking = ANY(%(rankings)s)) r
+        JOIN public.books b ON b.id = r.id
+        GROUP BY r.ranking, 2
+    """
+    return sql, params
+
+def fetch_name_categories(name: str, filters: dict = None, include_authors: bool = True,
+                          cursors: dict = None, limit: int = None, fields: tuple = None) -> dict:
+    """Ricerca per nome paginata: una pagina per categoria con il relativo cursore.
+    
+    Senza `cursors` restituisce la prima pagina delle categorie ammesse da
+    filters['tipo_pub'], più conteggi e filtri disponibili calcolati in SQL.
+    Con `cursors` ({categoria: token}) solo la pagina successiva delle categorie
+    indicate, senza conteggi. `limit` riduce la dimensione di pagina.
+    """
+    filters = filters or {}
+    allowed = NAME_TIPO_CATEGORIES.get(filters.get('tipo_pub'))
+    
+    pages = {}
+    for ranking, (key, _) in NAME_CATEGORIES.items():
+        if (ranking == 4 and not include_authors) or (allowed and key not in allowed):
+            continue
+        if cursors and not cursors.get(key):
+            continue
+        after = decode_cursor(cursors[key], ranking) if cursors else None
+        size = min(NAME_PAGE_SIZES[key], limit) if limit else NAME_PAGE_SIZES[key]
+        pages[ranking] = (after, max(size, 1))
+    
+    rows, counts = [], (None if cursors else [])
+    if pages:
+        with db_connection() as conn, conn.cursor() as cur:
+            sql, params = build_name_search_query(name, filters, include_authors, pages)
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            
+            if not cursors:
+                sql, params = build_name_counts_query(name, filters, include_authors, list(pages))
+                cur.execute(sql, params)
+                counts = cur.fetchall()
+    
+    # Righe (id, ranking, tipo, relevance, anno_key): la riga in più oltre la pagina dà il cursore
+    found = {key: [] for key, _ in NAME_CATEGORIES.values()}
+    next_cursors = {NAME_CATEGORIES[ranking][0]: None for ranking in pages}
+    
+    for row in rows:
+        key, _ = NAME_CATEGORIES[row[1]]
+        if len(found[key]) == pages[row[1]][1]:
+            last = found[key][-1]
+            key_values = [last[4], last[0]]
+            if row[1] == 5:
+                key_values.insert(0, last[3])
+            next_cursors[key] = encode_cursor(key_values)
+            continue
+        found[key].append(row)
+    
+    books = hydrate_books([row[0] for page in found.values() for row in page], fields)
+    categories = {
+        key: [{**books[row[0]], 'ranking': row[1], 'tipo': row[2]} for row in page if row[0] in books]
+        for key, page in found.items()
+    }
     
-    cur.close()
-    conn.close()
+    categories['cursori'] = next_cursors
+    categories['conteggi'] = None
+    if counts is not None:
+        per_category = {NAME_CATEGORIES[ranking][0]: 0 for ranking in pages}
+        lingue = {}
+        anni = []
+        for ranking, lingua, n, anno_min, anno_max in counts:
+            per_category[NAME_CATEGORIES[ranking][0]] += n
+            lang = normalize_language(lingua)
+            if lang:
+                lingue[lang] = lingue.get(lang, 0) + n
+            anni.extend(a for a in (anno_min, anno_max) if a is not None)
+        
+        categories['conteggi'] = per_category
+        categories['totale'] = sum(per_category.values())
+        categories['filtri_disponibili'] = {
+            'lingue': dict(sorted(lingue.items(), key=lambda x: -x[1])),
+            'tipi': {
+                'monografia': per_category.get('monografie_titolo', 0) + per_category.get('monografie', 0),
+                'collettiva': per_category.get('collettive', 0),
+                'autore': per_category.get('come_autore', 0)
+            },
+            'anni': {'min': min(anni) if anni else None, 'max': max(anni) if anni else None}
+        }
     
-    columns = ['id', 'titolo', 'editore', 'anno', 'descrizione', 'prezzo', 
-               'pagine', 'lingua', 'immagine', 'isbn', 'ranking', 'tipo']
+    return categories
+
+def name_result_fields(results: dict) -> dict:
+    """Campi della risposta per nome: i libri della pagina e i cursori, più
+    conteggi e filtri disponibili sulla prima pagina."""
+    fields = {
+        "risultati": [book for key, _ in NAME_CATEGORIES.values() for book in results[key]],
+        "cursori": results['cursori']
+    }
+    counts = results.get('conteggi')
+    if counts is not None:
+        fields["filtri_disponibili"] = results['filtri_disponibili']
+        fields["conteggi"] = {
+            "monografie": counts.get('monografie_titolo', 0) + counts.get('monografie', 0),
+            "collettive": counts.get('collettive', 0),
+            "come_autore": counts.get('come_autore', 0),
+            "citazioni": counts.get('citazioni', 0),
+            "totale": results['totale']
+        }
+    return fields
+
+# ============ DIRECT SEARCH - NO AI (NEW) ============
+
+def search_direct_artist(name: str, limit: int = 100, cursors: dict = None, fields: tuple = None) -> dict:
+    """Ricerca diretta per artista - SQL only, no Claude."""
     
-    all_results = (
-        [dict(zip(columns, r)) for r in monografie_titolo] +
-        [dict(zip(columns, r)) for r in monografie] +
-        [dict(zip(columns, r)) for r in collettive] +
-        [dict(zip(columns, r)) for r in menzioni]
-    )
+    categories = fetch_name_categories(name, include_authors=False, cursors=cursors, limit=limit, fields=fields)
     
-    return {
-        'risultati': all_results[:limit],
+    result = {
+        'risultati': [book for key, _ in NAME_CATEGORIES.values() for book in categories[key]],
         'nome_cercato': name,
-        'conteggi': {
-            'monografie': len(monografie_titolo) + len(monografie),
-            'collettive': len(collettive),
-            'menzioni': len(menzioni),
-            'totale': len(all_results)
-        }
+        'cursori': categories['cursori']
     }
+    counts = categories['conteggi']
+    if counts is not None:
+        result['conteggi'] = {
+            'monografie': counts.get('monografie_titolo', 0) + counts.get('monografie', 0),
+            'collettive': counts.get('collettive', 0),
+            'menzioni': counts.get('citazioni', 0),
+            'totale': categories['totale']
+        }
+    return result
 
-def search_direct_author(name: str, limit: int = 100) -> dict:
+def search_direct_author(name: str, limit: int = 100, fields: tuple = None) -> dict:
     """Ricerca diretta per autore - SQL only, no Claude."""
     
-    conn = get_db()
-    cur = conn.cursor()
+    pattern_original, pattern_reversed = name_patterns(name)
     
-    name_lower = name.lower().strip()
-    parts = name_lower.split()
-    
-    if len(parts) >= 2:
-        reversed_name = " ".join(reversed(parts))
-        pattern_original = f"%{name_lower}%"
-        pattern_reversed = f"%{reversed_name}%"
-    else:
-        pattern_original = f"%{name_lower}%"
-        pattern_reversed = pattern_original
-    
-    cur.execute("""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               4 as ranking, 'autore' as tipo
-        FROM public.books b
-        JOIN public.book_authors bau ON b.id = bau.book_id
-        WHERE (LOWER(bau.author) LIKE %s OR LOWER(bau.author) LIKE %s)
-        ORDER BY b.anno DESC
-        LIMIT %s
-    """, (pattern_original, pattern_reversed, limit))
-    
-    columns = ['id', 'titolo', 'editore', 'anno', 'descrizione', 'prezzo', 
-               'pagine', 'lingua', 'immagine', 'isbn', 'ranking', 'tipo']
-    results = [dict(zip(columns, row)) for row in cur.fetchall()]
+    # Prima fase solo sugli id, i campi dopo con hydrate_books
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT b.id
+            FROM public.books b
+            WHERE EXISTS (
+                SELECT 1 FROM public.book_authors bau
+                WHERE bau.book_id = b.id
+                  AND (LOWER(bau.author) LIKE %s OR LOWER(bau.author) LIKE %s)
+            )
+            ORDER BY b.anno DESC
+            LIMIT %s
+        """, (pattern_original, pattern_reversed, limit))
+        ids = [row[0] for row in cur.fetchall()]
     
-    cur.close()
-    conn.close()
+    books = hydrate_books(ids, fields)
+    results = [{**books[book_id], 'ranking': 4, 'tipo': 'autore'} for book_id in ids if book_id in books]
     
     return {
         'risultati': results,
@@ -370,35 +1468,17 @@ def search_direct_author(name: str, limit: int = 100) -> dict:
         'conteggi': {'totale': len(results)}
     }
 
-def search_direct_title(title: str, limit: int = 50) -> dict:
+def search_direct_title(title: str, limit: int = 50, fields: tuple = None) -> dict:
     """Ricerca diretta per titolo - SQL only, no Claude."""
     
-    conn = get_db()
-    cur = conn.cursor()
+    fields = fields or LIST_FIELDS
+    sql, params = build_title_search_query(title, limit, with_tipo=True, fields=fields)
     
-    title_lower = title.lower().strip()
-    pattern = f"%{title_lower}%"
-    
-    cur.execute("""
-        SELECT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               1 as ranking, 'titolo' as tipo
-        FROM public.books b
-        WHERE LOWER(b.titolo) LIKE %s
-        ORDER BY 
-            CASE WHEN LOWER(b.titolo) = %s THEN 0
-                 WHEN LOWER(b.titolo) LIKE %s THEN 1
-                 ELSE 2 END,
-            b.anno DESC
-        LIMIT %s
-    """, (pattern, title_lower, title_lower + '%', limit))
-    
-    columns = ['id', 'titolo', 'editore', 'anno', 'descrizione', 'prezzo', 
-               'pagine', 'lingua', 'immagine', 'isbn', 'ranking', 'tipo']
-    results = [dict(zip(columns, row)) for row in cur.fetchall()]
-    
-    cur.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        
+        columns = list(fields) + ['ranking', 'tipo']
+        results = [dict(zip(columns, row)) for row in cur.fetchall()]
     
     return {
         'risultati': results,
@@ -406,18 +1486,624 @@ def search_direct_title(title: str, limit: int = 50) -> dict:
         'conteggi': {'totale': len(results)}
     }
 
+# ============ EMBEDDING CACHE ============
+
+EMBEDDING_MODEL = "voyage-3-lite"
+EMBED_CACHE_MAX_BYTES = int(os.environ.get("EMBED_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+EMBED_CACHE_TTL = float(os.environ.get("EMBED_CACHE_TTL", "0"))
+# File SQLite per la cache persistente (es. /tmp/embeddings.sqlite); vuoto = solo memoria
+EMBED_CACHE_PATH = os.environ.get("EMBED_CACHE_PATH", "")
+
+class EmbeddingCache:
+    """Embedding delle query per testo normalizzato e modello.
+    
+    Primo livello LRU in memoria limitato in byte; secondo livello opzionale su
+    SQLite, che sopravvive ai riavvii ed è condiviso tra i worker dello stesso host.
+    Il file ha lo stesso limite in byte e lo stesso TTL: a ogni scrittura si
+    eliminano le righe scadute e, oltre il limite, le più vecchie.
+    I vettori sono float32, la stessa precisione con cui pgvector li memorizza.
+    """
+    
+    def __init__(self, max_bytes: int, ttl: float = 0, path: str = ""):
+        self.ttl = ttl or None
+        self.max_bytes = max_bytes
+        self.memory = LRUCache(max_bytes=max_bytes, ttl=self.ttl,
+                               sizeof=lambda vector: vector.itemsize * len(vector) + 100)
+        self.path = path
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        self.stats = {'disco_hit': 0, 'disco_miss': 0, 'disco_evict': 0, 'api': 0}
+    
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        return hashlib.sha1(f"{model}\x00{normalize_query_text(text)}".encode()).hexdigest()
+    
+    def _disk_connection(self):
+        if self._disk is None:
+            self._disk = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL
+                )
+            """)
+            self._disk.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+        return self._disk
+    
+    def _disk_get(self, key: str):
+        with self._disk_lock:
+            row = self._disk_connection().execute(
+                "SELECT created, vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (self.ttl and row[0] + self.ttl < time.time()):
+            self.stats['disco_miss'] += 1
+            return None
+        self.stats['disco_hit'] += 1
+        vector = array('f')
+        vector.frombytes(row[1])
+        return vector
+    
+    def _disk_set(self, key: str, vector: array):
+        with self._disk_lock:
+            conn = self._disk_connection()
+            now = time.time()
+            conn.execute("INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)",
+                         (key, now, vector.tobytes()))
+            evicted = 0
+            if self.ttl:
+                evicted += conn.execute("DELETE FROM embeddings WHERE created < ?", (now - self.ttl,)).rowcount
+            if self.max_bytes:
+                # Stesso conteggio della memoria: byte del vettore più 100 per voce
+                evicted += conn.execute("""
+                    DELETE FROM embeddings WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(length(vector) + 100) OVER (ORDER BY created DESC, key) AS total
+                            FROM embeddings
+                        ) WHERE total > ?
+                    )
+                """, (self.max_bytes,)).rowcount
+            conn.commit()
+        self.stats['disco_evict'] += max(evicted, 0)
+    
+    def get(self, text: str, model: str):
+        key = self.key(text, model)
+        vector = self.memory.get(key)
+        if vector is None and self.path:
+            try:
+                vector = self._disk_get(key)
+            except sqlite3.Error as e:
+                print(f"Errore cache embedding su disco: {e}")
+            if vector is not None:
+                self.memory.set(key, vector)
+        return vector
+    
+    def set(self, text: str, model: str, vector: array):
+        key = self.key(text, model)
+        self.memory.set(key, vector)
+        if self.path:
+            try:
+                self._disk_set(key, vector)
+            except sqlite3.Error as e:
+                print(f"Errore cache embedding su disco: {e}")
+    
+    def get_stats(self) -> dict:
+        return {**self.memory.get_stats(), **self.stats}
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_MAX_BYTES, EMBED_CACHE_TTL, EMBED_CACHE_PATH)
+
+def embed_query_vector(query: str, model: str = EMBEDDING_MODEL) -> array:
+    """Embedding di una query come array float32, da cache quando possibile."""
+    vector = embedding_cache.get(query, model)
+    if vector is None:
+        embedding_cache.stats['api'] += 1
+        result = vo.embed([query], model=model, input_type="query")
+        vector = array('f', result.embeddings[0])
+        embedding_cache.set(query, model, vector)
+    return vector
+
+def embed_query(query: str, model: str = EMBEDDING_MODEL) -> list:
+    """Embedding di una query, da cache quando possibile."""
+    return embed_query_vector(query, model).tolist()
+
+# ============ VECTOR SEARCH (PGVECTOR) ============
+# Gli array('f') vengono passati a psycopg2 direttamente come letterale vector
+# (precisione float32, 9 cifre significative) e la query li usa una volta sola.
+# L'indice ANN si crea con scripts/provision_vector_index.py; ef_search e probes
+# si impostano per transazione, così ogni ricerca può scegliere il suo punto
+# tra recall e latenza (scripts/bench_vector_recall.py aiuta a sceglierlo).
+
+VECTOR_EF_SEARCH = int(os.environ.get("VECTOR_EF_SEARCH", "40"))
+VECTOR_PROBES = int(os.environ.get("VECTOR_PROBES", "10"))
+# Valore massimo accettato da pgvector per hnsw.ef_search
+HNSW_MAX_EF_SEARCH = 1000
+
+def adapt_vector(vector: array):
+    if vector.typecode not in ('f', 'd'):
+        return psycopg2.extensions.adapt(vector.tolist())
+    # pgvector memorizza float32: 9 cifre significative bastano per il round-trip esatto
+    return AsIs("'[" + ",".join(f"{value:.9g}" for value in vector) + "]'::vector")
+
+register_adapter(array, adapt_vector)
+
+def build_semantic_query(vector: array, limit: int, fields: tuple = None) -> tuple:
+    """Query dei libri più vicini all'embedding (distanza coseno), servita dall'indice ANN."""
+    sql = f"""
+        WITH q AS (SELECT %s AS embedding)
+        SELECT 
+            {book_select(fields)},
+            1 - (b.embedding <=> q.embedding) as similarity
+        FROM public.books b, q
+        WHERE b.embedding IS NOT NULL
+        ORDER BY b.embedding <=> q.embedding
+        LIMIT %s
+    """
+    return sql, (vector, limit)
+
+def execute_vector_query(cur, sql: str, params: tuple, limit: int,
+                         ef_search: int = None, probes: int = None) -> list:
+    """Esegue una query ANN con ef_search/probes validi solo per questa transazione.
+    
+    HNSW non restituisce più di ef_search righe: il valore usato non è mai sotto il limite,
+    né sopra HNSW_MAX_EF_SEARCH (oltre, SET LOCAL fallirebbe).
+    """
+    ef_search = min(max(ef_search or VECTOR_EF_SEARCH, limit), HNSW_MAX_EF_SEARCH)
+    probes = probes or VECTOR_PROBES
+    cur.execute("BEGIN")
+    try:
+        cur.execute("SET LOCAL hnsw.ef_search = %s", (ef_search,))
+        cur.execute("SET LOCAL ivfflat.probes = %s", (probes,))
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+    return rows
+
+# ============ HYBRID SEARCH (FTS + VETTORI) ============
+# Recupero lessicale (full-text su titolo e descrizione) e vettoriale nella
+# stessa query, fusi con reciprocal-rank fusion: ogni libro prende
+# peso / (k + posizione) da ciascuna lista in cui compare. Un errore di
+# classificazione dell'intento non lascia più fuori i match letterali.
+
+SEMANTIC_BACKENDS = ('vector', 'hybrid')
+SEMANTIC_BACKEND = os.environ.get("SEMANTIC_BACKEND", "vector")
+HYBRID_WEIGHT_LEXICAL = float(os.environ.get("HYBRID_WEIGHT_LEXICAL", "1.0"))
+HYBRID_WEIGHT_SEMANTIC = float(os.environ.get("HYBRID_WEIGHT_SEMANTIC", "1.0"))
+HYBRID_RRF_K = int(os.environ.get("HYBRID_RRF_K", "60"))
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "100"))
+
+# Colonna tsvector mantenuta da trigger (migrations/006), con indice GIN
+BOOKS_FTS_EXPRESSION = "b.search_vector"
+
+def build_hybrid_search_query(text: str, vector: array, limit: int, candidates: int = None,
+                              weights: tuple = None, rrf_k: int = None, fields: tuple = None) -> tuple:
+    """Query ibrida: top-N full-text e top-N vettoriali, fusi con RRF.
+    
+    I termini della query sono in OR (plainto_tsquery con & → |), così una
+    richiesta in linguaggio naturale trova anche i libri che ne contengono solo una parte.
+    """
+    lexical_weight, semantic_weight = weights or (HYBRID_WEIGHT_LEXICAL, HYBRID_WEIGHT_SEMANTIC)
+    sql = f"""
+        WITH q AS NOT MATERIALIZED (
+            SELECT %(vector)s AS embedding,
+                   replace(plainto_tsquery('italian', public.search_unaccent(%(text)s))::text, '&', '|')::tsquery AS tsq
+        ),
+        lexical AS (
+            SELECT id, ROW_NUMBER() OVER (ORDER BY rank DESC, id) AS position
+            FROM (
+                SELECT b.id, ts_rank_cd({BOOKS_FTS_EXPRESSION}, q.tsq) AS rank
+                FROM public.books b, q
+                WHERE {BOOKS_FTS_EXPRESSION} @@ q.tsq
+                ORDER BY rank DESC
+                LIMIT %(candidates)s
+            ) l
+        ),
+        semantic AS (
+            SELECT id, ROW_NUMBER() OVER (ORDER BY distance, id) AS position
+            FROM (
+                SELECT b.id, b.embedding <=> q.embedding AS distance
+                FROM public.books b, q
+                WHERE b.embedding IS NOT NULL
+                ORDER BY b.embedding <=> q.embedding
+                LIMIT %(candidates)s
+            ) s
+        ),
+        fused AS (
+            SELECT id, SUM(score) AS score
+            FROM (
+                SELECT id, %(lexical_weight)s::float8 / (%(rrf_k)s + position) AS score FROM lexical
+                UNION ALL
+                SELECT id, %(semantic_weight)s::float8 / (%(rrf_k)s + position) FROM semantic
+            ) ranked
+            GROUP BY id
+            ORDER BY score DESC
+            LIMIT %(limit)s
+        )
+        SELECT 
+            {book_select(fields)},
+            1 - (b.embedding <=> q.embedding) as similarity,
+            f.score
+        FROM fused f
+        JOIN public.books b ON b.id = f.id
+        CROSS JOIN q
+        ORDER BY f.score DESC, b.id
+    """
+    params = {
+        'vector': vector,
+        'text': text,
+        'candidates': max(candidates or HYBRID_CANDIDATES, limit),
+        'lexical_weight': float(lexical_weight),
+        'semantic_weight': float(semantic_weight),
+        'rrf_k': rrf_k or HYBRID_RRF_K,
+        'limit': limit,
+    }
+    return sql, params
+
+def search_hybrid(query: str, limit: int = 10, weights: tuple = None, fields: tuple = None) -> list:
+    """Ricerca ibrida full-text + semantica in un solo round trip."""
+    
+    fields = fields or LIST_FIELDS
+    sql, params = build_hybrid_search_query(query, embed_query_vector(query), limit, weights=weights, fields=fields)
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        rows = execute_vector_query(cur, sql, params, params['candidates'])
+        
+        columns = list(fields) + ['similarity', 'score']
+        results = [dict(zip(columns, row)) for row in rows]
+    
+    return results
+
+def retrieve_semantic(query: str, limit: int = 10, backend: str = None, fields: tuple = None) -> list:
+    """Ramo semantico della ricerca: solo vettoriale o ibrido, secondo SEMANTIC_BACKEND
+    o il backend richiesto esplicitamente."""
+    backend = backend if backend in SEMANTIC_BACKENDS else SEMANTIC_BACKEND
+    if backend == 'hybrid':
+        return search_hybrid(query, limit, fields=fields)
+    return search_semantic(query, limit, fields=fields)
+
+# ============ FAST-PATH INTENT (NO AI) ============
+# Le query che sono solo un nome o un titolo presenti in catalogo (più qualche
+# filtro semplice) vengono classificate qui senza chiamare Claude.
+
+def fold_text(text: str) -> str:
+    """Minuscolo, senza accenti e punteggiatura, spazi singoli."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w]+", " ", stripped.casefold()).split())
+
+def name_key(text: str) -> str:
+    """Chiave indipendente dall'ordine delle parole ("Nauman Bruce" = "Bruce Nauman")."""
+    return " ".join(sorted(fold_text(text).split()))
+
+# Parole minime perché un titolo esatto decida da solo la ricerca per titolo
+TITLE_MIN_WORDS = 3
+
+class EntityDictionary:
+    """Nomi (artisti e autori) e titoli del catalogo indicizzati per forma normalizzata."""
+    
+    def __init__(self, names, titles):
+        self.names = {}
+        for name, count in names:
+            key = name_key(name)
+            if len(key) >= 3 and count > self.names.get(key, ('', 0))[1]:
+                self.names[key] = (name, count)
+        # Parole che compaiono nei nomi: una query fatta solo di queste può essere un nome
+        self.name_words = {word for key in self.names for word in key.split() if len(word) >= 3}
+        self.titles = {}
+        for (title,) in titles:
+            key = fold_text(title)
+            # Titoli brevi ("Fotografia", "Arte povera") sono quasi sempre ricerche tematiche
+            if len(key.split()) >= TITLE_MIN_WORDS:
+                self.titles.setdefault(key, title)
+    
+    def __len__(self):
+        return len(self.names) + len(self.titles)
+    
+    def lookup(self, text: str):
+        """('nome'|'titolo', valore canonico) se il testo identifica una sola entità."""
+        name = self.names.get(name_key(text))
+        title = self.titles.get(fold_text(text))
+        if name and title:
+            return None
+        if name:
+            return 'nome', name[0]
+        if title:
+            return 'titolo', title
+        return None
+    
+    def candidates(self, text: str) -> set:
+        """Tipi ('nome', 'titolo') che il testo potrebbe essere, anche se lookup non decide."""
+        found = set()
+        words = fold_text(text).split()
+        if words and all(word in self.name_words for word in words):
+            found.add('nome')
+        if fold_text(text) in self.titles:
+            found.add('titolo')
+        return found
+
+def _load_entity_dictionary(cur, previous):
+    cur.execute("""
+        SELECT artist, COUNT(*) FROM public.book_artists GROUP BY artist
+        UNION ALL
+        SELECT author, COUNT(*) FROM public.book_authors GROUP BY author
+    """)
+    names = [row for row in cur.fetchall() if row[0]]
+    cur.execute("SELECT DISTINCT titolo FROM public.books WHERE titolo IS NOT NULL")
+    return EntityDictionary(names, cur.fetchall())
+
+CATALOG_INDEX_LOADERS['entita'] = _load_entity_dictionary
+
+LANGUAGE_WORDS = {
+    'italiano': 'IT', 'inglese': 'EN', 'tedesco': 'DE', 'francese': 'FR',
+    'giapponese': 'JP', 'spagnolo': 'ES',
+}
+
+FILTER_PATTERNS = [
+    (re.compile(r"\bin (" + "|".join(LANGUAGE_WORDS) + r")\b"),
+     lambda m: {'lingua': LANGUAGE_WORDS[m.group(1)]}),
+    (re.compile(r"\btra il (\d{4}) e il (\d{4})\b"),
+     lambda m: {'anno_min': int(m.group(1)), 'anno_max': int(m.group(2))}),
+    (re.compile(r"\bdopo il (\d{4})\b"), lambda m: {'anno_min': int(m.group(1)) + 1}),
+    (re.compile(r"\bdal (\d{4})\b"), lambda m: {'anno_min': int(m.group(1))}),
+    (re.compile(r"\bprima del (\d{4})\b"), lambda m: {'anno_max': int(m.group(1)) - 1}),
+    (re.compile(r"\bfino al (\d{4})\b"), lambda m: {'anno_max': int(m.group(1))}),
+    (re.compile(r"\banni (\d{2})\b"),
+     lambda m: {'anno_min': 1900 + int(m.group(1)), 'anno_max': 1909 + int(m.group(1))}),
+    (re.compile(r"\b(solo )?(le )?monografie\b"), lambda m: {'tipo_pub': 'monografia'}),
+    (re.compile(r"\b(solo )?(le )?collettive\b"), lambda m: {'tipo_pub': 'collettiva'}),
+]
+
+LEADING_PHRASES = re.compile(r"^(cerco |avete |hai |libri (di|su) |cataloghi (di|su) |mostrami )+")
+
+# Parole che in un raffinamento ("solo in inglese", "e in italiano?") restano
+# attorno ai filtri senza aggiungere nulla
+FOLLOWUP_FILLER = {'solo', 'soltanto', 'e', 'ed', 'anche', 'ma', 'pero', 'invece', 'ora', 'adesso',
+                   'allora', 'quelli', 'quelle', 'i', 'gli', 'le', 'mostrami'}
+
+_fastpath_stats = {'hit': 0, 'miss': 0, 'non_disponibile': 0}
+
+def classify_query_locally(query: str, context: dict = None):
+    """Intento della query senza LLM, oppure None se la query è ambigua.
+    
+    Riconosce un nome o titolo noto (ordine delle parole, accenti e maiuscole
+    non contano) seguito da filtri semplici; con un contesto precedente, una
+    query fatta solo di filtri raffina la ricerca precedente.
+    """
+    dictionary = catalog_index('entita')
+    if dictionary is None:
+        _fastpath_stats['non_disponibile'] += 1
+        return None
+    
+    context = context or {}
+    text = fold_text(query)
+    filters = {}
+    for pattern, extract in FILTER_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            filters.update(extract(match))
+            text = (text[:match.start()] + " " + text[match.end():])
+    text = LEADING_PHRASES.sub("", " ".join(text.split()))
+    if filters and all(word in FOLLOWUP_FILLER for word in text.split()):
+        text = ""
+    
+    if not text:
+        if filters and context.get('previousSearch'):
+            prev_filters = context.get('previousFilters', {})
+            result = {'tipo': 'nome', 'nome': context['previousSearch']}
+            result.update({k: v for k, v in prev_filters.items() if k in ['lingua', 'anno_min', 'anno_max']})
+            result.update(filters)
+            _fastpath_stats['hit'] += 1
+            return result
+        _fastpath_stats['miss'] += 1
+        return None
+    
+    found = dictionary.lookup(text)
+    if found is None:
+        _fastpath_stats['miss'] += 1
+        return None
+    
+    tipo, value = found
+    _fastpath_stats['hit'] += 1
+    return {'tipo': tipo, tipo: value, **filters}
+
+def get_fastpath_stats() -> dict:
+    decided = _fastpath_stats['hit'] + _fastpath_stats['miss']
+    return {**_fastpath_stats,
+            'hit_rate': round(_fastpath_stats['hit'] / decided, 3) if decided else None}
+
+# ============ LIBRARIAN REPLIES (STREAMING) ============
+
+BOOK_LINK_RE = re.compile(r'\[\[ID:([^\|]+)\|([^\]]+)\]\]')
+SUGGESTIONS_MARKER = "SUGGERIMENTI:"
+# Oltre questa lunghezza un "[[" rimasto aperto non è un link: si smette di trattenerlo
+MAX_PENDING_LINK = 300
+STREAM_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream'
+}
+
+def rewrite_book_links(text: str) -> str:
+    """[[ID:xxx|Titolo]] → link alla scheda del libro."""
+    def replace_link(match):
+        book_id = match.group(1)
+        title = match.group(2)
+        return f'<a href="https://test01-frontend.vercel.app/books/{book_id}" target="_blank">{title}</a>'
+    
+    return BOOK_LINK_RE.sub(replace_link, text)
+
+def parse_suggestions(text: str) -> list:
+    return [s.strip() for s in text.strip().split(",") if s.strip()]
+
+class StreamingLinkRewriter:
+    """Riscrive i link su un testo che arriva a pezzi.
+    
+    Trattiene la coda che potrebbe essere un link non ancora chiuso, così un
+    [[ID:12|Titolo]] spezzato tra due chunk viene comunque riscritto per intero.
+    """
+    
+    def __init__(self):
+        self._pending = ""
+    
+    def feed(self, chunk: str) -> str:
+        text = self._pending + chunk
+        cut = len(text)
+        start = text.rfind('[[')
+        if start != -1 and ']]' not in text[start:] and len(text) - start < MAX_PENDING_LINK:
+            cut = start
+        elif text.endswith('['):
+            cut = len(text) - 1
+        self._pending = text[cut:]
+        return rewrite_book_links(text[:cut])
+    
+    def flush(self) -> str:
+        text, self._pending = self._pending, ""
+        return rewrite_book_links(text)
+
+def _marker_overlap(text: str, marker: str) -> int:
+    """Lunghezza della coda di `text` che potrebbe essere l'inizio di `marker`."""
+    for size in range(min(len(text), len(marker) - 1), 0, -1):
+        if text.endswith(marker[:size]):
+            return size
+    return 0
+
+class LibrarianReply:
+    """Testo del bibliotecario: una risposta fissa oppure un prompt per Claude.
+    
+    `complete()` restituisce il testo intero; `stream()` lo produce a pezzi con
+    i link già riscritti e al termine lascia lo stesso risultato in `result`.
+    Con `with_suggestions` la riga SUGGERIMENTI: finale viene separata dal testo.
+    """
+    
+    def __init__(self, prompt: str = None, max_tokens: int = 400, text: str = None,
+                 with_suggestions: bool = False):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.text = text
+        self.with_suggestions = with_suggestions
+        self.result = None
+    
+    def _request(self) -> dict:
+        return {
+            "model": "claude-sonnet-4-20250514",
+            "max_tokens": self.max_tokens,
+            "messages": [{"role": "user", "content": self.prompt}]
+        }
+    
+    def _result(self, text: str, suggestions: list) -> dict:
+        result = {"risposta": text}
+        if self.with_suggestions:
+            result["suggerimenti"] = suggestions
+        self.result = result
+        return result
+    
+    def complete(self) -> dict:
+        if self.prompt is None:
+            return self._result(self.text, [])
+        
+        message = claude.messages.create(**self._request())
+        response_text = message.content[0].text.strip()
+        
+        suggerimenti = []
+        if self.with_suggestions and SUGGESTIONS_MARKER in response_text:
+            parts = response_text.split(SUGGESTIONS_MARKER)
+            response_text = parts[0].strip()
+            suggerimenti = parse_suggestions(parts[1])
+        
+        return self._result(rewrite_book_links(response_text), suggerimenti)
+    
+    def stream(self):
+        """Genera i pezzi di testo man mano che arrivano dall'API di streaming."""
+        if self.prompt is None:
+            yield self.text
+            self._result(self.text, [])
+            return
+        
+        rewriter = StreamingLinkRewriter()
+        marker = SUGGESTIONS_MARKER if self.with_suggestions else None
+        emitted = []
+        pending = ""
+        tail = None
+        
+        with claude.messages.stream(**self._request()) as response:
+            for chunk in response.text_stream:
+                if tail is not None:
+                    tail += chunk
+                    continue
+                pending += chunk
+                if not emitted:
+                    pending = pending.lstrip()
+                
+                ready = pending
+                if marker:
+                    position = pending.find(marker)
+                    if position != -1:
+                        tail = pending[position + len(marker):]
+                        ready = pending[:position]
+                    else:
+                        ready = pending[:len(pending) - _marker_overlap(pending, marker)]
+                pending = "" if tail is not None else pending[len(ready):]
+                
+                out = rewriter.feed(ready)
+                if out:
+                    emitted.append(out)
+                    yield out
+        
+        out = rewriter.feed(pending) + rewriter.flush()
+        if out:
+            emitted.append(out)
+            yield out
+        
+        suggestions = parse_suggestions(tail.split(marker)[0]) if tail is not None else []
+        self._result("".join(emitted).strip(), suggestions)
+
 # ============ AI-POWERED SEARCH (existing) ============
 
-def extract_name_from_query(query: str, context: dict = None, image_base64: str = None) -> dict:
+INTENT_CACHE_SIZE = int(os.environ.get("INTENT_CACHE_SIZE", "2048"))
+INTENT_CACHE_TTL = float(os.environ.get("INTENT_CACHE_TTL", "86400"))
+
+intent_cache = LRUCache(max_entries=INTENT_CACHE_SIZE, ttl=INTENT_CACHE_TTL)
+
+def intent_cache_key(query: str, context: dict) -> str:
+    """Chiave per l'intento estratto: la query e, solo se presente, il contesto che entra nel prompt."""
+    parts = {'q': normalize_query_text(query)}
+    if context.get('previousSearch'):
+        parts['prev'] = normalize_query_text(context.get('previousSearch'))
+        parts['filtri'] = context.get('previousFilters', {})
+    return json.dumps(parts, sort_keys=True, default=str)
+
+def resolve_intent_locally(query: str, context: dict = None):
+    """Intento senza chiamare Claude (fast-path o cache), oppure None."""
+    context = context or {}
+    local_result = classify_query_locally(query, context)
+    if local_result is not None:
+        return local_result
+    cached = intent_cache.get(intent_cache_key(query, context))
+    if cached is not None:
+        return copy.deepcopy(cached)
+    return None
+
+def extract_name_from_query(query: str, context: dict = None, image_base64: str = None,
+                            resolve_locally: bool = True, cover_image: dict = None) -> dict:
     """Usa Claude per estrarre nomi di artisti/autori, titoli e filtri dalla query.
     
     Args:
         query: Testo della query utente
         context: Contesto conversazione precedente
         image_base64: Immagine in base64 (opzionale) - foto copertina libro
+        resolve_locally: False se il chiamante ha già provato resolve_intent_locally
+        cover_image: Foto già passata da prepare_cover_image (evita una seconda decodifica)
     """
     
     context = context or {}
+    
+    # Le foto non sono memorizzabili per testo: passano sempre da Claude
+    cache_key = None if image_base64 else intent_cache_key(query, context)
+    if cache_key and resolve_locally:
+        local_result = resolve_intent_locally(query, context)
+        if local_result is not None:
+            return local_result
+    
     context_info = ""
     
     if context.get('previousSearch'):
@@ -435,17 +2121,14 @@ mantieni il nome della ricerca precedente e aggiungi/modifica i filtri.
     
     # Se c'è un'immagine, aggiungila prima
     if image_base64:
-        # Rimuovi eventuale prefisso data:image/...;base64,
-        clean_base64 = image_base64
-        if ',' in clean_base64:
-            clean_base64 = clean_base64.split(',')[1]
+        cover_image = cover_image or prepare_cover_image(image_base64)
         
         content.append({
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/jpeg",
-                "data": clean_base64
+                "media_type": cover_image['media_type'],
+                "data": cover_image['data']
             }
         })
         
@@ -531,6 +2214,8 @@ JSON:"""
                 if key not in result and key in prev_filters:
                     result[key] = prev_filters[key]
         
+        if cache_key:
+            intent_cache.set(cache_key, copy.deepcopy(result))
         return result
     except:
         return {"tipo": "tematica", "tema": query or "ricerca generica"}
@@ -563,14 +2248,7 @@ ISTRUZIONI:
     )
     
     response_text = message.content[0].text.strip()
-    
-    def replace_link(match):
-        book_id = match.group(1)
-        title = match.group(2)
-        return f'<a href="https://test01-frontend.vercel.app/books/{book_id}" target="_blank">{title}</a>'
-    
-    response_text = re.sub(r'\[\[ID:([^\|]+)\|([^\]]+)\]\]', replace_link, response_text)
-    return response_text
+    return rewrite_book_links(response_text)
 
 def generate_comment_response(filter_term: str, books: list, original_query: str) -> str:
     """Genera commenti brevi sui libri filtrati."""
@@ -599,299 +2277,70 @@ ISTRUZIONI:
     )
     
     response_text = message.content[0].text.strip()
-    
-    def replace_link(match):
-        book_id = match.group(1)
-        title = match.group(2)
-        return f'<a href="https://test01-frontend.vercel.app/books/{book_id}" target="_blank">{title}</a>'
-    
-    response_text = re.sub(r'\[\[ID:([^\|]+)\|([^\]]+)\]\]', replace_link, response_text)
-    return response_text
+    return rewrite_book_links(response_text)
 
-def search_by_title(title: str, limit: int = 20) -> list:
+def search_by_title(title: str, limit: int = 20, fields: tuple = None) -> list:
     """Cerca libri per titolo esatto o parziale."""
     
-    conn = get_db()
-    cur = conn.cursor()
-    
-    title_lower = title.lower().strip()
-    pattern = f"%{title_lower}%"
-    
-    cur.execute("""
-        SELECT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo
-        FROM public.books b
-        WHERE LOWER(b.titolo) LIKE %s
-        ORDER BY 
-            CASE WHEN LOWER(b.titolo) = %s THEN 0
-                 WHEN LOWER(b.titolo) LIKE %s THEN 1
-                 ELSE 2 END,
-            b.anno DESC
-        LIMIT %s
-    """, (pattern, title_lower, title_lower + '%', limit))
-    
-    columns = ['id', 'titolo', 'editore', 'anno', 'descrizione', 'prezzo', 
-               'pagine', 'lingua', 'immagine', 'isbn']
-    results = [dict(zip(columns, row)) for row in cur.fetchall()]
+    fields = fields or LIST_FIELDS
+    sql, params = build_title_search_query(title, limit, fields=fields)
     
-    cur.close()
-    conn.close()
-    
-    return results
-
-def generate_response_for_title(title: str, results: list) -> str:
-    """Genera risposta per ricerca per titolo."""
-    
-    if not results:
-        return f"Non ho trovato libri con titolo \"{title}\". Prova con parole chiave diverse."
-    
-    books_context = "\n".join([
-        f"- ID:{r['id']} | \"{r['titolo']}\" ({r['editore']}, {r['anno']}) - Lingua: {r['lingua']}"
-        for r in results[:10]
-    ])
-    
-    message = claude.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=300,
-        messages=[{
-            "role": "user",
-            "content": f"""Sei un bibliotecario. L'utente cerca: "{title}"
-
-RISULTATI ({len(results)} titoli):
-{books_context}
-
-ISTRUZIONI:
-- Conferma se c'è un match: "Sì, abbiamo [[ID:xxx|Titolo]]"
-- Formato: [[ID:xxx|Titolo]] con editore, anno, lingua
-- Risposte brevi"""
-        }]
-    )
-    
-    response_text = message.content[0].text
-    
-    def replace_link(match):
-        book_id = match.group(1)
-        title = match.group(2)
-        return f'<a href="https://test01-frontend.vercel.app/books/{book_id}" target="_blank">{title}</a>'
-    
-    response_text = re.sub(r'\[\[ID:([^\|]+)\|([^\]]+)\]\]', replace_link, response_text)
-    return response_text
-
-def search_by_name(name: str, filters: dict = None, limit: int = 100) -> dict:
-    """Cerca tutti i libri collegati a un nome, con ranking e filtri."""
-    
-    conn = get_db()
-    cur = conn.cursor()
-    
-    filters = filters or {}
-    
-    name_lower = name.lower().strip()
-    parts = name_lower.split()
-    
-    if len(parts) >= 2:
-        reversed_name = " ".join(reversed(parts))
-        pattern_original = f"%{name_lower}%"
-        pattern_reversed = f"%{reversed_name}%"
-    else:
-        pattern_original = f"%{name_lower}%"
-        pattern_reversed = pattern_original
-    
-    extra_conditions = ""
-    extra_params = []
-    
-    if filters.get('lingua'):
-        extra_conditions += " AND LOWER(b.lingua) LIKE %s"
-        extra_params.append(f"%{filters['lingua'].lower()}%")
-    
-    if filters.get('anno_min'):
-        extra_conditions += " AND b.anno >= %s"
-        extra_params.append(str(filters['anno_min']))
-    
-    if filters.get('anno_max'):
-        extra_conditions += " AND b.anno <= %s"
-        extra_params.append(str(filters['anno_max']))
-    
-    tipo_pub = filters.get('tipo_pub')
-    
-    cur.execute(f"""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione, 
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               1 as ranking, 'monografia_titolo' as tipo
-        FROM public.books b
-        JOIN public.book_artists ba ON b.id = ba.book_id
-        WHERE (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
-          AND (LOWER(b.titolo) LIKE %s OR LOWER(b.titolo) LIKE %s)
-          AND (SELECT COUNT(*) FROM public.book_artists ba2 WHERE ba2.book_id = b.id) = 1
-          {extra_conditions}
-        ORDER BY b.anno DESC
-    """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed) + tuple(extra_params))
-    monografie_titolo = cur.fetchall()
-    
-    cur.execute(f"""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               2 as ranking, 'monografia' as tipo
-        FROM public.books b
-        JOIN public.book_artists ba ON b.id = ba.book_id
-        WHERE (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
-          AND LOWER(b.titolo) NOT LIKE %s AND LOWER(b.titolo) NOT LIKE %s
-          AND (SELECT COUNT(*) FROM public.book_artists ba2 WHERE ba2.book_id = b.id) = 1
-          {extra_conditions}
-        ORDER BY b.anno DESC
-    """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed) + tuple(extra_params))
-    monografie = cur.fetchall()
-    
-    cur.execute(f"""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               3 as ranking, 'collettiva' as tipo
-        FROM public.books b
-        JOIN public.book_artists ba ON b.id = ba.book_id
-        WHERE (LOWER(ba.artist) LIKE %s OR LOWER(ba.artist) LIKE %s)
-          AND (SELECT COUNT(*) FROM public.book_artists ba2 WHERE ba2.book_id = b.id) > 1
-          {extra_conditions}
-        ORDER BY b.anno DESC
-    """, (pattern_original, pattern_reversed) + tuple(extra_params))
-    collettive = cur.fetchall()
-    
-    cur.execute(f"""
-        SELECT DISTINCT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-               b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-               4 as ranking, 'autore' as tipo
-        FROM public.books b
-        JOIN public.book_authors bau ON b.id = bau.book_id
-        WHERE (LOWER(bau.author) LIKE %s OR LOWER(bau.author) LIKE %s)
-          {extra_conditions}
-        ORDER BY b.anno DESC
-    """, (pattern_original, pattern_reversed) + tuple(extra_params))
-    come_autore = cur.fetchall()
-    
-    found_ids = [r[0] for r in monografie_titolo + monografie + collettive + come_autore]
-    if found_ids:
-        cur.execute(f"""
-            SELECT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-                   b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-                   5 as ranking, 'menzione' as tipo
-            FROM public.books b
-            WHERE (LOWER(b.descrizione) LIKE %s OR LOWER(b.descrizione) LIKE %s
-                   OR LOWER(b.titolo) LIKE %s OR LOWER(b.titolo) LIKE %s)
-              AND b.id NOT IN %s
-              {extra_conditions}
-            ORDER BY b.anno DESC
-            LIMIT 50
-        """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed, tuple(found_ids)) + tuple(extra_params))
-    else:
-        cur.execute(f"""
-            SELECT b.id, b.titolo, b.editore, b.anno, b.descrizione,
-                   b.prezzo_def_euro_web, b.pagine, b.lingua, b.permalinkimmagine, b.isbn_expo,
-                   5 as ranking, 'menzione' as tipo
-            FROM public.books b
-            WHERE (LOWER(b.descrizione) LIKE %s OR LOWER(b.descrizione) LIKE %s
-                   OR LOWER(b.titolo) LIKE %s OR LOWER(b.titolo) LIKE %s)
-              {extra_conditions}
-            ORDER BY b.anno DESC
-            LIMIT 50
-        """, (pattern_original, pattern_reversed, pattern_original, pattern_reversed) + tuple(extra_params))
-    citazioni = cur.fetchall()
-    
-    cur.close()
-    conn.close()
-    
-    columns = ['id', 'titolo', 'editore', 'anno', 'descrizione', 'prezzo', 
-               'pagine', 'lingua', 'immagine', 'isbn', 'ranking', 'tipo']
-    
-    result_dict = {
-        'monografie_titolo': [dict(zip(columns, r)) for r in monografie_titolo],
-        'monografie': [dict(zip(columns, r)) for r in monografie],
-        'collettive': [dict(zip(columns, r)) for r in collettive],
-        'come_autore': [dict(zip(columns, r)) for r in come_autore],
-        'citazioni': [dict(zip(columns, r)) for r in citazioni],
-    }
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        
+        columns = list(fields)
+        results = [dict(zip(columns, row)) for row in cur.fetchall()]
     
-    if tipo_pub:
-        if tipo_pub == 'monografia':
-            result_dict['collettive'] = []
-            result_dict['come_autore'] = []
-            result_dict['citazioni'] = []
-        elif tipo_pub == 'collettiva':
-            result_dict['monografie_titolo'] = []
-            result_dict['monografie'] = []
-            result_dict['come_autore'] = []
-            result_dict['citazioni'] = []
-        elif tipo_pub == 'autore':
-            result_dict['monografie_titolo'] = []
-            result_dict['monografie'] = []
-            result_dict['collettive'] = []
-            result_dict['citazioni'] = []
-    
-    result_dict['totale'] = (len(result_dict['monografie_titolo']) + 
-                             len(result_dict['monografie']) + 
-                             len(result_dict['collettive']) + 
-                             len(result_dict['come_autore']) + 
-                             len(result_dict['citazioni']))
-    
-    all_results = (result_dict['monografie_titolo'] + result_dict['monografie'] + 
-                   result_dict['collettive'] + result_dict['come_autore'] + result_dict['citazioni'])
-    
-    lingue = {}
-    for r in all_results:
-        lang = r.get('lingua', '').strip().upper()
-        if lang:
-            if lang in ['I', 'IT', 'ITA', 'ITALIANO']:
-                lang = 'IT'
-            elif lang in ['E', 'EN', 'ENG', 'ENGLISH']:
-                lang = 'EN'
-            elif lang in ['D', 'DE', 'DEU', 'DEUTSCH']:
-                lang = 'DE'
-            elif lang in ['F', 'FR', 'FRA', 'FRANCAIS']:
-                lang = 'FR'
-            lingue[lang] = lingue.get(lang, 0) + 1
-    
-    anni = [int(r.get('anno', 0)) for r in all_results if r.get('anno') and str(r.get('anno')).isdigit()]
-    anno_min = min(anni) if anni else None
-    anno_max = max(anni) if anni else None
-    
-    result_dict['filtri_disponibili'] = {
-        'lingue': dict(sorted(lingue.items(), key=lambda x: -x[1])),
-        'tipi': {
-            'monografia': len(result_dict['monografie_titolo']) + len(result_dict['monografie']),
-            'collettiva': len(result_dict['collettive']),
-            'autore': len(result_dict['come_autore'])
-        },
-        'anni': {'min': anno_min, 'max': anno_max}
-    }
+    return results
+
+def title_reply(title: str, results: list) -> LibrarianReply:
+    """Risposta per ricerca per titolo."""
+    
+    if not results:
+        return LibrarianReply(text=f"Non ho trovato libri con titolo \"{title}\". Prova con parole chiave diverse.")
+    
+    books_context = "\n".join([
+        f"- ID:{r['id']} | \"{r['titolo']}\" ({r['editore']}, {r['anno']}) - Lingua: {r['lingua']}"
+        for r in results[:10]
+    ])
     
-    return result_dict
+    return LibrarianReply(
+        prompt=f"""Sei un bibliotecario. L'utente cerca: "{title}"
 
-def search_semantic(query: str, limit: int = 10) -> list:
-    """Ricerca semantica classica."""
+RISULTATI ({len(results)} titoli):
+{books_context}
+
+ISTRUZIONI:
+- Conferma se c'è un match: "Sì, abbiamo [[ID:xxx|Titolo]]"
+- Formato: [[ID:xxx|Titolo]] con editore, anno, lingua
+- Risposte brevi""",
+        max_tokens=300
+    )
+
+def search_by_name(name: str, filters: dict = None, limit: int = 100, cursors: dict = None,
+                   fields: tuple = None) -> dict:
+    """Cerca i libri collegati a un nome, con ranking e filtri, una pagina per categoria."""
     
-    result = vo.embed([query], model="voyage-3-lite", input_type="query")
-    query_embedding = result.embeddings[0]
+    return fetch_name_categories(name, filters, cursors=cursors, limit=limit, fields=fields)
+
+def search_semantic(query: str, limit: int = 10, ef_search: int = None, probes: int = None,
+                    fields: tuple = None) -> list:
+    """Ricerca semantica classica."""
     
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT 
-            id, titolo, editore, anno, descrizione, 
-            prezzo_def_euro_web, pagine, lingua, permalinkimmagine, isbn_expo,
-            1 - (embedding <=> %s::vector) as similarity
-        FROM public.books
-        WHERE embedding IS NOT NULL
-        ORDER BY embedding <=> %s::vector
-        LIMIT %s
-    """, (query_embedding, query_embedding, limit))
+    fields = fields or LIST_FIELDS
+    query_embedding = embed_query_vector(query)
+    sql, params = build_semantic_query(query_embedding, limit, fields)
     
-    columns = ['id', 'titolo', 'editore', 'anno', 'descrizione', 'prezzo', 
-               'pagine', 'lingua', 'immagine', 'isbn', 'similarity']
-    results = [dict(zip(columns, row)) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cur:
+        rows = execute_vector_query(cur, sql, params, limit, ef_search, probes)
+        
+        columns = list(fields) + ['similarity']
+        results = [dict(zip(columns, row)) for row in rows]
     
     return results
 
-def generate_response_for_name(name: str, results: dict, filters: dict = None) -> str:
-    """Genera risposta per ricerca per nome."""
+def name_reply(name: str, results: dict, filters: dict = None) -> LibrarianReply:
+    """Risposta per ricerca per nome."""
     
     filters = filters or {}
     
@@ -899,7 +2348,7 @@ def generate_response_for_name(name: str, results: dict, filters: dict = None) -
         filter_msg = ""
         if filters.get('lingua'):
             filter_msg = f" in lingua {filters['lingua']}"
-        return f"Non ho trovato pubblicazioni su {name}{filter_msg}. Vuoi provare senza filtri?"
+        return LibrarianReply(text=f"Non ho trovato pubblicazioni su {name}{filter_msg}. Vuoi provare senza filtri?")
     
     context_parts = []
     
@@ -914,10 +2363,11 @@ def generate_response_for_name(name: str, results: dict, filters: dict = None) -
     if filter_info:
         context_parts.append(f"FILTRI: {', '.join(filter_info)}")
     
-    n_mono = len(results['monografie_titolo']) + len(results['monografie'])
-    n_coll = len(results['collettive'])
-    n_autore = len(results['come_autore'])
-    n_citazioni = len(results['citazioni'])
+    counts = results['conteggi']
+    n_mono = counts.get('monografie_titolo', 0) + counts.get('monografie', 0)
+    n_coll = counts.get('collettive', 0)
+    n_autore = counts.get('come_autore', 0)
+    n_citazioni = counts.get('citazioni', 0)
     
     context_parts.append(f"""CONTEGGI:
 - Monografie: {n_mono}
@@ -952,12 +2402,8 @@ def generate_response_for_name(name: str, results: dict, filters: dict = None) -
     
     books_with_ids = "\n".join([f"ID:{b['id']} | {b['titolo']}" for b in all_books])
     
-    message = claude.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=400,
-        messages=[{
-            "role": "user",
-            "content": f"""Bibliotecario arte. Utente cerca: {name}
+    return LibrarianReply(
+        prompt=f"""Bibliotecario arte. Utente cerca: {name}
 
 DATI: {context}
 
@@ -968,40 +2414,23 @@ REGOLE:
 - Inizia con numeri totali
 - Cita 3-5 titoli
 - Concludi: "Filtro per periodo, lingua o tipo?"
-- Breve, lingua utente"""
-        }]
+- Breve, lingua utente""",
+        max_tokens=400
     )
-    
-    response_text = message.content[0].text
-    
-    def replace_link(match):
-        book_id = match.group(1)
-        title = match.group(2)
-        return f'<a href="https://test01-frontend.vercel.app/books/{book_id}" target="_blank">{title}</a>'
-    
-    response_text = re.sub(r'\[\[ID:([^\|]+)\|([^\]]+)\]\]', replace_link, response_text)
-    return response_text
 
-def generate_response_semantic(query: str, results: list) -> dict:
-    """Genera risposta per ricerca semantica."""
+def semantic_reply(query: str, results: list) -> LibrarianReply:
+    """Risposta per ricerca semantica, con i suggerimenti per affinare."""
     
     if not results:
-        return {
-            "risposta": "Non ho trovato risultati. Prova con termini diversi.",
-            "suggerimenti": []
-        }
+        return LibrarianReply(text="Non ho trovato risultati. Prova con termini diversi.", with_suggestions=True)
     
     books_context = "\n".join([
         f"- ID:{r['id']} | \"{r['titolo']}\" ({r['editore']}, {r['anno']})"
         for r in results[:7]
     ])
     
-    message = claude.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=500,
-        messages=[{
-            "role": "user",
-            "content": f"""Bibliotecario arte. Query: "{query}"
+    return LibrarianReply(
+        prompt=f"""Bibliotecario arte. Query: "{query}"
 
 RISULTATI: {books_context}
 
@@ -1013,181 +2442,1045 @@ REGOLE:
 
 OBBLIGATORIO - ULTIMA RIGA:
 SUGGERIMENTI: termine1, termine2, termine3, termine4
-(3-5 parole brevi per affinare)"""
-        }]
+(3-5 parole brevi per affinare)""",
+        max_tokens=500,
+        with_suggestions=True
     )
+
+# ============ SPECULATIVE SEARCH ============
+# Mentre Claude estrae l'intento, le ricerche più probabili partono sulla query
+# grezza; quando l'intento arriva si riusa il ramo che coincide e si scartano gli altri.
+
+SPECULATIVE_BRANCHES = [b for b in os.environ.get("SPECULATIVE_BRANCHES", "semantica,nome,titolo").split(",") if b]
+# Rami speculativi in corso per processo: restano una minoranza del pool DB, perché
+# quelli scartati finiscono comunque la loro query
+SPECULATIVE_MAX_INFLIGHT = int(os.environ.get("SPECULATIVE_MAX_INFLIGHT", str(max(1, DB_POOL_MAX // 3))))
+BACKGROUND_WORKERS = int(os.environ.get("BACKGROUND_WORKERS", "16"))
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+def _executor(name: str, workers: int) -> ThreadPoolExecutor:
+    """Pool di thread `name` del processo corrente (ricreato dopo un fork)."""
+    pid, executor = _executors.get(name, (None, None))
+    if pid != os.getpid():
+        with _executor_lock:
+            pid, executor = _executors.get(name, (None, None))
+            if pid != os.getpid():
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+                _executors[name] = (os.getpid(), executor)
+    return executor
+
+def background_executor() -> ThreadPoolExecutor:
+    """Pool di thread del processo per l'I/O parallelo alle richieste (database, API)."""
+    return _executor("background", BACKGROUND_WORKERS)
+
+def image_executor() -> ThreadPoolExecutor:
+    """Pool per il lavoro CPU della ricerca per immagine, separato da quello di I/O."""
+    return _executor("image", IMAGE_WORKERS)
+
+_speculative_stats = {'avviate': 0, 'usate': 0, 'scartate': 0, 'saltate': 0}
+_speculative_slots = threading.BoundedSemaphore(SPECULATIVE_MAX_INFLIGHT)
+
+def speculative_branches(query: str) -> list:
+    """Rami da avviare per la query: la semantica sempre, nome e titolo solo se il
+    dizionario delle entità li rende plausibili; nessuno se il pool DB è già a metà."""
+    if get_pool().available() <= DB_POOL_MAX // 2:
+        _speculative_stats['saltate'] += len(SPECULATIVE_BRANCHES)
+        return []
+    dictionary = catalog_index('entita')
+    candidates = dictionary.candidates(query) if dictionary is not None else set()
+    return [branch for branch in SPECULATIVE_BRANCHES if branch == 'semantica' or branch in candidates]
+
+class SpeculativeSearch:
+    """Ricerche lanciate sulla query grezza prima di conoscerne l'intento."""
+    
+    def __init__(self, query: str, limit: int, branches=None, backend: str = None, fields: tuple = None):
+        self.query = query
+        self._key = normalize_query_text(query)
+        runners = {
+            'semantica': lambda: retrieve_semantic(query, limit, backend, fields),
+            'nome': lambda: search_by_name(query, {}, limit, fields=fields),
+            'titolo': lambda: search_by_title(query, limit, fields),
+        }
+        executor = background_executor()
+        self._futures = {}
+        for branch in (branches if branches is not None else speculative_branches(query)):
+            if branch not in runners:
+                continue
+            if not _speculative_slots.acquire(blocking=False):
+                _speculative_stats['saltate'] += 1
+                continue
+            future = executor.submit(runners[branch])
+            # Il posto si libera sia a fine query sia se il ramo viene annullato prima di partire
+            future.add_done_callback(lambda _: _speculative_slots.release())
+            self._futures[branch] = future
+        _speculative_stats['avviate'] += len(self._futures)
+    
+    def take(self, branch: str, value: str, filters: dict = None):
+        """Risultato del ramo se ha cercato esattamente `value` senza filtri, altrimenti None."""
+        future = self._futures.pop(branch, None)
+        if future is None:
+            return None
+        if filters or normalize_query_text(value) != self._key:
+            future.cancel()
+            _speculative_stats['scartate'] += 1
+            return None
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Ricerca speculativa '{branch}' fallita: {e}")
+            return None
+        _speculative_stats['usate'] += 1
+        return result
     
-    response_text = message.content[0].text.strip()
+    def discard(self):
+        """Annulla i rami non ancora partiti; quelli in corso finiscono a vuoto."""
+        for future in self._futures.values():
+            future.cancel()
+        _speculative_stats['scartate'] += len(self._futures)
+        self._futures.clear()
+
+def run_ai_search(query: str, context: dict, limit: int, semantic_backend: str = None, fields: tuple = None):
+    """Ricerca testuale con intento estratto da Claude.
     
-    suggerimenti = []
-    if "SUGGERIMENTI:" in response_text:
-        parts = response_text.split("SUGGERIMENTI:")
-        response_text = parts[0].strip()
-        if len(parts) > 1:
-            sugg_text = parts[1].strip()
-            suggerimenti = [s.strip() for s in sugg_text.split(",") if s.strip()]
+    Restituisce il payload senza la risposta del bibliotecario e la LibrarianReply
+    da completare, così il chiamante può inviare i risultati prima del testo.
+    `semantic_backend` sceglie il ramo semantico ('vector' o 'hybrid', default SEMANTIC_BACKEND);
+    `fields` i campi dei libri, a cui si aggiungono sempre quelli citati nella risposta.
+    """
+    fields = book_fields(set(fields or LIST_FIELDS) | set(REPLY_FIELDS))
+    speculative = None
+    query_info = resolve_intent_locally(query, context)
+    try:
+        if query_info is None:
+            if SPECULATIVE_BRANCHES:
+                speculative = SpeculativeSearch(query, limit, backend=semantic_backend, fields=fields)
+            query_info = extract_name_from_query(query, context, resolve_locally=False)
+        
+        if query_info.get('tipo') == 'titolo':
+            title = query_info['titolo']
+            results = speculative.take('titolo', title) if speculative else None
+            if results is None:
+                results = search_by_title(title, limit, fields)
+            
+            payload = {
+                "tipo_ricerca": "titolo",
+                "titolo_cercato": title,
+                "risultati": results
+            }
+            return payload, title_reply(title, results)
+        
+        if query_info.get('tipo') == 'nome':
+            name = query_info['nome']
+            filters = {k: v for k, v in query_info.items() if k in ['lingua', 'anno_min', 'anno_max', 'tipo_pub']}
+            results = speculative.take('nome', name, filters) if speculative else None
+            if results is None:
+                results = search_by_name(name, filters, limit, fields=fields)
+            
+            payload = {
+                "tipo_ricerca": "nome",
+                "nome_cercato": name,
+                "filtri": filters,
+                **name_result_fields(results)
+            }
+            return payload, name_reply(name, results, filters)
+        
+        results = speculative.take('semantica', query) if speculative else None
+        if results is None:
+            results = retrieve_semantic(query, limit, semantic_backend, fields)
+        
+        payload = {
+            "tipo_ricerca": "semantica",
+            "risultati": results
+        }
+        return payload, semantic_reply(query, results)
+    finally:
+        if speculative:
+            speculative.discard()
+
+def run_image_search(query: str, context: dict, image, limit: int) -> dict:
+    """Ricerca per copertina: hash e indice delle copertine girano nel pool delle
+    immagini mentre Claude legge la foto, poi i due risultati si uniscono.
     
-    def replace_link(match):
-        book_id = match.group(1)
-        title = match.group(2)
-        return f'<a href="https://test01-frontend.vercel.app/books/{book_id}" target="_blank">{title}</a>'
+    `image` è la stringa base64 del body JSON oppure i byte di un upload binario.
+    """
+    started = time.perf_counter()
+    cover_image = prepare_cover_image(image)
+    preparation_ms = elapsed_ms(started)
+    cover_future = image_executor().submit(match_cover, cover_image['immagine'])
+    
+    vision_started = time.perf_counter()
+    query_info = extract_name_from_query(query, context, image, cover_image=cover_image)
+    vision_ms = elapsed_ms(vision_started)
+    
+    image_search_result = search_by_image_hybrid(query_info, image, limit, cover_future.result())
+    
+    risposta = generate_response_for_image_search(image_search_result, query_info)
+    
+    risultati = []
+    for c in image_search_result['candidati'][:20]:
+        risultati.append({
+            'id': c['id'],
+            'titolo': c['titolo'],
+            'editore': c.get('editore', ''),
+            'anno': c.get('anno', ''),
+            'immagine': c.get('immagine', ''),
+            'confidence': c.get('confidence', 'bassa'),
+            'image_match': c.get('image_match', False)
+        })
+    
+    timings = {'preparazione': preparation_ms, **image_search_result['tempi_ms'],
+               'visione': vision_ms, 'totale': elapsed_ms(started)}
+    print(f"Ricerca immagine, tempi (ms): {timings}, "
+          f"{cover_image['formato']} {cover_image['byte_originali']} → {cover_image['byte_inviati']} byte")
+    
+    return {
+        "tipo_ricerca": "immagine",
+        "risposta": risposta,
+        "risultati": risultati,
+        "best_match": image_search_result.get('best_match'),
+        "search_term": image_search_result.get('search_term'),
+        "total_candidates": image_search_result.get('total_candidates', 0),
+        "tempi_ms": timings
+    }
+
+DIRECT_SEARCH_TYPES = ('artist', 'author', 'title')
+
+def run_direct_search(query: str, search_type: str, limit: int, fields: tuple, cursors: dict = None):
+    """Ricerca diretta (senza AI) per artista, autore o titolo; None se il tipo non è previsto."""
+    if search_type == 'artist':
+        result = search_direct_artist(query, limit, cursors, fields)
+        return {
+            "tipo_ricerca": "diretto",
+            "nome_cercato": query,
+            "risultati": result['risultati'],
+            "conteggi": result.get('conteggi'),
+            "cursori": result['cursori']
+        }
+    
+    if search_type == 'author':
+        result = search_direct_author(query, limit, fields)
+        return {
+            "tipo_ricerca": "diretto",
+            "nome_cercato": query,
+            "risultati": result['risultati'],
+            "conteggi": result['conteggi']
+        }
+    
+    if search_type == 'title':
+        result = search_direct_title(query, limit, fields)
+        return {
+            "tipo_ricerca": "diretto",
+            "titolo_cercato": query,
+            "risultati": result['risultati'],
+            "conteggi": result['conteggi']
+        }
+    
+    return None
+
+# ============ RESPONSE CACHE ============
+# Risposte complete di /api/search, con chiave canonica della richiesta e della
+# versione del catalogo (migrations/003): dopo un import le voci vecchie non
+# vengono più lette ed escono per LRU.
+
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "/tmp/libro-search-responses.sqlite")
+CATALOG_VERSION_TTL = float(os.environ.get("CATALOG_VERSION_TTL", "30"))
+
+# Campi della richiesta che determinano la risposta (stream e image esclusi)
+RESPONSE_KEY_FIELDS = ('query', 'limit', 'direct', 'searchType', 'filters', 'mode',
+                       'originalQuery', 'refinement', 'context', 'semanticBackend', 'cursors',
+                       'fields')
+
+_catalog_version = {'value': None, 'checked': 0.0}
+_catalog_version_lock = threading.Lock()
+
+def get_catalog_version():
+    """Versione corrente del catalogo, riletta dal database al più ogni CATALOG_VERSION_TTL secondi."""
+    now = time.monotonic()
+    if _catalog_version['checked'] and now - _catalog_version['checked'] < CATALOG_VERSION_TTL:
+        return _catalog_version['value']
+    with _catalog_version_lock:
+        if _catalog_version['checked'] and now - _catalog_version['checked'] < CATALOG_VERSION_TTL:
+            return _catalog_version['value']
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT version FROM public.catalog_version WHERE id = 1")
+                row = cur.fetchone()
+                cur.close()
+            _catalog_version['value'] = row[0] if row else 0
+        except psycopg2.Error as e:
+            # Migrazione non applicata: la cache resta valida solo per RESPONSE_CACHE_TTL
+            print(f"Versione catalogo non disponibile: {e}")
+            _catalog_version['value'] = 0
+        _catalog_version['checked'] = now
+        return _catalog_version['value']
+
+# Campi di testo libero: conta il testo normalizzato, non maiuscole e spazi
+RESPONSE_KEY_TEXT_FIELDS = ('query', 'originalQuery', 'refinement')
+
+def _canonical_value(value):
+    """Forma stabile di un campo della richiesta, senza i valori vuoti."""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, dict):
+        cleaned = {k: _canonical_value(v) for k, v in value.items()}
+        return {k: v for k, v in cleaned.items() if v not in (None, '', [], {})}
+    if isinstance(value, (list, tuple)):
+        return [_canonical_value(v) for v in value]
+    return value
+
+def search_cache_key(data: dict, version=None):
+    """Chiave della risposta per una richiesta di ricerca, o None se non va in cache."""
+    if data.get('image') or data.get('mode') == 'comment':
+        return None
+    fields = {name: _canonical_value(data.get(name)) for name in RESPONSE_KEY_FIELDS}
+    for name in RESPONSE_KEY_TEXT_FIELDS:
+        fields[name] = normalize_query_text(fields[name])
+    fields['limit'] = int(fields['limit'] or 50)
+    fields = {k: v for k, v in fields.items() if v not in (None, '', False, [], {})}
+    if not fields.get('query'):
+        return None
+    fields['catalogo'] = get_catalog_version() if version is None else version
+    canonical = json.dumps(fields, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class MemoryResponseBackend:
+    """Risposte serializzate in un LRU del processo."""
+    
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self._cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, sizeof=len)
+    
+    def get(self, key: str):
+        return self._cache.get(key)
+    
+    def set(self, key: str, body: bytes):
+        self._cache.set(key, body)
+    
+    def clear(self):
+        self._cache.clear()
+    
+    def get_stats(self) -> dict:
+        return {'backend': 'memory', **self._cache.get_stats()}
+
+class FileResponseBackend:
+    """Risposte su un file SQLite condiviso dai worker dello stesso host.
+    
+    Stessi limiti del backend in memoria: voci, byte e TTL. L'ordine LRU è dato
+    dall'ultimo accesso; a ogni scrittura si eliminano le righe scadute e,
+    oltre i limiti, quelle usate meno di recente (come il disco di
+    EmbeddingCache). Gli accessi dei hit restano in memoria e si scrivono
+    insieme alla scrittura successiva, o ogni ACCESS_BATCH hit: una lettura
+    non apre mai una transazione di scrittura.
+    """
+    
+    ACCESS_BATCH = 256
+    
+    def __init__(self, path: str, max_entries: int, max_bytes: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl or None
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._accessed = {}
+        self.stats = {'hit': 0, 'miss': 0, 'evict': 0}
+    
+    def _connection(self):
+        # Una connessione per processo: quelle ereditate con fork non sono utilizzabili
+        if self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY, created REAL NOT NULL,
+                    accessed REAL NOT NULL, body BLOB NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._conn_pid = os.getpid()
+            self._accessed = {}
+        return self._conn
+    
+    def _write_accessed(self, conn):
+        if self._accessed:
+            conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?",
+                             [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed = {}
+    
+    def get(self, key: str):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT created, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl and row[0] + self.ttl < time.time()):
+                self.stats['miss'] += 1
+                return None
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= self.ACCESS_BATCH:
+                self._write_accessed(conn)
+                conn.commit()
+        self.stats['hit'] += 1
+        return bytes(row[1])
+    
+    def set(self, key: str, body: bytes):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            self._write_accessed(conn)
+            conn.execute("INSERT OR REPLACE INTO responses (key, created, accessed, body) VALUES (?, ?, ?, ?)",
+                         (key, now, now, body))
+            evicted = 0
+            if self.ttl:
+                evicted += conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,)).rowcount
+            if self.max_entries or self.max_bytes:
+                evicted += conn.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key,
+                                   ROW_NUMBER() OVER recent AS position,
+                                   SUM(length(body)) OVER recent AS total
+                            FROM responses
+                            WINDOW recent AS (ORDER BY accessed DESC, key)
+                        ) WHERE (? AND position > ?) OR (? AND total > ?)
+                    )
+                """, (bool(self.max_entries), self.max_entries or 0,
+                      bool(self.max_bytes), self.max_bytes or 0)).rowcount
+            conn.commit()
+        self.stats['evict'] += max(evicted, 0)
+    
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+            self._accessed = {}
+    
+    def get_stats(self) -> dict:
+        with self._lock:
+            entries, size = self._connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(length(body)), 0) FROM responses"
+            ).fetchone()
+        return {'backend': 'file', **self.stats, 'voci': entries, 'byte': size}
+
+class ResponseCache:
+    """Facciata sul backend configurato; gli errori del backend diventano miss."""
+    
+    def __init__(self, backend):
+        self.backend = backend
+    
+    def get(self, key):
+        if key is None or self.backend is None:
+            return None
+        try:
+            return self.backend.get(key)
+        except sqlite3.Error as e:
+            print(f"Errore cache risposte: {e}")
+            return None
+    
+    def set(self, key, body: bytes):
+        if key is None or self.backend is None:
+            return
+        try:
+            self.backend.set(key, body)
+        except sqlite3.Error as e:
+            print(f"Errore cache risposte: {e}")
+    
+    def get_stats(self) -> dict:
+        if self.backend is None:
+            return {'backend': 'off'}
+        try:
+            return self.backend.get_stats()
+        except sqlite3.Error as e:
+            return {'errore': str(e)}
+
+RESPONSE_CACHE_BACKENDS = {
+    'memory': lambda: MemoryResponseBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL),
+    'file': lambda: FileResponseBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE,
+                                        RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL),
+}
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_BACKENDS[RESPONSE_CACHE_BACKEND]() if RESPONSE_CACHE_BACKEND in RESPONSE_CACHE_BACKENDS else None
+)
+
+# ============ IMAGE UPLOAD (BINARIO) ============
+# Alternativa al base64 nel JSON: POST /api/search con il file come body
+# (Content-Type image/*, parametri q/limit nella query string) oppure come
+# multipart/form-data (campo "image", più "query", "limit" e "context" in JSON).
+# Il body viene letto una sola volta, entro IMAGE_UPLOAD_MAX_BYTES.
+
+IMAGE_UPLOAD_MAX_BYTES = int(os.environ.get("IMAGE_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# Il JSON con la foto in base64 pesa circa 4/3 dei byte dell'immagine
+JSON_BODY_MAX_BYTES = IMAGE_UPLOAD_MAX_BYTES * 4 // 3 + 64 * 1024
+MULTIPART_FIELDS = ('query', 'limit', 'context')
+
+class UploadError(Exception):
+    """Upload rifiutato: `status` è il codice HTTP da restituire."""
+    
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def is_binary_upload(content_type: str) -> bool:
+    media_type = content_type.split(';')[0].strip().lower()
+    return (media_type.startswith('image/') or media_type == 'application/octet-stream'
+            or media_type == 'multipart/form-data')
+
+def multipart_boundary(content_type: str) -> bytes:
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary' and value:
+            return value.strip('"').encode()
+    raise UploadError(400, "Boundary multipart mancante")
+
+def parse_multipart(body: bytes, boundary: bytes) -> dict:
+    """Parti di un body multipart come nome → (content-type, memoryview del contenuto).
+    
+    Le parti restano viste sul body letto: nessuna copia finché non servono i byte.
+    """
+    view = memoryview(body)
+    delimiter = b'--' + boundary
+    parts = {}
+    position = body.find(delimiter)
+    while position != -1:
+        start = position + len(delimiter)
+        if body[start:start + 2] == b'--':
+            break
+        header_end = body.find(b'\r\n\r\n', start)
+        end = body.find(b'\r\n' + delimiter, header_end)
+        if header_end == -1 or end == -1:
+            raise UploadError(400, "Body multipart non valido")
+        headers = body[start:header_end].decode('utf-8', 'replace')
+        name = re.search(r'name="([^"]*)"', headers)
+        media_type = re.search(r'(?im)^content-type:\s*([^\s;]+)', headers)
+        if name:
+            parts[name.group(1)] = (media_type.group(1).lower() if media_type else None,
+                                    view[header_end + 4:end])
+        position = end + 2
+    return parts
+
+# ============ RESPONSE WRITER ============
+# Tutte le risposte passano da handler._send_body: JSON serializzato con
+# orjson se installato (altrimenti json della stdlib), compresso con brotli
+# (se installato) o gzip secondo Accept-Encoding, sempre con Content-Length.
+# Così le connessioni HTTP/1.1 restano aperte tra una richiesta e l'altra;
+# gli stream usano il chunked encoding.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.environ.get("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.environ.get("RESPONSE_BROTLI_QUALITY", "5"))
+# Secondi di attesa della richiesta successiva su una connessione keep-alive
+# (0 = ogni risposta chiude la connessione)
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "5"))
+
+def dumps_json(payload) -> bytes:
+    """Payload in JSON (UTF-8); i tipi non JSON (Decimal, date) diventano stringhe."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Interi oltre 64 bit e simili: ci pensa la stdlib
+            pass
+    return json.dumps(payload, default=str).encode()
+
+def negotiate_encoding(accept_encoding: str):
+    """'br', 'gzip' o None secondo l'header Accept-Encoding (q=0 esclude la codifica)."""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name.strip():
+            accepted[name.strip().lower()] = quality
+    
+    for encoding in (('br',) if brotli is not None else ()) + ('gzip',):
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+    return body
+
+# ============ HTTP CACHE ============
+# GET /api/search e /api/suggest dipendono solo dalla richiesta e dal catalogo:
+# l'ETag è la chiave canonica della richiesta (che include la versione del
+# catalogo, migrations/003), così browser e CDN possono rivalidare con
+# If-None-Match e ricevere 304 senza che la ricerca venga rifatta. Dopo un
+# import la versione cambia e con lei tutti gli ETag.
+
+# Cache-Control per endpoint (vuoto = nessun header)
+HTTP_CACHE_CONTROL = {
+    'search': os.environ.get("HTTP_CACHE_SEARCH", "public, max-age=60, s-maxage=600"),
+    'direct': os.environ.get("HTTP_CACHE_DIRECT", "public, max-age=300, s-maxage=3600"),
+    # s-maxage pari a CATALOG_REFRESH_INTERVAL: l'indice dei suggerimenti non è più fresco di così
+    'suggest': os.environ.get("HTTP_CACHE_SUGGEST", "public, max-age=300, s-maxage=600"),
+}
+
+def http_etag(cache_key: str, version: int):
+    """ETag (debole: il body cambia con Content-Encoding) per una chiave di richiesta.
     
-    response_text = re.sub(r'\[\[ID:([^\|]+)\|([^\]]+)\]\]', replace_link, response_text)
+    Senza versione del catalogo (migrazione 003 non applicata) un ETag non
+    scadrebbe mai, quindi non viene emesso.
+    """
+    if cache_key is None or not version:
+        return None
+    return f'W/"{cache_key[:32]}"'
+
+def suggest_etag(suggestion_type: str, query: str, limit: int):
+    """ETag dei suggerimenti, dalla versione con cui è stato costruito l'indice in memoria.
     
-    return {"risposta": response_text, "suggerimenti": suggerimenti}
+    Niente Postgres sul percorso dell'autocompletamento, e l'ETag cambia solo
+    quando l'indice viene ricaricato, cioè quando cambiano i suggerimenti.
+    """
+    index = catalog_index('artist' if suggestion_type == 'artist' else 'author')
+    if index is None:
+        return None
+    canonical = json.dumps({'suggest': suggestion_type, 'q': normalize_query_text(query), 'limit': limit,
+                            'catalogo': index.version}, sort_keys=True, separators=(',', ':'))
+    return http_etag(hashlib.sha256(canonical.encode()).hexdigest(), index.version)
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Confronto debole tra If-None-Match e l'ETag della risposta."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return etag.removeprefix('W/') in tags
+
+def http_cache_headers(endpoint: str, etag: str) -> dict:
+    headers = {}
+    if HTTP_CACHE_CONTROL.get(endpoint):
+        headers['Cache-Control'] = HTTP_CACHE_CONTROL[endpoint]
+    if etag:
+        headers['ETag'] = etag
+    return headers
 
 # ============ HTTP HANDLER ============
 
+SEARCH_MAX_LIMIT = int(os.environ.get("SEARCH_MAX_LIMIT", "500"))
+
+def clamp_limit(value, default: int) -> int:
+    """Limite chiesto dal client, tra 1 e SEARCH_MAX_LIMIT (default se non è un numero)."""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, SEARCH_MAX_LIMIT))
+
 class handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' if HTTP_KEEPALIVE_TIMEOUT > 0 else 'HTTP/1.0'
+    
+    def handle(self):
+        """Come BaseHTTPRequestHandler.handle, ma il timeout vale solo per l'attesa
+        tra una richiesta e l'altra, non per la lettura di un upload lento.
+        
+        Serve ai server con un thread per connessione (Vercel, ThreadingHTTPServer);
+        main.py usa PooledRequestHandler, che parcheggia le connessioni inattive.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_next_request():
+            self.handle_one_request()
+    
+    def _wait_next_request(self) -> bool:
+        """Attende l'inizio della richiesta successiva per HTTP_KEEPALIVE_TIMEOUT secondi."""
+        self.connection.settimeout(HTTP_KEEPALIVE_TIMEOUT)
+        try:
+            # peek restituisce subito i byte già nel buffer (richieste in pipeline)
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(None)
+    
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        
         parsed = urlparse(self.path)
         path = parsed.path
         params = parse_qs(parsed.query)
         
+        if path == '/api/book' or path.startswith('/api/book/'):
+            self.book_detail(path, params)
+            return
+
+        if path == '/api/stats':
+            self._send_json({
+                "db_pool": get_pool_stats(),
+                "catalogo": get_catalog_stats(),
+                "suggest": _suggest_stats,
+                "embedding_cache": embedding_cache.get_stats(),
+                "intent_cache": intent_cache.get_stats(),
+                "fast_path": get_fastpath_stats(),
+                "speculative": _speculative_stats,
+                "response_cache": response_cache.get_stats(),
+                "book_cache": book_cache.get_stats() if book_cache is not None else None
+            })
+            return
+
         # NEW: /api/suggest endpoint
         if path == '/api/suggest':
             suggestion_type = params.get('type', ['artist'])[0]
             query = params.get('q', [''])[0]
-            limit = int(params.get('limit', ['10'])[0])
+            limit = clamp_limit(params.get('limit', ['10'])[0], 10)
+            
+            etag = suggest_etag(suggestion_type, query, limit)
+            if self._not_modified('suggest', etag):
+                return
             
             suggestions = get_suggestions(suggestion_type, query, limit)
             
-            self.wfile.write(json.dumps({
+            self._send_json({
                 "suggestions": suggestions
-            }).encode())
+            }, headers=http_cache_headers('suggest', etag))
             return
         
-        # Existing /api/search GET
+        # Existing /api/search GET (?direct=artist|author|title per la ricerca diretta)
         query = params.get('q', [''])[0]
-        limit = int(params.get('limit', ['10'])[0])
+        limit = clamp_limit(params.get('limit', ['10'])[0], 10)
+        fields = params.get('fields', [None])[0]
+        direct = params.get('direct', [None])[0]
+        if direct not in DIRECT_SEARCH_TYPES:
+            direct = None
         
         if not query:
-            self.wfile.write(json.dumps({
+            self._send_json({
                 "status": "ok",
                 "message": "Libro Search API v5 - Image Hash. Usa ?q=query per cercare."
-            }).encode())
+            })
             return
         
         try:
-            query_info = extract_name_from_query(query, None)
+            request = {'query': query, 'limit': limit, 'fields': fields}
+            if direct:
+                # Stessa chiave della POST con direct/searchType: la cache è condivisa
+                request.update(direct=True, searchType=direct)
+            cache_key = search_cache_key(request)
+            endpoint = 'direct' if direct else 'search'
+            etag = http_etag(cache_key, get_catalog_version())
+            if self._not_modified(endpoint, etag):
+                return
             
-            if query_info.get('tipo') == 'titolo':
-                title = query_info['titolo']
-                results = search_by_title(title, limit)
-                risposta = generate_response_for_title(title, results)
-                
-                self.wfile.write(json.dumps({
-                    "tipo_ricerca": "titolo",
-                    "titolo_cercato": title,
-                    "risposta": risposta,
-                    "risultati": results
-                }, default=str).encode())
-            elif query_info.get('tipo') == 'nome':
-                name = query_info['nome']
-                filters = {k: v for k, v in query_info.items() if k in ['lingua', 'anno_min', 'anno_max', 'tipo_pub']}
-                results = search_by_name(name, filters, limit)
-                risposta = generate_response_for_name(name, results, filters)
-                
-                all_results = (
-                    results['monografie_titolo'] + results['monografie'] + 
-                    results['collettive'] + results['come_autore'] + results['citazioni'][:20]
-                )
-                
-                self.wfile.write(json.dumps({
-                    "tipo_ricerca": "nome",
-                    "nome_cercato": name,
-                    "filtri": filters,
-                    "risposta": risposta,
-                    "risultati": all_results,
-                    "filtri_disponibili": results.get('filtri_disponibili', {}),
-                    "conteggi": {
-                        "monografie": len(results['monografie_titolo']) + len(results['monografie']),
-                        "collettive": len(results['collettive']),
-                        "come_autore": len(results['come_autore']),
-                        "citazioni": len(results['citazioni']),
-                        "totale": results['totale']
-                    }
-                }, default=str).encode())
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                self._send_body(cached, headers=http_cache_headers(endpoint, etag))
+                return
+            
+            if direct:
+                payload = run_direct_search(query, direct, limit, book_fields(fields))
             else:
-                results = search_semantic(query, limit)
-                response_data = generate_response_semantic(query, results)
-                
-                self.wfile.write(json.dumps({
-                    "tipo_ricerca": "semantica",
-                    "risposta": response_data["risposta"],
-                    "suggerimenti": response_data.get("suggerimenti", []),
-                    "risultati": results
-                }, default=str).encode())
+                payload, reply = run_ai_search(query, None, limit, fields=book_fields(fields))
+                payload.update(reply.complete())
+            self._send_json(payload, cache_key=cache_key, headers=http_cache_headers(endpoint, etag))
                 
         except Exception as e:
-            self.wfile.write(json.dumps({"error": str(e)}).encode())
+            self._send_json({"error": str(e)})
     
-    def do_POST(self):
+    def book_detail(self, path: str, params: dict):
+        """GET /api/book/<id> (un libro) o /api/book?ids=1,2,3 (più libri), con ?fields= opzionale."""
+        single = path.startswith('/api/book/')
+        raw_ids = [path[len('/api/book/'):]] if single else params.get('ids', []) + params.get('id', [])
+        try:
+            ids = list(dict.fromkeys(int(value) for raw in raw_ids for value in raw.split(',') if value.strip()))
+        except ValueError:
+            self._send_error_json(400, "Id non valido")
+            return
+        if not ids:
+            self._send_error_json(400, "Indica almeno un id")
+            return
+        if len(ids) > BOOK_DETAIL_MAX_IDS:
+            self._send_error_json(400, f"Al massimo {BOOK_DETAIL_MAX_IDS} id per richiesta")
+            return
+        
+        try:
+            books = fetch_books(ids, book_fields(params.get('fields', [None])[0], DETAIL_FIELDS))
+        except Exception as e:
+            self._send_error_json(500, str(e))
+            return
+        
+        if single:
+            if not books:
+                self._send_error_json(404, "Libro non trovato")
+                return
+            self._send_json({"libro": books[0]})
+        else:
+            found = {book['id'] for book in books}
+            self._send_json({"libri": books, "mancanti": [book_id for book_id in ids if book_id not in found]})
+    
+    def _send_body(self, body: bytes, status: int = 200, content_type: str = 'application/json',
+                   headers: dict = None):
+        """Invia una risposta completa, compressa se il client lo accetta e ne vale la pena."""
+        encoding = None
+        if len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding', ''))
+        if encoding:
+            body = compress_body(body, encoding)
+        
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_json(self, payload, status: int = 200, cache_key: str = None, headers: dict = None):
+        """Serializza e invia il payload; se la richiesta ha una chiave, lo mette in cache."""
+        body = dumps_json(payload)
+        if status == 200:
+            response_cache.set(cache_key, body)
+        self._send_body(body, status, headers=headers)
+    
+    def _not_modified(self, endpoint: str, etag: str) -> bool:
+        """Risponde 304 se il client ha già la risposta con questo ETag."""
+        if not etag_matches(self.headers.get('If-None-Match'), etag):
+            return False
+        self.send_response(304)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Vary', 'Accept-Encoding')
+        for name, value in http_cache_headers(endpoint, etag).items():
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        return True
+    
+    def _send_error_json(self, status: int, message: str):
+        self._send_json({"error": message}, status)
+    
+    def _start_stream(self, content_type: str):
+        """Header di una risposta a eventi: chunked su HTTP/1.1, altrimenti chiusa a fine stream."""
+        self._chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
         self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
         self.send_header('Access-Control-Allow-Origin', '*')
+        if self._chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
         self.end_headers()
+    
+    def _write_stream(self, data: bytes):
+        """Scrive un pezzo dello stream e lo spinge subito al client."""
+        if self._chunked:
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+        self.wfile.write(data)
+        self.wfile.flush()
+    
+    def _end_stream(self):
+        if self._chunked:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+    
+    def _send_event(self, stream_format: str, event: str, payload: dict):
+        """Scrive un evento dello stream."""
+        if stream_format == 'sse':
+            chunk = b"event: " + event.encode() + b"\ndata: " + dumps_json(payload) + b"\n\n"
+        else:
+            chunk = dumps_json({"evento": event, **payload}) + b"\n"
+        self._write_stream(chunk)
+    
+    def stream_ai_search(self, data: dict, stream_format: str, cache_key: str = None):
+        """Ricerca AI in streaming: prima i risultati, poi il testo man mano che arriva."""
+        self._start_stream(STREAM_CONTENT_TYPES[stream_format])
+        
+        try:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                # Risposta già pronta: stessi eventi, con il testo in un solo pezzo
+                payload = json.loads(cached)
+                result = {k: payload.pop(k) for k in ('risposta', 'suggerimenti') if k in payload}
+                self._send_event(stream_format, 'risultati', payload)
+                self._send_event(stream_format, 'testo', {"delta": result.get('risposta', '')})
+                self._send_event(stream_format, 'fine', result)
+                self._end_stream()
+                return
+            
+            payload, reply = run_ai_search(data.get('query', ''), data.get('context', {}),
+                                           clamp_limit(data.get('limit', 50), 50),
+                                           data.get('semanticBackend'), book_fields(data.get('fields')))
+            self._send_event(stream_format, 'risultati', payload)
+            
+            for delta in reply.stream():
+                self._send_event(stream_format, 'testo', {"delta": delta})
+            
+            self._send_event(stream_format, 'fine', reply.result)
+            self._end_stream()
+            response_cache.set(cache_key, dumps_json({**payload, **reply.result}))
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            print("Client disconnesso durante lo streaming")
+        except Exception as e:
+            self._send_event(stream_format, 'errore', {"error": str(e)})
+            self._end_stream()
+    
+    def _read_upload(self, content_type: str):
+        """Legge un upload binario entro i limiti: restituisce (byte o memoryview dell'immagine, campi)."""
+        if self.headers.get('Content-Length') is None:
+            raise UploadError(411, "Content-Length richiesto")
+        length = int(self.headers['Content-Length'])
+        
+        if content_type.split(';')[0].strip().lower() == 'multipart/form-data':
+            boundary = multipart_boundary(content_type)
+            if length > IMAGE_UPLOAD_MAX_BYTES + 64 * 1024:
+                raise UploadError(413, "Immagine troppo grande")
+            parts = parse_multipart(self.rfile.read(length), boundary)
+            if 'image' not in parts:
+                raise UploadError(400, "Campo 'image' mancante")
+            image = parts['image'][1]
+            if len(image) > IMAGE_UPLOAD_MAX_BYTES:
+                raise UploadError(413, "Immagine troppo grande")
+            if sniff_image_format(bytes(image[:16])) is None:
+                raise UploadError(415, "Formato immagine non supportato")
+            fields = {name: bytes(parts[name][1]).decode('utf-8', 'replace')
+                      for name in MULTIPART_FIELDS if name in parts}
+            # La memoryview arriva fino a prepare_cover_image: nessuna copia dell'immagine
+            return image, fields
+        
+        if length > IMAGE_UPLOAD_MAX_BYTES:
+            raise UploadError(413, "Immagine troppo grande")
+        # Se il reader lo consente, i primi byte si guardano prima di leggere il resto
+        peek = getattr(self.rfile, 'peek', None)
+        head = peek(16)[:16] if peek else b''
+        if len(head) >= 12 and sniff_image_format(head) is None:
+            raise UploadError(415, "Formato immagine non supportato")
+        image = self.rfile.read(length)
+        if sniff_image_format(image[:16]) is None:
+            raise UploadError(415, "Formato immagine non supportato")
+        
+        params = parse_qs(urlparse(self.path).query)
+        fields = {name: params[key][0] for name, key in (('query', 'q'), ('limit', 'limit'), ('context', 'context'))
+                  if key in params}
+        return image, fields
+    
+    def image_upload_search(self, content_type: str):
+        """Ricerca per copertina con la foto inviata come file invece che in base64."""
+        try:
+            image, fields = self._read_upload(content_type)
+            limit = clamp_limit(fields.get('limit') or 50, 50)
+            context = json.loads(fields['context']) if fields.get('context') else {}
+        except UploadError as e:
+            # Il body può essere rimasto non letto: la connessione non è riutilizzabile
+            self.close_connection = True
+            self._send_error_json(e.status, str(e))
+            return
+        except ValueError as e:
+            self.close_connection = True
+            self._send_error_json(400, str(e))
+            return
+        
+        try:
+            result = run_image_search(fields.get('query', ''), context, image, limit)
+            self._send_json(result)
+        except Exception as e:
+            self._send_json({"error": str(e)})
+    
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding'):
+            # Il body chunked non viene decodificato: resterebbe sulla connessione
+            # e sarebbe letto come richiesta successiva
+            self.close_connection = True
+            self._send_error_json(411, "Content-Length richiesto")
+            return
+        
+        content_type = self.headers.get('Content-Type', '')
+        if is_binary_upload(content_type):
+            self.image_upload_search(content_type)
+            return
         
         content_length = int(self.headers.get('Content-Length', 0))
+        if content_length > JSON_BODY_MAX_BYTES:
+            self.close_connection = True
+            self._send_error_json(413, "Richiesta troppo grande")
+            return
         body = self.rfile.read(content_length)
         
         try:
             data = json.loads(body)
+        except ValueError as e:
+            self._send_json({"error": str(e)})
+            return
+        
+        try:
+            cache_key = search_cache_key(data)
+        except (AttributeError, TypeError, ValueError):
+            cache_key = None
+        
+        stream_format = data.get('stream') if isinstance(data, dict) else None
+        if (stream_format in STREAM_CONTENT_TYPES and data.get('query')
+                and not data.get('image') and not data.get('direct')
+                and not data.get('mode') and not data.get('filters') and not data.get('cursors')):
+            self.stream_ai_search(data, stream_format, cache_key)
+            return
+        
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            self._send_body(cached)
+            return
+        
+        try:
             query = data.get('query', '')
-            limit = data.get('limit', 50)
+            limit = clamp_limit(data.get('limit', 50), 50)
             direct = data.get('direct', False)
             search_type = data.get('searchType', None)
             direct_filters = data.get('filters', None)
             mode = data.get('mode', None)
             image_base64 = data.get('image', None)  # NUOVO: supporto immagine
+            cursors = data.get('cursors') if isinstance(data.get('cursors'), dict) else None
+            fields = book_fields(data.get('fields'))
             
             # Se c'è un'immagine ma nessuna query, è ok (ricerca solo per immagine)
             if not query and not image_base64:
-                self.wfile.write(json.dumps({"error": "Query richiesta"}).encode())
+                self._send_json({"error": "Query richiesta"})
                 return
             
             # NEW: Direct search (no AI)
             if direct:
-                if search_type == 'artist':
-                    result = search_direct_artist(query, limit)
-                    self.wfile.write(json.dumps({
-                        "tipo_ricerca": "diretto",
-                        "nome_cercato": query,
-                        "risultati": result['risultati'],
-                        "conteggi": result['conteggi']
-                    }, default=str).encode())
-                    return
-                    
-                elif search_type == 'author':
-                    result = search_direct_author(query, limit)
-                    self.wfile.write(json.dumps({
-                        "tipo_ricerca": "diretto",
-                        "nome_cercato": query,
-                        "risultati": result['risultati'],
-                        "conteggi": result['conteggi']
-                    }, default=str).encode())
-                    return
-                    
-                elif search_type == 'title':
-                    result = search_direct_title(query, limit)
-                    self.wfile.write(json.dumps({
-                        "tipo_ricerca": "diretto",
-                        "titolo_cercato": query,
-                        "risultati": result['risultati'],
-                        "conteggi": result['conteggi']
-                    }, default=str).encode())
+                payload = run_direct_search(query, search_type, limit, fields, cursors)
+                if payload is not None:
+                    self._send_json(payload, cache_key=cache_key)
                     return
             
             # Comment mode
@@ -1196,34 +3489,36 @@ class handler(BaseHTTPRequestHandler):
                 original_query = data.get('originalQuery', '')
                 risposta = generate_comment_response(query, filtered_books, original_query)
                 
-                self.wfile.write(json.dumps({
+                self._send_json({
                     "tipo_ricerca": "commento",
                     "risposta": risposta,
                     "risultati": filtered_books
-                }, default=str).encode())
+                })
                 return
             
             # Refined mode
             if mode == 'refined':
                 original_query = data.get('originalQuery', '')
                 refinement = data.get('refinement', '')
-                results = search_semantic(query, limit)
+                results = retrieve_semantic(query, limit, data.get('semanticBackend'), fields)
                 risposta = generate_refined_response(refinement, results, original_query)
                 
-                self.wfile.write(json.dumps({
+                self._send_json({
                     "tipo_ricerca": "affinata",
                     "risposta": risposta,
                     "risultati": results,
                     "suggerimenti": []
-                }, default=str).encode())
+                }, cache_key=cache_key)
                 return
             
-            # Direct filters (existing)
-            if direct_filters:
+            # Direct filters (existing), e pagine successive della ricerca per nome
+            if direct_filters or cursors:
                 name = query
-                results = search_by_name(name, direct_filters, limit)
+                direct_filters = direct_filters or {}
+                results = search_by_name(name, direct_filters, limit, cursors, fields)
+                page = name_result_fields(results)
                 
-                totale = results['totale']
+                totale = results.get('totale')
                 filter_desc = []
                 if direct_filters.get('lingua'):
                     lang_names = {'IT': 'in italiano', 'EN': 'in inglese', 'DE': 'in tedesco', 'FR': 'in francese'}
@@ -1233,109 +3528,36 @@ class handler(BaseHTTPRequestHandler):
                     filter_desc.append(tipo_names.get(direct_filters['tipo_pub'], direct_filters['tipo_pub']))
                 
                 filter_text = ', '.join(filter_desc) if filter_desc else ''
-                risposta = f"{totale} risultati per {name} {filter_text}." if totale > 0 else f"Nessun risultato per {name} {filter_text}."
+                if totale is None:
+                    risposta = f"Altri {len(page['risultati'])} risultati per {name} {filter_text}."
+                elif totale > 0:
+                    risposta = f"{totale} risultati per {name} {filter_text}."
+                else:
+                    risposta = f"Nessun risultato per {name} {filter_text}."
                 
-                all_results = (
-                    results['monografie_titolo'] + results['monografie'] + 
-                    results['collettive'] + results['come_autore'] + results['citazioni'][:20]
-                )
-                
-                self.wfile.write(json.dumps({
+                self._send_json({
                     "tipo_ricerca": "nome",
                     "nome_cercato": name,
                     "filtri": direct_filters,
                     "risposta": risposta,
-                    "risultati": all_results,
-                    "filtri_disponibili": results.get('filtri_disponibili', {}),
-                    "conteggi": {
-                        "monografie": len(results['monografie_titolo']) + len(results['monografie']),
-                        "collettive": len(results['collettive']),
-                        "come_autore": len(results['come_autore']),
-                        "citazioni": len(results['citazioni']),
-                        "totale": results['totale']
-                    }
-                }, default=str).encode())
+                    **page
+                }, cache_key=cache_key)
                 return
             
             # AI-powered search (con supporto immagine ibrido)
             context = data.get('context', {})
-            query_info = extract_name_from_query(query, context, image_base64)
             
             # Se c'è un'immagine, usa la ricerca ibrida
             if image_base64:
-                image_search_result = search_by_image_hybrid(query_info, image_base64, limit)
-                
-                risposta = generate_response_for_image_search(image_search_result, query_info)
-                
-                risultati = []
-                for c in image_search_result['candidati'][:20]:
-                    risultati.append({
-                        'id': c['id'],
-                        'titolo': c['titolo'],
-                        'editore': c.get('editore', ''),
-                        'anno': c.get('anno', ''),
-                        'immagine': c.get('immagine', ''),
-                        'confidence': c.get('confidence', 'bassa'),
-                        'image_match': c.get('image_match', False)
-                    })
-                
-                self.wfile.write(json.dumps({
-                    "tipo_ricerca": "immagine",
-                    "risposta": risposta,
-                    "risultati": risultati,
-                    "best_match": image_search_result.get('best_match'),
-                    "search_term": image_search_result.get('search_term'),
-                    "total_candidates": image_search_result.get('total_candidates', 0)
-                }, default=str).encode())
+                result = run_image_search(query, context, image_base64, limit)
+                self._send_json(result)
                 return
             
-            if query_info.get('tipo') == 'titolo':
-                title = query_info['titolo']
-                results = search_by_title(title, limit)
-                risposta = generate_response_for_title(title, results)
-                
-                self.wfile.write(json.dumps({
-                    "tipo_ricerca": "titolo",
-                    "titolo_cercato": title,
-                    "risposta": risposta,
-                    "risultati": results
-                }, default=str).encode())
-            elif query_info.get('tipo') == 'nome':
-                name = query_info['nome']
-                filters = {k: v for k, v in query_info.items() if k in ['lingua', 'anno_min', 'anno_max', 'tipo_pub']}
-                results = search_by_name(name, filters, limit)
-                risposta = generate_response_for_name(name, results, filters)
-                
-                all_results = (
-                    results['monografie_titolo'] + results['monografie'] + 
-                    results['collettive'] + results['come_autore'] + results['citazioni'][:20]
-                )
-                
-                self.wfile.write(json.dumps({
-                    "tipo_ricerca": "nome",
-                    "nome_cercato": name,
-                    "filtri": filters,
-                    "risposta": risposta,
-                    "risultati": all_results,
-                    "filtri_disponibili": results.get('filtri_disponibili', {}),
-                    "conteggi": {
-                        "monografie": len(results['monografie_titolo']) + len(results['monografie']),
-                        "collettive": len(results['collettive']),
-                        "come_autore": len(results['come_autore']),
-                        "citazioni": len(results['citazioni']),
-                        "totale": results['totale']
-                    }
-                }, default=str).encode())
-            else:
-                results = search_semantic(query, limit)
-                response_data = generate_response_semantic(query, results)
-                
-                self.wfile.write(json.dumps({
-                    "tipo_ricerca": "semantica",
-                    "risposta": response_data["risposta"],
-                    "suggerimenti": response_data.get("suggerimenti", []),
-                    "risultati": results
-                }, default=str).encode())
+            payload, reply = run_ai_search(query, context, limit, data.get('semanticBackend'), fields)
+            payload.update(reply.complete())
+            self._send_json(payload, cache_key=cache_key)
                 
+        except CursorError as e:
+            self._send_error_json(400, str(e))
         except Exception as e:
-            self.wfile.write(json.dumps({"error": str(e)}).encode())
+            self._send_json({"error": str(e)})
@@ -1,14 +1,339 @@
 from http.server import HTTPServer
 import sys
 import os
+import queue
+import selectors
+import signal
+import socket
+import socketserver
+import threading
+import time
 
 # Aggiungi la cartella api al path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'api'))
 
+import search
 from search import handler
 
+# single = HTTPServer originale (una richiesta alla volta)
+# threaded = pool di thread con coda limitata
+# prefork = più processi worker sulla stessa porta (SO_REUSEPORT), ognuno con il suo pool di thread
+SERVER_MODE = os.environ.get("SERVER_MODE", "threaded")
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", "16"))
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "2"))
+SERVER_QUEUE_SIZE = int(os.environ.get("SERVER_QUEUE_SIZE", "64"))
+SERVER_SHUTDOWN_TIMEOUT = float(os.environ.get("SERVER_SHUTDOWN_TIMEOUT", "30"))
+# Prefork: un worker che esce prima di WORKER_STABLE_SECONDS conta come crash;
+# i riavvii dopo crash consecutivi aspettano 0.5, 1, 2... secondi (al massimo
+# WORKER_RESPAWN_MAX_DELAY) e oltre WORKER_MAX_CRASHES il supervisore si ferma
+WORKER_STABLE_SECONDS = float(os.environ.get("WORKER_STABLE_SECONDS", "30"))
+WORKER_RESPAWN_MAX_DELAY = float(os.environ.get("WORKER_RESPAWN_MAX_DELAY", "30"))
+WORKER_MAX_CRASHES = int(os.environ.get("WORKER_MAX_CRASHES", "10"))
+
+OVERLOADED_RESPONSE = (
+    b"HTTP/1.0 503 Service Unavailable\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Access-Control-Allow-Origin: *\r\n"
+    b"Retry-After: 1\r\n"
+    b"Content-Length: 33\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b'{"error": "Server sovraccarico"}\n'
+)
+
+
+class PooledRequestHandler(handler):
+    """Serve una richiesta per turno: tra una richiesta e l'altra la connessione
+    keep-alive aspetta nel selettore di PooledHTTPServer invece di occupare un thread."""
+    
+    def handle(self):
+        self.handle_one_request()
+    
+    def finish(self):
+        # I file restano aperti finché la connessione è parcheggiata
+        if self.close_connection:
+            self.close()
+    
+    def close(self):
+        if not self.wfile.closed:
+            super().finish()
+    
+    def has_pending_input(self) -> bool:
+        """True se la richiesta successiva (pipeline) è già nel buffer o sul socket."""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            # Connessione in errore: la prossima lettura lo scopre e la chiude
+            return True
+        finally:
+            self.connection.setblocking(True)
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer con un numero fisso di thread e una coda di richieste limitata.
+    
+    Le connessioni accettate quando la coda è piena ricevono subito un 503,
+    così una raffica di chiamate lente a Claude non accumula attese infinite.
+    Le connessioni keep-alive inattive aspettano tutte in un selettore (un solo
+    thread) e tornano in coda quando arriva la richiesta successiva; dopo
+    HTTP_KEEPALIVE_TIMEOUT secondi di silenzio vengono chiuse.
+    """
+    
+    def __init__(self, server_address, handler_class, threads: int, queue_size: int,
+                 reuse_port: bool = False):
+        self.reuse_port = reuse_port
+        self._requests = queue.Queue(maxsize=queue_size)
+        self._parking = queue.SimpleQueue()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._closing = False
+        super().__init__(server_address, handler_class)
+        self._watcher = threading.Thread(target=self._watch_idle, name="http-idle", daemon=True)
+        self._watcher.start()
+        self._workers = [
+            threading.Thread(target=self._process_queue, name=f"http-{i}", daemon=True)
+            for i in range(threads)
+        ]
+        for worker in self._workers:
+            worker.start()
+    
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+    
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            try:
+                request.sendall(OVERLOADED_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+    
+    def _process_queue(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            if isinstance(item, tuple):
+                # Nuova connessione: il costruttore serve la prima richiesta
+                request, client_address = item
+                try:
+                    conn_handler = self.RequestHandlerClass(request, client_address, self)
+                except Exception:
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+                    continue
+            else:
+                conn_handler = item
+                try:
+                    conn_handler.handle_one_request()
+                except Exception:
+                    self.handle_error(conn_handler.request, conn_handler.client_address)
+                    conn_handler.close_connection = True
+            self._after_request(conn_handler)
+    
+    def _after_request(self, conn_handler):
+        if conn_handler.close_connection or self._closing:
+            self._close_connection(conn_handler)
+        elif conn_handler.has_pending_input():
+            self._dispatch(conn_handler)
+        else:
+            conn_handler.parked_at = time.monotonic()
+            self._parking.put(conn_handler)
+            self._wakeup()
+    
+    def _dispatch(self, conn_handler):
+        """Rimette in coda una connessione con una richiesta pronta da leggere."""
+        try:
+            self._requests.put_nowait(conn_handler)
+        except queue.Full:
+            try:
+                conn_handler.connection.sendall(OVERLOADED_RESPONSE)
+            except OSError:
+                pass
+            self._close_connection(conn_handler)
+    
+    def _close_connection(self, conn_handler):
+        conn_handler.close_connection = True
+        try:
+            conn_handler.close()
+        except Exception:
+            pass
+        self.shutdown_request(conn_handler.request)
+    
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+    
+    def _watch_idle(self):
+        """Thread del selettore: l'unico che lo modifica."""
+        while not self._closing:
+            for key, _ in self._selector.select(timeout=1):
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self._selector.unregister(key.fileobj)
+                self._dispatch(key.data)
+            
+            while True:
+                try:
+                    conn_handler = self._parking.get_nowait()
+                except queue.Empty:
+                    break
+                self._selector.register(conn_handler.connection, selectors.EVENT_READ, conn_handler)
+            
+            expired = time.monotonic() - search.HTTP_KEEPALIVE_TIMEOUT
+            for key in list(self._selector.get_map().values()):
+                if key.data is not None and key.data.parked_at < expired:
+                    self._selector.unregister(key.fileobj)
+                    self._close_connection(key.data)
+        
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                self._close_connection(key.data)
+        self._selector.close()
+    
+    def server_close(self):
+        """Chiude il socket, lascia finire le richieste già in coda e chiude le connessioni inattive."""
+        super().server_close()
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join(SERVER_SHUTDOWN_TIMEOUT)
+        self._closing = True
+        self._wakeup()
+        self._watcher.join(SERVER_SHUTDOWN_TIMEOUT)
+
+
+def install_shutdown_handlers(server):
+    """SIGTERM/SIGINT fermano il serve_forever senza interrompere le richieste in corso."""
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+
+def serve(server):
+    install_shutdown_handlers(server)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class CloseConnectionHandler(handler):
+    # Un solo thread: una connessione in attesa della richiesta successiva farebbe
+    # aspettare tutti gli altri client
+    protocol_version = "HTTP/1.0"
+
+
+def run_single(port):
+    server = HTTPServer(('0.0.0.0', port), CloseConnectionHandler)
+    print(f"Server running on port {port}")
+    server.serve_forever()
+
+
+def run_threaded(port):
+    search.init_worker()
+    server = PooledHTTPServer(('0.0.0.0', port), PooledRequestHandler, SERVER_THREADS, SERVER_QUEUE_SIZE)
+    print(f"Server running on port {port} ({SERVER_THREADS} thread, coda {SERVER_QUEUE_SIZE})")
+    serve(server)
+
+
+def run_worker(port):
+    # Processo figlio: client e pool propri, mai condivisi con il padre
+    search.init_worker()
+    server = PooledHTTPServer(('0.0.0.0', port), PooledRequestHandler, SERVER_THREADS, SERVER_QUEUE_SIZE,
+                              reuse_port=True)
+    print(f"Worker {os.getpid()} running on port {port}")
+    serve(server)
+
+
+def spawn_worker(port):
+    pid = os.fork()
+    if pid == 0:
+        # I worker riavviati nascono dopo che il padre ha installato il suo stop:
+        # fino a serve() il figlio deve morire con il segnale, non eseguirlo
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            run_worker(port)
+        except BaseException as e:
+            print(f"Worker {os.getpid()} terminato con errore: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def run_prefork(port):
+    stopping = False
+    failed = False
+    crashes = 0
+    children = {}
+    for _ in range(SERVER_WORKERS):
+        children[spawn_worker(port)] = time.monotonic()
+    print(f"Server running on port {port} ({SERVER_WORKERS} worker x {SERVER_THREADS} thread)")
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        
+        # Un worker che muore subito (import, bind) non deve trasformare il padre in un ciclo di fork
+        crashes = crashes + 1 if time.monotonic() - started < WORKER_STABLE_SECONDS else 0
+        if crashes > WORKER_MAX_CRASHES:
+            print(f"Worker {pid} uscito (status {status}): {crashes} crash consecutivi, arresto il server")
+            failed = True
+            stop(None, None)
+            continue
+        
+        delay = min(WORKER_RESPAWN_MAX_DELAY, 0.5 * 2 ** (crashes - 1)) if crashes else 0
+        print(f"Worker {pid} uscito (status {status}), lo riavvio" + (f" tra {delay:g}s" if delay else ""))
+        deadline = time.monotonic() + delay
+        while not stopping and time.monotonic() < deadline:
+            time.sleep(max(0, min(0.5, deadline - time.monotonic())))
+        if not stopping:
+            children[spawn_worker(port)] = time.monotonic()
+    
+    if failed:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    server = HTTPServer(('0.0.0.0', port), handler)
-    print(f"Server running on port {port}")
-    server.serve_forever()
\ No newline at end of file
+    if SERVER_MODE == "prefork":
+        run_prefork(port)
+    elif SERVER_MODE == "threaded":
+        run_threaded(port)
+    else:
+        run_single(port)
@@ -0,0 +1,60 @@
+-- Numero di artisti per libro, mantenuto da trigger su book_artists.
+-- La classificazione monografia/collettiva legge questa colonna invece di
+-- eseguire una COUNT(*) correlata per ogni libro candidato.
+
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS artist_count integer NOT NULL DEFAULT 0;
+
+-- Ricalcolo completo (book_ids NULL) o limitato ad alcuni libri: usato qui per
+-- il riempimento iniziale e dopo import massivi eseguiti con i trigger disabilitati.
+CREATE OR REPLACE FUNCTION public.refresh_books_artist_count(book_ids integer[] DEFAULT NULL)
+RETURNS integer AS $$
+DECLARE
+    updated integer;
+BEGIN
+    UPDATE public.books b
+    SET artist_count = COALESCE(c.n, 0)
+    FROM public.books b2
+    LEFT JOIN (
+        SELECT book_id, COUNT(*) AS n
+        FROM public.book_artists
+        WHERE book_ids IS NULL OR book_id = ANY(book_ids)
+        GROUP BY book_id
+    ) c ON c.book_id = b2.id
+    WHERE b.id = b2.id
+      AND (book_ids IS NULL OR b2.id = ANY(book_ids))
+      AND b.artist_count IS DISTINCT FROM COALESCE(c.n, 0);
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT public.refresh_books_artist_count();
+
+CREATE OR REPLACE FUNCTION public.books_artist_count_sync() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE public.books SET artist_count = artist_count + 1 WHERE id = NEW.book_id;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE public.books SET artist_count = artist_count - 1 WHERE id = OLD.book_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION public.books_artist_count_truncate() RETURNS trigger AS $$
+BEGIN
+    UPDATE public.books SET artist_count = 0 WHERE artist_count <> 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS book_artists_count_sync ON public.book_artists;
+CREATE TRIGGER book_artists_count_sync
+    AFTER INSERT OR DELETE OR UPDATE OF book_id ON public.book_artists
+    FOR EACH ROW EXECUTE FUNCTION public.books_artist_count_sync();
+
+DROP TRIGGER IF EXISTS book_artists_count_truncate ON public.book_artists;
+CREATE TRIGGER book_artists_count_truncate
+    AFTER TRUNCATE ON public.book_artists
+    FOR EACH STATEMENT EXECUTE FUNCTION public.books_artist_count_truncate();
@@ -0,0 +1,26 @@
+-- Indici trigram per i filtri LOWER(col) LIKE '%termine%' della ricerca lessicale.
+-- Sono indici su espressione: le query devono usare esattamente LOWER(col).
+-- CREATE INDEX (non CONCURRENTLY) perché la migrazione gira in una transazione;
+-- sul catalogo attuale il lock in scrittura dura pochi secondi.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS book_artists_artist_trgm_idx
+    ON public.book_artists USING gin (LOWER(artist) gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS book_authors_author_trgm_idx
+    ON public.book_authors USING gin (LOWER(author) gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS books_titolo_trgm_idx
+    ON public.books USING gin (LOWER(titolo) gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS books_descrizione_trgm_idx
+    ON public.books USING gin (LOWER(descrizione) gin_trgm_ops);
+
+-- Join dai nomi ai libri e trigger di artist_count
+CREATE INDEX IF NOT EXISTS book_artists_book_id_idx ON public.book_artists (book_id);
+CREATE INDEX IF NOT EXISTS book_authors_book_id_idx ON public.book_authors (book_id);
+
+ANALYZE public.books;
+ANALYZE public.book_artists;
+ANALYZE public.book_authors;
@@ -0,0 +1,37 @@
+-- Versione del catalogo: un contatore incrementato da ogni modifica a libri,
+-- artisti e autori. Le cache delle risposte la includono nella chiave, così
+-- dopo un import nessuna risposta calcolata sul catalogo precedente viene riusata.
+
+CREATE TABLE IF NOT EXISTS public.catalog_version (
+    id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version bigint NOT NULL DEFAULT 1,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+INSERT INTO public.catalog_version (id) VALUES (1) ON CONFLICT (id) DO NOTHING;
+
+-- Trigger per statement: un import da migliaia di righe incrementa la versione una volta sola.
+-- Eccezione: gli import su book_artists aggiornano books.artist_count riga per riga
+-- (trigger di 001), e ogni UPDATE incrementava la versione; la 007 sostituisce il
+-- trigger su books per ignorare gli UPDATE delle sole colonne derivate.
+CREATE OR REPLACE FUNCTION public.bump_catalog_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE public.catalog_version SET version = version + 1, updated_at = now() WHERE id = 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS books_catalog_version ON public.books;
+CREATE TRIGGER books_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.books
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_catalog_version();
+
+DROP TRIGGER IF EXISTS book_artists_catalog_version ON public.book_artists;
+CREATE TRIGGER book_artists_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.book_artists
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_catalog_version();
+
+DROP TRIGGER IF EXISTS book_authors_catalog_version ON public.book_authors;
+CREATE TRIGGER book_authors_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.book_authors
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_catalog_version();
@@ -0,0 +1,7 @@
+-- Hash percettivi aggiuntivi delle copertine (difference, perceptual/DCT, colore),
+-- affiancati all'average hash di image_hash. Sono interi a 64 bit memorizzati
+-- come bigint con segno; vanno riempiti con scripts/backfill_cover_fingerprints.py.
+
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS hash_difference bigint;
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS hash_perceptual bigint;
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS hash_color bigint;
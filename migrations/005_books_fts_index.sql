@@ -0,0 +1,8 @@
+-- Indice full-text su titolo + descrizione per la ricerca ibrida (FTS + vettori).
+-- L'espressione deve restare identica a BOOKS_FTS_EXPRESSION in api/search.py,
+-- altrimenti il planner non usa l'indice.
+
+CREATE INDEX IF NOT EXISTS books_fts_italian_idx ON public.books
+    USING gin (to_tsvector('italian', COALESCE(titolo, '') || ' ' || COALESCE(descrizione, '')));
+
+ANALYZE public.books;
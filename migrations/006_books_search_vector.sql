@@ -0,0 +1,68 @@
+-- Colonna tsvector mantenuta da trigger su titolo + descrizione, per le menzioni
+-- della ricerca per nome (phrase search al posto di LIKE '%nome%' sulle descrizioni)
+-- e per la parte full-text della ricerca ibrida. Sostituisce l'indice di 005.
+--
+-- Ogni testo è indicizzato con le configurazioni italian, english e simple: le
+-- prime due per le parole del linguaggio naturale, simple (senza stemming) per i
+-- nomi propri. Il titolo pesa A, la descrizione B, così ts_rank favorisce i libri
+-- con il nome nel titolo. Gli accenti sono rimossi con unaccent se l'estensione è
+-- disponibile; api/search.py applica la stessa public.search_unaccent alle query.
+
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS unaccent;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'unaccent non disponibile: la colonna search_vector mantiene gli accenti';
+END
+$$;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'unaccent') THEN
+        EXECUTE $f$
+            CREATE OR REPLACE FUNCTION public.search_unaccent(text) RETURNS text AS
+            $body$ SELECT public.unaccent('public.unaccent'::regdictionary, COALESCE($1, '')) $body$
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        $f$;
+    ELSE
+        EXECUTE $f$
+            CREATE OR REPLACE FUNCTION public.search_unaccent(text) RETURNS text AS
+            $body$ SELECT COALESCE($1, '') $body$
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        $f$;
+    END IF;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION public.books_search_vector(titolo text, descrizione text) RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('simple', public.search_unaccent(COALESCE(titolo, ''))), 'A')
+        || setweight(to_tsvector('italian', public.search_unaccent(COALESCE(titolo, ''))), 'A')
+        || setweight(to_tsvector('english', public.search_unaccent(COALESCE(titolo, ''))), 'A')
+        || setweight(to_tsvector('simple', public.search_unaccent(COALESCE(descrizione, ''))), 'B')
+        || setweight(to_tsvector('italian', public.search_unaccent(COALESCE(descrizione, ''))), 'B')
+        || setweight(to_tsvector('english', public.search_unaccent(COALESCE(descrizione, ''))), 'B')
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+CREATE OR REPLACE FUNCTION public.books_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := public.books_search_vector(NEW.titolo, NEW.descrizione);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS books_search_vector ON public.books;
+CREATE TRIGGER books_search_vector
+    BEFORE INSERT OR UPDATE OF titolo, descrizione ON public.books
+    FOR EACH ROW EXECUTE FUNCTION public.books_search_vector_update();
+
+UPDATE public.books
+SET search_vector = public.books_search_vector(titolo, descrizione)
+WHERE search_vector IS NULL;
+
+CREATE INDEX IF NOT EXISTS books_search_vector_idx ON public.books USING gin (search_vector);
+
+DROP INDEX IF EXISTS public.books_fts_italian_idx;
+
+ANALYZE public.books;
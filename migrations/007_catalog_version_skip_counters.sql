@@ -0,0 +1,36 @@
+-- La versione del catalogo (003) non cambia più per gli UPDATE su books che
+-- toccano solo colonne derivate. Il trigger per riga di 001 esegue un
+-- UPDATE books SET artist_count = ... per ogni riga importata in book_artists,
+-- e ognuno faceva scattare il trigger per statement di books: un import di N
+-- righe incrementava la versione N volte, serializzando ogni scrittura
+-- sull'unica riga di catalog_version. L'import stesso la incrementa già una
+-- volta tramite il trigger su book_artists.
+--
+-- Gli UPDATE su books confrontano le righe prima e dopo (transition table)
+-- ignorando artist_count e search_vector, mantenute da trigger: la versione
+-- sale una volta per statement e solo se è cambiato davvero qualcos'altro.
+
+CREATE OR REPLACE FUNCTION public.bump_catalog_version_books_update() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (
+        SELECT to_jsonb(n) - 'artist_count' - 'search_vector' FROM new_rows n
+        EXCEPT
+        SELECT to_jsonb(o) - 'artist_count' - 'search_vector' FROM old_rows o
+    ) THEN
+        UPDATE public.catalog_version SET version = version + 1, updated_at = now() WHERE id = 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Le transition table richiedono un trigger per un solo evento: UPDATE separato
+DROP TRIGGER IF EXISTS books_catalog_version ON public.books;
+CREATE TRIGGER books_catalog_version
+    AFTER INSERT OR DELETE OR TRUNCATE ON public.books
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_catalog_version();
+
+DROP TRIGGER IF EXISTS books_catalog_version_update ON public.books;
+CREATE TRIGGER books_catalog_version_update
+    AFTER UPDATE ON public.books
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.bump_catalog_version_books_update();
@@ -0,0 +1,97 @@
+"""Calcola le impronte delle copertine (migrations/004) per i libri che non le hanno.
+
+Scarica ogni permalinkimmagine, calcola i quattro hash con la stessa funzione
+usata dalla ricerca per immagine e aggiorna hash_difference, hash_perceptual e
+hash_color. image_hash viene scritto solo se mancante, a meno di --rehash.
+
+Uso: NEON_DATABASE_URL=postgresql://... python scripts/backfill_cover_fingerprints.py [--batch 200] [--workers 8] [--limit N] [--rehash]
+"""
+import argparse
+import os
+import sys
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import psycopg2
+from PIL import Image
+import search
+
+
+def fingerprint_url(url: str, timeout: float):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            data = response.read()
+        with Image.open(BytesIO(data)) as img:
+            return search.compute_fingerprint(img)
+    except Exception as e:
+        print(f"  {url}: {e}")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=15)
+    parser.add_argument('--rehash', action='store_true', help="riscrive anche image_hash")
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ.get("NEON_DATABASE_URL"))
+    done = failed = 0
+    # Libri con immagine non scaricabile: saltati per il resto dell'esecuzione
+    skipped = []
+    
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            while args.limit is None or done + failed < args.limit:
+                size = args.batch if args.limit is None else min(args.batch, args.limit - done - failed)
+                with conn, conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT id, permalinkimmagine
+                        FROM public.books
+                        WHERE hash_perceptual IS NULL
+                          AND COALESCE(permalinkimmagine, '') <> ''
+                          AND NOT (id = ANY(%s))
+                        ORDER BY id
+                        LIMIT %s
+                    """, (skipped, size))
+                    rows = cur.fetchall()
+                if not rows:
+                    break
+                
+                fingerprints = executor.map(lambda row: fingerprint_url(row[1], args.timeout), rows)
+                updates = []
+                for (book_id, _), fingerprint in zip(rows, fingerprints):
+                    if fingerprint is None:
+                        skipped.append(book_id)
+                        failed += 1
+                        continue
+                    updates.append((
+                        search.fingerprint_hex(fingerprint),
+                        search.to_signed64(fingerprint['difference']),
+                        search.to_signed64(fingerprint['perceptual']),
+                        search.to_signed64(fingerprint['color']),
+                        book_id,
+                    ))
+                
+                image_hash = "%s" if args.rehash else "COALESCE(image_hash, %s)"
+                # Un batch per transazione: la versione del catalogo sale una volta per UPDATE
+                with conn, conn.cursor() as cur:
+                    cur.executemany(f"""
+                        UPDATE public.books
+                        SET image_hash = {image_hash}, hash_difference = %s,
+                            hash_perceptual = %s, hash_color = %s
+                        WHERE id = %s
+                    """, updates)
+                done += len(updates)
+                print(f"Impronte calcolate: {done}, errori: {failed}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Recall e latenza della ricerca semantica ANN rispetto alla ricerca esatta.
+
+Usa come query gli embedding di libri presi a caso (nessuna chiamata a Voyage),
+calcola il top-k esatto con gli indici disabilitati e lo confronta con la query
+di search_semantic a diversi valori di ef_search (HNSW) o probes (IVFFlat).
+
+Uso: NEON_DATABASE_URL=postgresql://... python scripts/bench_vector_recall.py
+         [--queries 50] [--k 10] [--ef-search 10,20,40,80,160] [--probes 1,5,10,20]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import psycopg2
+import search
+
+
+def sample_vectors(cur, count: int) -> list:
+    cur.execute("""
+        SELECT embedding::text FROM public.books
+        WHERE embedding IS NOT NULL
+        ORDER BY random()
+        LIMIT %s
+    """, (count,))
+    return [array('f', (float(x) for x in row[0].strip('[]').split(','))) for row in cur.fetchall()]
+
+
+def exact_ids(cur, vector: array, k: int) -> list:
+    sql, params = search.build_semantic_query(vector, k)
+    cur.execute("BEGIN")
+    cur.execute("SET LOCAL enable_indexscan = off")
+    cur.execute("SET LOCAL enable_bitmapscan = off")
+    cur.execute(sql, params)
+    ids = [row[0] for row in cur.fetchall()]
+    cur.execute("COMMIT")
+    return ids
+
+
+def run(cur, vectors: list, truth: list, k: int, **settings) -> tuple:
+    recalls, latencies = [], []
+    for vector, expected in zip(vectors, truth):
+        sql, params = search.build_semantic_query(vector, k)
+        started = time.perf_counter()
+        rows = search.execute_vector_query(cur, sql, params, k, **settings)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found = {row[0] for row in rows}
+        recalls.append(len(found & set(expected)) / max(len(expected), 1))
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return statistics.mean(recalls), statistics.median(latencies), p95
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--ef-search', default='10,20,40,80,160')
+    parser.add_argument('--probes', default='1,5,10,20')
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ.get("NEON_DATABASE_URL"))
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            vectors = sample_vectors(cur, args.queries)
+            if not vectors:
+                print("Nessun embedding nel catalogo.")
+                return
+            
+            started = time.perf_counter()
+            truth = [exact_ids(cur, vector, args.k) for vector in vectors]
+            exact_ms = (time.perf_counter() - started) * 1000 / len(vectors)
+            print(f"{len(vectors)} query, k={args.k}; ricerca esatta: {exact_ms:.1f} ms/query")
+            
+            cur.execute("""
+                SELECT am.amname FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                JOIN pg_am am ON am.oid = c.relam
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+                WHERE i.indrelid = 'public.books'::regclass AND a.attname = 'embedding'
+            """)
+            methods = {row[0] for row in cur.fetchall()}
+            if not methods:
+                print("Nessun indice ANN su books.embedding: esegui scripts/provision_vector_index.py")
+                return
+            
+            print(f"{'parametro':<16}{'recall':>8}{'p50 ms':>10}{'p95 ms':>10}")
+            if 'hnsw' in methods:
+                for value in (int(v) for v in args.ef_search.split(',')):
+                    recall, p50, p95 = run(cur, vectors, truth, args.k, ef_search=value)
+                    print(f"{'ef_search=' + str(value):<16}{recall:>8.3f}{p50:>10.1f}{p95:>10.1f}")
+            if 'ivfflat' in methods:
+                for value in (int(v) for v in args.probes.split(',')):
+                    recall, p50, p95 = run(cur, vectors, truth, args.k, probes=value)
+                    print(f"{'probes=' + str(value):<16}{recall:>8.3f}{p50:>10.1f}{p95:>10.1f}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Verifica che le query lessicali più frequenti usino gli indici trigram.
+
+Esegue EXPLAIN sulle query costruite da api/search.py con termini di esempio e
+fallisce (exit 1) se compare un Seq Scan su una tabella del catalogo con più di
+--min-rows righe stimate. Sotto quella soglia il seq scan è la scelta corretta
+del planner e viene solo segnalato.
+
+Uso: NEON_DATABASE_URL=postgresql://... python scripts/check_query_plans.py [--min-rows 10000]
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import psycopg2
+import search
+
+CATALOG_TABLES = ('books', 'book_artists', 'book_authors')
+
+
+def hot_queries(term: str, name: str) -> dict:
+    return {
+        'search_by_name': search.build_name_search_query(name, {}),
+        'search_by_name (filtri)': search.build_name_search_query(name, {'lingua': 'EN', 'anno_min': 2000}),
+        'search_direct_artist': search.build_name_search_query(name, include_authors=False),
+        'search_by_name conteggi': search.build_name_counts_query(name, {}),
+        'search_by_title': search.build_title_search_query(term, 20),
+        'search_direct_title': search.build_title_search_query(term, 50, with_tipo=True),
+        'get_suggestions artist': search.build_suggest_query('artist', name[:4], 10),
+        'get_suggestions author': search.build_suggest_query('author', name[:4], 10),
+    }
+
+
+def seq_scans(plan: dict):
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan.get('Relation Name')
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--min-rows', type=int, default=10000)
+    parser.add_argument('--term', default='fotografia')
+    parser.add_argument('--name', default='Bruce Nauman')
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ.get("NEON_DATABASE_URL"))
+    conn.autocommit = True
+    failures = 0
+    
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT relname, reltuples::bigint FROM pg_class
+            WHERE relname = ANY(%s) AND relnamespace = 'public'::regnamespace
+        """, (list(CATALOG_TABLES),))
+        table_rows = dict(cur.fetchall())
+        
+        for label, (sql, params) in hot_queries(args.term, args.name).items():
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            
+            scanned = [t for t in seq_scans(plan[0]['Plan']) if t in CATALOG_TABLES]
+            large = [t for t in scanned if table_rows.get(t, 0) >= args.min_rows]
+            
+            if large:
+                failures += 1
+                print(f"FAIL  {label}: seq scan su {', '.join(sorted(set(large)))}")
+            elif scanned:
+                print(f"ok    {label} (seq scan su tabelle piccole: {', '.join(sorted(set(scanned)))})")
+            else:
+                print(f"ok    {label}")
+    
+    conn.close()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Applica in ordine le migrazioni SQL di migrations/ non ancora eseguite.
+
+Uso: NEON_DATABASE_URL=postgresql://... python scripts/migrate.py [--dry-run]
+"""
+import os
+import sys
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), '..', 'migrations')
+
+
+def pending_migrations(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.schema_migrations (
+            name text PRIMARY KEY,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("SELECT name FROM public.schema_migrations")
+    applied = {row[0] for row in cur.fetchall()}
+    names = sorted(f for f in os.listdir(MIGRATIONS_DIR) if f.endswith('.sql'))
+    return [name for name in names if name not in applied]
+
+
+def main():
+    dry_run = '--dry-run' in sys.argv
+    conn = psycopg2.connect(os.environ.get("NEON_DATABASE_URL"))
+    try:
+        with conn, conn.cursor() as cur:
+            pending = pending_migrations(cur)
+        
+        if not pending:
+            print("Nessuna migrazione da applicare.")
+            return
+        
+        for name in pending:
+            print(f"{'[dry-run] ' if dry_run else ''}Applico {name}")
+            if dry_run:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                sql = f.read()
+            # Una transazione per file: se fallisce non resta applicata a metà
+            with conn, conn.cursor() as cur:
+                cur.execute(sql)
+                cur.execute("INSERT INTO public.schema_migrations (name) VALUES (%s)", (name,))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
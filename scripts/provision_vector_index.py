@@ -0,0 +1,73 @@
+"""Crea (o ricrea) l'indice ANN su books.embedding usato dalla ricerca semantica.
+
+HNSW con m / ef_construction configurabili (default pgvector 16 / 64), oppure
+IVFFlat con --lists. La costruzione usa CREATE INDEX CONCURRENTLY, quindi non
+blocca le letture; con --replace il nuovo indice viene creato prima di eliminare
+quello vecchio.
+
+Uso: NEON_DATABASE_URL=postgresql://... python scripts/provision_vector_index.py
+         [--method hnsw|ivfflat] [--m 16] [--ef-construction 64] [--lists 100]
+         [--maintenance-work-mem 1GB] [--replace] [--dry-run]
+"""
+import argparse
+import os
+
+import psycopg2
+
+INDEX_NAME = 'books_embedding_ann'
+
+
+def index_statement(args, name: str) -> str:
+    if args.method == 'hnsw':
+        options = f"m = {args.m}, ef_construction = {args.ef_construction}"
+    else:
+        options = f"lists = {args.lists}"
+    return (f"CREATE INDEX CONCURRENTLY {name} ON public.books "
+            f"USING {args.method} (embedding vector_cosine_ops) WITH ({options})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--method', choices=('hnsw', 'ivfflat'), default='hnsw')
+    parser.add_argument('--m', type=int, default=16)
+    parser.add_argument('--ef-construction', type=int, default=64)
+    parser.add_argument('--lists', type=int, default=100)
+    parser.add_argument('--maintenance-work-mem', default=None)
+    parser.add_argument('--replace', action='store_true', help="ricrea l'indice se esiste già")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ.get("NEON_DATABASE_URL"))
+    # CREATE INDEX CONCURRENTLY non può girare in una transazione
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = 'public' AND indexname = %s",
+                        (INDEX_NAME,))
+            existing = cur.fetchone()
+            if existing and not args.replace:
+                print(f"Indice già presente: {existing[0]}")
+                print("Usa --replace per ricrearlo con i nuovi parametri.")
+                return
+            
+            name = f"{INDEX_NAME}_new" if existing else INDEX_NAME
+            statements = []
+            if args.maintenance_work_mem:
+                statements.append(f"SET maintenance_work_mem = '{args.maintenance_work_mem}'")
+            statements.append(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            statements.append(index_statement(args, name))
+            if existing:
+                statements.append(f"DROP INDEX CONCURRENTLY {INDEX_NAME}")
+                statements.append(f"ALTER INDEX {name} RENAME TO {INDEX_NAME}")
+            statements.append("ANALYZE public.books")
+            
+            for statement in statements:
+                print(f"{'[dry-run] ' if args.dry_run else ''}{statement}")
+                if not args.dry_run:
+                    cur.execute(statement)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import gzip
+import os
+import sys
+import unittest
+
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import search
+
+
+class NegotiateEncodingTest(unittest.TestCase):
+    """Accept-Encoding: brotli se installato, poi gzip; q=0 esclude la codifica."""
+
+    def setUp(self):
+        self._brotli = search.brotli
+
+    def tearDown(self):
+        search.brotli = self._brotli
+
+    def test_without_brotli(self):
+        search.brotli = None
+        cases = {
+            'gzip, deflate, br': 'gzip',
+            'br': None,
+            'GZIP;q=0.5': 'gzip',
+            'gzip;q=0': None,
+            'gzip; q=0.0, *': None,
+            '*': 'gzip',
+            '*;q=0': None,
+            'gzip;q=abc': None,
+            '': None,
+            None: None,
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(search.negotiate_encoding(header), expected)
+
+    def test_brotli_preferred_when_installed(self):
+        search.brotli = object()
+        self.assertEqual(search.negotiate_encoding('gzip, br'), 'br')
+        self.assertEqual(search.negotiate_encoding('gzip, br;q=0'), 'gzip')
+        self.assertEqual(search.negotiate_encoding('*'), 'br')
+
+
+class CompressBodyTest(unittest.TestCase):
+
+    def test_gzip_round_trip_is_deterministic(self):
+        body = b'{"risultati": []}' * 200
+        compressed = search.compress_body(body, 'gzip')
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(gzip.decompress(compressed), body)
+        # mtime=0: stesso body, stessi byte (ETag e cache intermedie)
+        self.assertEqual(search.compress_body(body, 'gzip'), compressed)
+
+    def test_identity(self):
+        self.assertEqual(search.compress_body(b'abc', None), b'abc')
+
+    @unittest.skipIf(search.brotli is None, "brotli non installato")
+    def test_brotli_round_trip(self):
+        body = b'{"risultati": []}' * 200
+        self.assertEqual(search.brotli.decompress(search.compress_body(body, 'br')), body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import base64
+import json
+import os
+import sys
+import unittest
+
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import search
+
+
+class CursorTest(unittest.TestCase):
+    """Cursori della ricerca per nome: round-trip, firma e forma della chiave."""
+
+    def test_round_trip(self):
+        self.assertEqual(search.decode_cursor(search.encode_cursor(['1998', 42]), 2), ['1998', 42])
+        self.assertEqual(search.decode_cursor(search.encode_cursor([0.75, '0000', 7]), 5), [0.75, '0000', 7])
+
+    def test_tampered_payload_is_rejected(self):
+        token = search.encode_cursor(['1998', 42])
+        payload, signature = token.split('.')
+        forged = base64.urlsafe_b64encode(json.dumps(['1998', 41]).encode()).decode().rstrip('=')
+        for bad in (forged + '.' + signature, payload + '.' + signature[::-1], payload, payload + '.'):
+            with self.subTest(token=bad):
+                with self.assertRaises(search.CursorError):
+                    search.decode_cursor(bad, 2)
+
+    def test_malformed_tokens(self):
+        for bad in ('', '!!!', 'a.b.c', None, 12):
+            with self.subTest(token=bad):
+                with self.assertRaises(search.CursorError):
+                    search.decode_cursor(bad, 2)
+
+    def test_key_must_match_the_category(self):
+        # Chiave di una menzione (rilevanza, anno, id) usata su un'altra categoria, e viceversa
+        with self.assertRaises(search.CursorError):
+            search.decode_cursor(search.encode_cursor([0.5, '2001', 3]), 2)
+        with self.assertRaises(search.CursorError):
+            search.decode_cursor(search.encode_cursor(['2001', 3]), 5)
+        with self.assertRaises(search.CursorError):
+            search.decode_cursor(search.encode_cursor(['2001', '3']), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
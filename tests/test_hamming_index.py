@@ -0,0 +1,82 @@
+import os
+import random
+import sys
+import time
+import unittest
+
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import search
+
+
+def brute_force(entries, hash_hex, k, max_distance):
+    query = int(hash_hex, 16)
+    found = sorted((bin(value ^ query).count("1"), book_id) for book_id, value in entries.items())
+    return [item for item in found if item[0] <= max_distance][:k]
+
+
+class HammingIndexTest(unittest.TestCase):
+    """Indice delle copertine: stessi risultati della scansione esaustiva, più veloce."""
+
+    def setUp(self):
+        self.rng = random.Random(7)
+        self.entries = {book_id: self.rng.getrandbits(64) for book_id in range(1, 2001)}
+        self.index = search.HammingIndex()
+        self.index.sync((book_id, f"{value:016x}") for book_id, value in self.entries.items())
+
+    def near(self, value, bits):
+        for bit in self.rng.sample(range(64), bits):
+            value ^= 1 << bit
+        return f"{value:016x}"
+
+    def test_nearest_matches_brute_force(self):
+        for book_id in self.rng.sample(sorted(self.entries), 20):
+            query = self.near(self.entries[book_id], self.rng.randint(0, 12))
+            with self.subTest(query=query):
+                self.assertEqual(self.index.nearest(query, 10, 25), brute_force(self.entries, query, 10, 25))
+
+    def test_upsert_update_and_remove(self):
+        self.index.upsert(5000, "ffffffffffffffff")
+        self.entries[5000] = 0xffffffffffffffff
+        self.index.upsert(10, "0000000000000000")
+        self.entries[10] = 0
+        self.index.remove(11)
+        del self.entries[11]
+        self.index.upsert(12, "non-esadecimale")
+        del self.entries[12]
+
+        self.assertEqual(len(self.index), len(self.entries))
+        self.assertEqual(self.index.nearest("0000000000000000", 1), [(0, 10)])
+        self.assertEqual(self.index.nearest("fffffffffffffffe", 1), [(1, 5000)])
+        for query in ("0000000000000000", "ffffffffffffffff", self.near(self.entries[13], 3)):
+            with self.subTest(query=query):
+                self.assertEqual(self.index.nearest(query, 5, 64), brute_force(self.entries, query, 5, 64))
+
+    def test_invalid_query(self):
+        self.assertEqual(self.index.nearest(None), [])
+        self.assertEqual(self.index.nearest("zz"), [])
+
+    def test_faster_than_python_scan(self):
+        entries = {book_id: self.rng.getrandbits(64) for book_id in range(50000)}
+        index = search.HammingIndex()
+        index.sync((book_id, f"{value:016x}") for book_id, value in entries.items())
+        query = self.near(entries[123], 4)
+
+        def best_of(fn):
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - start)
+            return min(timings)
+
+        indexed = best_of(lambda: index.nearest(query, 10))
+        scanned = best_of(lambda: brute_force(entries, query, 10, search.IMAGE_MATCH_DISTANCE))
+        self.assertEqual(index.nearest(query, 10)[0], (4, 123))
+        self.assertLess(indexed, scanned)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import search
+
+
+class EtagTest(unittest.TestCase):
+    """ETag deboli dalla chiave della richiesta e confronto con If-None-Match."""
+
+    def setUp(self):
+        self.key = search.search_cache_key({'query': 'Lucio Fontana', 'limit': 20}, version=7)
+        self.etag = search.http_etag(self.key, 7)
+
+    def test_etag_is_weak_and_stable(self):
+        self.assertEqual(self.etag, f'W/"{self.key[:32]}"')
+        same = search.search_cache_key({'query': '  lucio   FONTANA ', 'limit': '20'}, version=7)
+        self.assertEqual(search.http_etag(same, 7), self.etag)
+
+    def test_catalog_version_changes_the_etag(self):
+        newer = search.search_cache_key({'query': 'Lucio Fontana', 'limit': 20}, version=8)
+        self.assertNotEqual(search.http_etag(newer, 8), self.etag)
+
+    def test_no_etag_without_version_or_key(self):
+        self.assertIsNone(search.http_etag(self.key, 0))
+        self.assertIsNone(search.http_etag(self.key, None))
+        self.assertIsNone(search.http_etag(None, 7))
+
+    def test_if_none_match(self):
+        strong = self.etag.removeprefix('W/')
+        cases = {
+            self.etag: True,
+            strong: True,
+            f'"altro", {self.etag}': True,
+            '*': True,
+            ' * ': True,
+            '"altro"': False,
+            '': False,
+            None: False,
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(search.etag_matches(header, self.etag), expected)
+        self.assertFalse(search.etag_matches('*', None))
+
+    def test_cache_headers(self):
+        headers = search.http_cache_headers('suggest', self.etag)
+        self.assertEqual(headers['ETag'], self.etag)
+        self.assertEqual(headers['Cache-Control'], search.HTTP_CACHE_CONTROL['suggest'])
+        self.assertNotIn('ETag', search.http_cache_headers('direct', None))
+
+
+if __name__ == "__main__":
+    unittest.main()
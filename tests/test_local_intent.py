@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import search
+
+
+class ClassifyQueryLocallyTest(unittest.TestCase):
+    """Fast-path senza Claude: nomi e titoli noti, raffinamenti fatti di soli filtri."""
+
+    def setUp(self):
+        self._previous = dict(search._catalog_indexes)
+        search._catalog_indexes['entita'] = search.EntityDictionary(
+            [("Bruce Nauman", 12), ("Lucio Fontana", 30)],
+            [("Arte povera",), ("Lo spazio dell'arte povera",), ("Fotografia",)]
+        )
+        self.context = {'previousSearch': 'Lucio Fontana', 'previousFilters': {'anno_min': 1960}}
+
+    def tearDown(self):
+        search._catalog_indexes.clear()
+        search._catalog_indexes.update(self._previous)
+
+    def test_known_name_with_filters(self):
+        self.assertEqual(search.classify_query_locally("libri di Nauman Bruce in inglese"),
+                         {'tipo': 'nome', 'nome': 'Bruce Nauman', 'lingua': 'EN'})
+
+    def test_followups_from_the_prompt(self):
+        cases = {
+            "solo in inglese": {'lingua': 'EN'},
+            "e in italiano?": {'lingua': 'IT'},
+            "mostrami le monografie": {'tipo_pub': 'monografia'},
+            "dopo il 2000": {'anno_min': 2001},
+            "ma anche le collettive": {'tipo_pub': 'collettiva'},
+        }
+        for query, filters in cases.items():
+            with self.subTest(query=query):
+                expected = {'tipo': 'nome', 'nome': 'Lucio Fontana', 'anno_min': 1960, **filters}
+                self.assertEqual(search.classify_query_locally(query, self.context), expected)
+
+    def test_filler_without_context_is_not_decided(self):
+        self.assertIsNone(search.classify_query_locally("solo in inglese"))
+
+    def test_filler_alone_is_not_a_followup(self):
+        self.assertIsNone(search.classify_query_locally("e allora?", self.context))
+
+    def test_short_title_goes_to_claude(self):
+        self.assertIsNone(search.classify_query_locally("Arte povera"))
+        self.assertIsNone(search.classify_query_locally("fotografia"))
+
+    def test_long_exact_title(self):
+        self.assertEqual(search.classify_query_locally("lo spazio dell'arte povera"),
+                         {'tipo': 'titolo', 'titolo': "Lo spazio dell'arte povera"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import search
+
+
+class FileResponseBackendTest(unittest.TestCase):
+    """Cache delle risposte su SQLite: limiti di voci e byte, ordine LRU, hit senza scritture."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'responses.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def backend(self, max_entries=0, max_bytes=0, ttl=0):
+        return search.FileResponseBackend(self.path, max_entries, max_bytes, ttl)
+
+    def test_byte_bound_evicts_least_recently_used(self):
+        cache = self.backend(max_bytes=3000)
+        for key in 'abc':
+            cache.set(key, key.encode() * 1000)
+        self.assertEqual(cache.get('a'), b'a' * 1000)
+        cache.set('d', b'd' * 1000)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(key) is not None for key in 'acd'], [True, True, True])
+        self.assertEqual(cache.get_stats()['byte'], 3000)
+
+    def test_entry_bound(self):
+        cache = self.backend(max_entries=2)
+        for key in 'abc':
+            cache.set(key, b'x')
+        self.assertEqual(cache.get_stats()['voci'], 2)
+        self.assertIsNone(cache.get('a'))
+
+    def test_hits_do_not_write(self):
+        cache = self.backend(max_entries=10)
+        cache.set('a', b'risposta')
+        conn = cache._connection()
+        before = conn.total_changes
+        for _ in range(cache.ACCESS_BATCH - 1):
+            self.assertEqual(cache.get('a'), b'risposta')
+        self.assertEqual(conn.total_changes, before)
+        self.assertFalse(conn.in_transaction)
+
+    def test_expired_entries(self):
+        cache = self.backend(ttl=60)
+        cache.set('a', b'x')
+        cache._connection().execute("UPDATE responses SET created = created - 120")
+        self.assertIsNone(cache.get('a'))
+        cache.set('b', b'y')
+        self.assertEqual(cache.get_stats()['voci'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+from io import BytesIO
+
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+from PIL import Image
+
+import search
+
+
+def encode_image(image_format: str, size=(64, 48)) -> bytes:
+    encoded = BytesIO()
+    Image.new('RGB', size, (180, 40, 20)).save(encoded, image_format)
+    return encoded.getvalue()
+
+
+def multipart(boundary: bytes, parts: list) -> bytes:
+    body = b''
+    for name, content_type, content in parts:
+        body += b'--' + boundary + b'\r\nContent-Disposition: form-data; name="' + name + b'"'
+        if content_type:
+            body += b'; filename="foto"\r\nContent-Type: ' + content_type
+        body += b'\r\n\r\n' + content + b'\r\n'
+    return body + b'--' + boundary + b'--\r\n'
+
+
+class ParseMultipartTest(unittest.TestCase):
+    """Upload multipart: parti come viste sul body, immagine aperta senza copia."""
+
+    def setUp(self):
+        self.image = encode_image('PNG')
+        self.body = multipart(b'XyZ', [
+            (b'image', b'Image/PNG', self.image),
+            (b'query', None, 'libri di Fontana'.encode()),
+            (b'limit', None, b'20'),
+        ])
+
+    def test_parts_and_content_types(self):
+        parts = search.parse_multipart(self.body, b'XyZ')
+        self.assertEqual(set(parts), {'image', 'query', 'limit'})
+        self.assertEqual(parts['image'][0], 'image/png')
+        self.assertIsNone(parts['query'][0])
+        self.assertEqual(bytes(parts['query'][1]).decode(), 'libri di Fontana')
+        self.assertEqual(bytes(parts['limit'][1]), b'20')
+
+    def test_image_is_a_view_on_the_body(self):
+        image = search.parse_multipart(self.body, b'XyZ')['image'][1]
+        self.assertIsInstance(image, memoryview)
+        self.assertIs(image.obj, self.body)
+        self.assertEqual(image.tobytes(), self.image)
+
+    def test_truncated_body(self):
+        with self.assertRaises(search.UploadError) as raised:
+            search.parse_multipart(self.body[:len(self.body) // 2], b'XyZ')
+        self.assertEqual(raised.exception.status, 400)
+
+    def test_boundary_from_content_type(self):
+        self.assertEqual(search.multipart_boundary('multipart/form-data; boundary="XyZ"'), b'XyZ')
+        with self.assertRaises(search.UploadError):
+            search.multipart_boundary('multipart/form-data')
+
+    def test_prepare_cover_image_reads_the_view(self):
+        for image_format in ('JPEG', 'PNG', 'WEBP'):
+            with self.subTest(image_format=image_format):
+                raw = encode_image(image_format, (2400, 1600))
+                body = multipart(b'b', [(b'image', b'image/x', raw)])
+                view = search.parse_multipart(body, b'b')['image'][1]
+                prepared = search.prepare_cover_image(view)
+                self.assertEqual(prepared['formato'], image_format)
+                self.assertEqual(max(prepared['immagine'].size), search.IMAGE_MAX_EDGE)
+                self.assertEqual(prepared['data'], search.prepare_cover_image(raw)['data'])
+
+
+if __name__ == "__main__":
+    unittest.main()